@@ -0,0 +1,4 @@
+'''
+Benchmarks for the Irccat data path. Run from the plugins directory
+e. g., python3 -m Irccat.bench.auth_cache
+'''
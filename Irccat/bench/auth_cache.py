@@ -0,0 +1,49 @@
+'''
+Lines/sec through IrccatProtocol.lineReceived with and without the
+credential cache, using a slow (sha512-crypt) password hash.
+'''
+
+import crypt
+
+from .. import plugin
+from . import common
+
+LINES = 2000
+ROUNDS = 20000
+
+
+def lines_per_sec(auth_cache, sections, count):
+    ''' Feed count lines through a protocol, return lines/sec. '''
+    # pylint: disable=W0212
+    proto = plugin.IrccatProtocol(plugin._Ingest(sections,
+                                                 plugin._Blacklist(),
+                                                 auth_cache,
+                                                 [],
+                                                 common.NullConn()))
+    proto.makeConnection(common.Transport())
+    line = b'bench;benchpw;some build output'
+    return common.rate(lambda: proto.lineReceived(line), count)
+
+
+def main():
+    ''' Indeed: main function. '''
+    salt = '$6$rounds=%d$benchsalt' % ROUNDS
+    sections = plugin._Sections()                     # pylint: disable=W0212
+    section = {'password': crypt.crypt('benchpw', salt),
+               'channels': ['#bench']}
+    sections.apply(('snapshot', 1, {'bench': section}))
+
+    uncached = plugin._AuthCache()                    # pylint: disable=W0212
+    uncached.TTL = 0
+    before = lines_per_sec(uncached, sections, LINES // 20)
+    cached = plugin._AuthCache()                      # pylint: disable=W0212
+    after = lines_per_sec(cached, sections, LINES)
+
+    print('sha512-crypt, %d rounds' % ROUNDS)
+    print('  crypt() per line: %10.1f lines/sec' % before)
+    print('  cached:           %10.1f lines/sec' % after)
+    print('  speedup:          %10.1fx' % (after / before))
+
+
+if __name__ == '__main__':
+    main()
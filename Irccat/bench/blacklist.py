@@ -0,0 +1,83 @@
+'''
+Stress test for _Blacklist: a million distinct failing addresses, as
+from a port scan. Reports memory held afterwards and per-call cost,
+for the old unbounded dict and the current bounded table.
+'''
+
+import time
+import tracemalloc
+
+from .. import plugin
+
+ADDRESSES = 1000000
+
+
+class UnboundedBlacklist(object):
+    ''' The old _Blacklist: a dict growing forever. '''
+
+    FailMax = 8
+    BlockTime = 500
+
+    def __init__(self):
+        self._state = {}
+
+    def register(self, host, status):
+        ''' Register an event coming from host (address) being OK/Fail. '''
+        if not host in self._state:
+            self._state[host] = (1, status, time.time())
+            return
+        count, oldstate, when = self._state[host]
+        if oldstate == status:
+            self._state[host] = (count + 1, oldstate, when)
+        else:
+            self._state[host] = (1, status, time.time())
+
+    def onList(self, host):
+        ''' Return True if host is blacklisted i. e., should be blocked.'''
+        if not host in self._state:
+            return False
+        count, oldstate, when = self._state[host]
+        if oldstate:
+            return False
+        if count >= self.FailMax:
+            if time.time() - when < self.BlockTime:
+                return True
+            else:
+                self._state[host] = (1, oldstate, time.time())
+        return False
+
+
+def hosts():
+    ''' Yield ADDRESSES distinct IPv4 addresses. '''
+    for i in range(0, ADDRESSES):
+        yield '10.%d.%d.%d' % (i >> 16, (i >> 8) & 0xff, i & 0xff)
+
+
+def scan(blacklist):
+    ''' A connection per host which fails, as in irccat. '''
+    for host in hosts():
+        if not blacklist.onList(host):
+            blacklist.register(host, False)
+
+
+def main():
+    ''' Indeed: main function. '''
+    # pylint: disable=W0212
+    print('%d distinct failing addresses' % ADDRESSES)
+    for label, factory in [('unbounded dict', UnboundedBlacklist),
+                           ('bounded LRU', plugin._Blacklist)]:
+        blacklist = factory()
+        start = time.time()
+        scan(blacklist)
+        per_call = (time.time() - start) / ADDRESSES / 2
+        blacklist = factory()
+        tracemalloc.start()
+        scan(blacklist)
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('  %-15s %8.2f MB held  %6.2f us per lookup/register' %
+              (label, held / 1e6, per_call * 1e6))
+
+
+if __name__ == '__main__':
+    main()
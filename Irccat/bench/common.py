@@ -0,0 +1,58 @@
+''' Helpers shared by the benchmarks. '''
+
+import time
+
+
+class NullConn(object):
+    ''' Stand-in for the io_process end of the pipe. '''
+
+    def __init__(self):
+        self.count = 0
+
+    def send(self, obj):
+        ''' Swallow obj, just count it. '''
+        self.count += 1
+
+
+class Peer(object):
+    ''' Stand-in for a twisted IAddress. '''
+
+    host = '127.0.0.1'
+
+
+class Transport(object):
+    ''' Stand-in for a twisted transport. '''
+
+    disconnecting = False
+
+    def getPeer(self):
+        ''' Return the fake peer. '''
+        return Peer()
+
+    def abortConnection(self):
+        ''' Nothing to abort. '''
+        pass
+
+    def loseConnection(self):
+        ''' Nothing to lose. '''
+        pass
+
+
+def rate(func, count):
+    ''' Run func() count times, return calls per second. '''
+    start = time.time()
+    for i in range(0, count):                       # pylint: disable=W0612
+        func()
+    return count / (time.time() - start)
+
+
+def percentiles(samples, which = (50, 90, 99)):
+    ''' Return list of (percentile, value) for the samples list. '''
+    samples = sorted(samples)
+    if not samples:
+        return [(p, 0.0) for p in which]
+    result = []
+    for p in which:
+        ix = min(len(samples) - 1, int(len(samples) * p / 100.0))
+        result.append((p, samples[ix]))
+    return result
@@ -0,0 +1,83 @@
+'''
+Section store: load time and update latency against section count,
+full rewrite of sections.json per update (the old _Config._dump,
+without its pprint) versus the journal + snapshot _Config.
+'''
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from .. import config
+from .. import plugin
+from . import common
+
+COUNTS = (100, 1000, 10000)
+UPDATES = 200
+
+
+def make_sections(count):
+    ''' Return dict with count sections. '''
+    section = {'password': 'abNhdvNQ6hOIw', 'channels': ['#a', '#b']}
+    return dict([('section%d' % i, section) for i in range(0, count)])
+
+
+def timed(func):
+    ''' Return seconds spent in func(). '''
+    start = time.time()
+    func()
+    return time.time() - start
+
+
+def rewrite(sections, path):
+    ''' Old style: dump all, return (update latencies, load time). '''
+    def dump():
+        ''' Rewrite file. '''
+        with open(path, 'w') as f:
+            json.dump(sections, f)
+    latencies = []
+    for i in range(0, UPDATES):
+        sections['section%d' % i] = {'password': 'x', 'channels': ['#c']}
+        latencies.append(timed(dump))
+    return latencies, timed(lambda: json.load(open(path)))
+
+
+def journal(sections, path):
+    ''' _Config: journal + snapshot, return (update latencies, load). '''
+    with open(path, 'w') as f:
+        json.dump({'format': 2, 'version': 0, 'sections': sections}, f)
+    config.global_option('sectionspath').setValue(path)
+    store = plugin._Config()                          # pylint: disable=W0212
+    latencies = []
+    for i in range(0, UPDATES):
+        latencies.append(
+            timed(lambda: store.update('section%d' % i, 'x', ['#c'])))
+    store.close()
+    holder = []
+    load = timed(lambda: holder.append(plugin._Config()))
+    holder[0].close()
+    return latencies, load
+
+
+def main():
+    ''' Indeed: main function. '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('%d updates, latencies in ms' % UPDATES)
+        for count in COUNTS:
+            for label, func in [('rewrite', rewrite), ('journal', journal)]:
+                path = os.path.join(tmpdir, '%s-%d.json' % (label, count))
+                latencies, load = func(make_sections(count), path)
+                pcts = common.percentiles(latencies, (50, 99))
+                print('  %6d sections %-8s load %7.2f  update %s' %
+                      (count, label, load * 1000,
+                       ', '.join(['p%d %.3f' % (p, v * 1000)
+                                  for p, v in pcts])))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+'''
+The process engine, twisted in a forked io_process passing pickled
+frames on a pipe, against the asyncio engine, a thread in the bot
+process passing frames on a queue: memory, startup time (start to
+first line delivered) and latency of single lines in a session. Each
+engine runs in a fresh interpreter, started as this module with the
+engine as argument. The section has high priority, so lines are not
+held for a frame.
+'''
+
+import crypt
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from .. import plugin
+from . import common
+
+PORT = 23498
+LINES = 2000               # Lines for the latency test.
+
+
+class Settings(object):
+    ''' The _Config attributes used by _Listeners and the workers. '''
+
+    httpport = 0
+    udpport = 0
+    unixpath = ''
+    unixmode = 0o660
+    workers = 1
+    transport = 'pipe'
+    ringsize = 1 << 20
+    ringoverflow = 'block'
+
+    def __init__(self, engine):
+        self.port = PORT
+        self.engine = engine
+
+    def snapshot(self):
+        ''' The config update sent to a new worker. '''
+        section = {'password': crypt.crypt('benchpw', 'ab'),
+                   'channels': ['#bench'],
+                   'priority': 'high'}
+        return ('snapshot', 1, {'bench': section})
+
+
+def memory(pid):
+    ''' Return (rss, pss) of process pid in MB, from /proc. '''
+    result = {}
+    with open('/proc/%d/smaps_rollup' % pid) as f:
+        for line in f:
+            words = line.split()
+            if words[0] in ('Rss:', 'Pss:'):
+                result[words[0]] = int(words[1]) / 1024.0
+    return result['Rss:'], result['Pss:']
+
+
+def receive(source):
+    ''' Wait for next non-empty frame from source, return it. '''
+    while True:
+        for ready in plugin._wait_any([source], 5):  # pylint: disable=W0212
+            frame = ready.read()
+            if frame:
+                return frame
+        assert not source.closed, 'Engine has exited'
+
+
+def measure(engine):
+    ''' Run engine, return dict with results. '''
+    # pylint: disable=W0212
+    settings = Settings(engine)
+    listeners = plugin._Listeners()
+    sockets = listeners.claim(settings)[0]
+    if engine == 'asyncio':
+        worker_class = plugin._AsyncioWorker
+    else:
+        worker_class = plugin._Worker
+    before = memory(os.getpid())[0]
+    start = time.time()
+    worker = worker_class(settings, sockets, lambda w, kind, payload: None)
+    worker.start()
+    client = socket.create_connection(('localhost', PORT))
+    try:
+        client.sendall(b'AUTH bench;benchpw\nfirst\n')
+        receive(worker.source)
+        result = {'startup': time.time() - start}
+        latencies = []
+        for i in range(0, LINES):
+            sent = time.time()
+            client.sendall(b'line %d\n' % i)
+            receive(worker.source)
+            latencies.append(time.time() - sent)
+        result['latency'] = common.percentiles(latencies, (50, 99))
+        rss = memory(os.getpid())[0]
+        result['main'] = rss - before
+        if engine == 'process':
+            result['io'] = memory(worker.process.pid)
+    finally:
+        client.close()
+        worker.terminate()
+        worker.join(5)
+        listeners.close()
+    return result
+
+
+def main():
+    ''' Indeed: main function. '''
+    if len(sys.argv) > 1:
+        print(json.dumps(measure(sys.argv[1])))
+        return
+    print('%d lines, times in ms, memory in MB' % LINES)
+    for engine in ('process', 'asyncio'):
+        output = subprocess.check_output(
+            [sys.executable, '-m', __spec__.name, engine]).decode()
+        result = json.loads([line for line in output.splitlines()
+                             if line.startswith('{')][-1])    # Not logs.
+        io = ''
+        if 'io' in result:
+            io = '  io process rss %5.1f pss %5.1f' % tuple(result['io'])
+        print('  %-8s startup %6.1f  latency %s  bot process %+5.1f%s' %
+              (engine, result['startup'] * 1000,
+               ', '.join(['p%d %.3f' % (p, v * 1000)
+                          for p, v in result['latency']]),
+               result['main'], io))
+
+
+if __name__ == '__main__':
+    main()
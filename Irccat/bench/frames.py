@@ -0,0 +1,78 @@
+'''
+Parsing cost of the line protocol against the framed protocol: lines
+/sec through IrccatProtocol.dataReceived, data fed in 64 KiB chunks as
+from a socket. Line protocol clients use session mode; frames carry 1
+to 1000 records. The decoder alone is timed too. No filters, messages
+go to a stand-in for the pipe.
+'''
+
+import crypt
+import time
+
+from .. import plugin
+from . import common
+
+LINES = 200000
+CHUNK = 65536
+RECORDS = (1, 10, 100, 1000)       # Records per frame.
+TEXT = 'gcc -O2 -c -o build/obj/some_file.o src/some_file.c'
+
+
+def chunks(data):
+    ''' Return data split in CHUNK sized pieces. '''
+    return [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+
+def protocol():
+    ''' Return a connected IrccatProtocol. '''
+    # pylint: disable=W0212
+    sections = plugin._Sections()
+    section = {'password': crypt.crypt('benchpw', 'ab'),
+               'channels': ['#bench']}
+    sections.apply(('snapshot', 1, {'bench': section}))
+    batcher = plugin._Batcher(common.NullConn())
+    batcher.MaxFrame = 1000000          # No reactor, don't wait for it.
+    proto = plugin.IrccatProtocol(plugin._Ingest(sections,
+                                                 plugin._Blacklist(),
+                                                 plugin._AuthCache(),
+                                                 [],
+                                                 batcher))
+    proto.makeConnection(common.Transport())
+    return proto
+
+
+def feed(data, parse):
+    ''' Return lines/sec when passing data in chunks to parse(). '''
+    pieces = chunks(data)
+    start = time.time()
+    for piece in pieces:
+        parse(piece)
+    return LINES / (time.time() - start)
+
+
+def framed(records):
+    ''' Return framed protocol data, records per frame. '''
+    # pylint: disable=W0212
+    frames = [plugin._encode_frame('bench', 'benchpw' if i == 0 else '',
+                                   [TEXT] * records)
+              for i in range(0, LINES // records)]
+    return plugin._FrameDecoder.Magic + b''.join(frames)
+
+
+def main():
+    ''' Indeed: main function. '''
+    # pylint: disable=W0212
+    print('%d lines of %d bytes, lines/sec' % (LINES, len(TEXT)))
+    lines = b'AUTH bench;benchpw\n' + (TEXT + '\n').encode() * LINES
+    print('  line protocol            %9.0f' %
+          feed(lines, protocol().dataReceived))
+    for records in RECORDS:
+        data = framed(records)
+        decoder = plugin._FrameDecoder()
+        decoded = feed(data[len(decoder.Magic):], decoder.feed)
+        print('  frames of %4d records   %9.0f   decoder only %9.0f' %
+              (records, feed(data, protocol().dataReceived), decoded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+'''
+Throughput and latency from io_process to main process: one pickle
+per message, frames built by _Batcher and the shm ring transport. Load
+is bursty, the irc side is replaced by a stand-in which counts messages.
+'''
+
+import crypt
+import multiprocessing
+import time
+
+from supybot import ircmsgs
+
+from .. import plugin
+from .. import ring
+from . import common
+
+BURSTS = 200
+BURST_SIZE = 250
+GAP = 0.005
+
+
+class StandInIrc(object):
+    ''' Swallows messages queued for irc. '''
+
+    def __init__(self):
+        self.count = 0
+
+    def queueMsg(self, msg):
+        ''' Count msg, nothing more. '''
+        self.count += 1
+
+
+def producer(conn, max_frame, ring_):
+    ''' io_process lookalike: bursts of lines -> protocol -> conn. '''
+    # pylint: disable=W0212
+    from twisted.internet import reactor
+
+    if ring_:
+        batcher = plugin._Batcher(plugin._RingWriter(ring_))
+    else:
+        batcher = plugin._Batcher(conn)
+    batcher.MaxFrame = max_frame
+    sections = plugin._Sections()
+    section = {'password': crypt.crypt('benchpw', 'ab'),
+               'channels': ['#bench']}
+    sections.apply(('snapshot', 1, {'bench': section}))
+    proto = plugin.IrccatProtocol(plugin._Ingest(sections,
+                                                 plugin._Blacklist(),
+                                                 plugin._AuthCache(),
+                                                 [],
+                                                 batcher))
+    proto.makeConnection(common.Transport())
+    proto.lineReceived(b'AUTH bench;benchpw')
+
+    def burst():
+        ''' Feed BURST_SIZE time-stamped lines. '''
+        for i in range(0, BURST_SIZE):                # pylint: disable=W0612
+            proto.lineReceived(('%.9f some build output' %
+                                time.time()).encode())
+
+    def done():
+        ''' Flush and tell consumer we're done. '''
+        batcher.flush()
+        conn.send(None)
+        reactor.stop()
+
+    for i in range(0, BURSTS):
+        reactor.callLater(i * GAP, burst)
+    reactor.callLater(BURSTS * GAP + 0.1, done)
+    reactor.run()
+
+
+def run(max_frame, ring_ = None):
+    ''' Run producer process and consume, return (msgs/sec, latencies). '''
+    # pylint: disable=W0212
+    pipe = multiprocessing.Pipe()
+    process = multiprocessing.Process(target = producer,
+                                      args = (pipe[0], max_frame, ring_))
+    irc = StandInIrc()
+    latencies = []
+    first = None
+    process.start()
+    while True:
+        if ring_ and ring_.wait(0.01):
+            frame = ring_.consume(plugin._decode_record)
+        elif pipe[1].poll(0 if ring_ else 1.0):
+            msg = pipe[1].recv()
+            if msg is None:
+                break
+            frame = msg[1]
+        elif not process.is_alive():
+            raise RuntimeError('producer died')
+        else:
+            continue
+        now = time.time()
+        for msg, channels, lane, when in frame:   # pylint: disable=W0612
+            sent = float(msg.split(' ', 1)[0])
+            first = sent if first is None else first
+            for channel in channels:
+                irc.queueMsg(ircmsgs.notice(channel, msg))
+            latencies.append(now - sent)
+        last = time.time()
+    process.join()
+    return irc.count / (last - first), latencies
+
+
+def main():
+    ''' Indeed: main function. '''
+    print('%d bursts of %d lines, %.1f ms apart' %
+          (BURSTS, BURST_SIZE, GAP * 1000))
+    max_frame = plugin._Batcher.MaxFrame              # pylint: disable=W0212
+    shm = ring.ShmRing(1 << 20)
+    for label, args in [('one message/send', (1,)),
+                        ('framed (%d)' % max_frame, (max_frame,)),
+                        ('shm ring', (max_frame, shm))]:
+        throughput, latencies = run(*args)
+        pcts = ', '.join(['p%d %.2f ms' % (p, v * 1000)
+                          for p, v in common.percentiles(latencies)])
+        print('  %-18s %10.0f msgs/sec  %s' % (label, throughput, pcts))
+    print('  shm ring counters: ' + str(shm.counters()))
+    shm.close()
+    shm.unlink()
+
+
+if __name__ == '__main__':
+    main()
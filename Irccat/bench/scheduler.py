@@ -0,0 +1,99 @@
+'''
+Latency for a quiet channel while a noisy section floods another one,
+with messages queued straight to irc (as before) and using _Scheduler.
+Runs in simulated time: the irc stand-in sends one message each
+THROTTLE seconds, like the supybot flood throttle.
+'''
+
+import collections
+
+from .. import plugin
+from . import common
+
+THROTTLE = 1.0          # Seconds between messages sent to irc.
+DURATION = 600          # Simulated seconds.
+FLOOD = 1500            # Lines in the initial noisy burst,
+NOISY_RATE = 2          # followed by this many lines/second.
+QUIET_EVERY = 15        # Seconds between lines to the quiet channel.
+
+
+class ThrottledIrc(object):
+    ''' Irc stand-in: a send queue, emptied by the simulation. '''
+
+    zombie = False
+
+    def __init__(self):
+        self.queue = collections.deque()
+
+    def queueMsg(self, msg):
+        ''' Queue msg for sending. '''
+        self.queue.append(msg)
+
+
+def events():
+    ''' Return time-ordered list of (time, channel, text). '''
+    result = [(0.0, '#noisy', 'noisy burst line %d' % i)
+              for i in range(0, FLOOD)]
+    t = 0.0
+    while t < DURATION:
+        t += 1.0 / NOISY_RATE
+        result.append((t, '#noisy', 'noisy line at %.3f' % t))
+    t = 0.5
+    while t < DURATION:
+        result.append((t, '#quiet', 'quiet %.3f' % t))
+        t += QUIET_EVERY
+    return sorted(result, key = lambda e: e[0])
+
+
+def simulate(scheduler):
+    ''' Run the events, return (messages, lines, latencies, backlog). '''
+    irc = ThrottledIrc()
+    pending = collections.deque(events())
+    sent = lines = 0
+    latencies = []
+    now = 0.0
+    while now < DURATION:
+        while pending and pending[0][0] <= now:
+            when, channel, text = pending.popleft()   # pylint: disable=W0612
+            if scheduler:
+                scheduler.put(irc, channel, text)
+                scheduler.pump()
+            else:
+                irc.queueMsg(plugin.ircmsgs.notice(channel, text))
+        if irc.queue:
+            msg = irc.queue.popleft()
+            sent += 1
+            for text in msg.args[1].split(plugin._Scheduler.Separator):
+                lines += 1
+                if text.startswith('quiet '):
+                    latencies.append(now - float(text.split(' ')[1]))
+        if scheduler:
+            scheduler.pump()
+        now += THROTTLE
+    backlog = len(irc.queue) + (scheduler.pending if scheduler else 0)
+    return sent, lines, latencies, backlog
+
+
+def report(name, result):
+    ''' Print one result. '''
+    sent, lines, latencies, backlog = result
+    print('%s:' % name)
+    print('  irc messages:       %6d' % sent)
+    print('  lines delivered:    %6d' % lines)
+    print('  lines left queued:  %6d' % backlog)
+    print('  quiet lines:        %6d' % len(latencies))
+    for p, value in common.percentiles(latencies, (50, 99)):
+        print('  quiet latency p%d: %8.1f s' % (p, value))
+
+
+def main():
+    ''' Indeed: main function. '''
+    print('%d line burst + %d lines/s to #noisy, one line each %d s to'
+          ' #quiet, 1 msg/%.1f s to irc, %d s'
+          % (FLOOD, NOISY_RATE, QUIET_EVERY, THROTTLE, DURATION))
+    report('queueMsg per line', simulate(None))
+    report('scheduler', simulate(plugin._Scheduler()))  # pylint: disable=W0212
+
+
+if __name__ == '__main__':
+    main()
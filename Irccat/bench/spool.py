@@ -0,0 +1,62 @@
+'''
+Spool throughput: appending lines for channels which aren't joined and
+replaying them, in batches as the plugin does (ReplayBurst) and large
+ones. Each append is flushed to the OS, not synced to disk.
+'''
+
+import shutil
+import tempfile
+import time
+
+from .. import plugin
+from .. import spool
+
+LINES = 100000
+SIZES = (64, 256)           # Bytes of text in a line.
+CHANNELS = (1, 100)         # Lines are spread over this many channels.
+BATCHES = (plugin.Irccat.ReplayBurst, 100)
+
+
+def run(size, channels, batch):
+    ''' Append and replay LINES lines, return (append, replay) lines/s. '''
+    tmpdir = tempfile.mkdtemp()
+    try:
+        spool_ = spool.Spool(tmpdir, 1 << 40, 86400)
+        text = 'x' * size
+        targets = ['#chan%d' % i for i in range(0, channels)]
+        now = time.time()
+        start = time.time()
+        for i in range(0, LINES):
+            spool_.append(targets[i % channels], text, 1, now)
+        append = LINES / (time.time() - start)
+        count = 0
+        start = time.time()
+        for target in spool_.targets():
+            while True:
+                taken = len(spool_.take(target, batch, now))
+                if not taken:
+                    break
+                count += taken
+        replay = count / (time.time() - start)
+        spool_.close()
+        assert count == LINES
+    finally:
+        shutil.rmtree(tmpdir)
+    return append, replay
+
+
+def main():
+    ''' Indeed: main function. '''
+    print('%d lines, lines/sec' % LINES)
+    for size in SIZES:
+        for channels in CHANNELS:
+            for batch in BATCHES:
+                append, replay = run(size, channels, batch)
+                print('  %4d bytes %4d channels  append %8.0f (%5.1f MB/s)'
+                      '  replay by %3d %8.0f' %
+                      (size, channels, append, append * size / 1e6, batch,
+                       replay))
+
+
+if __name__ == '__main__':
+    main()
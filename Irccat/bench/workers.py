@@ -0,0 +1,105 @@
+'''
+Ingest throughput with 1, 2 and 4 io_process workers sharing the port
+using SO_REUSEPORT. Client processes open many connections sending
+lines in the 'section;password;data' format, the main process counts
+messages arriving from all workers. Scaling requires as many free
+cores as workers.
+'''
+
+import crypt
+import multiprocessing
+import socket
+import time
+
+from .. import plugin
+
+PORT = 23499
+CLIENTS = 8                # Client processes,
+CONNECTIONS = 16           # each making this many connections,
+LINES = 1000               # each sending this many lines.
+TIMEOUT = 120              # Max time for a run (seconds).
+
+
+def client():
+    ''' Connect CONNECTIONS times, send LINES lines each time. '''
+    data = b'bench;benchpw;some build output\n' * LINES
+    for i in range(0, CONNECTIONS):                 # pylint: disable=W0612
+        s = socket.create_connection(('localhost', PORT))
+        try:
+            s.sendall(data)
+        finally:
+            s.close()
+
+
+class Settings(object):
+    ''' The _Config attributes used by _Listeners.claim(). '''
+
+    httpport = 0
+    udpport = 0
+    unixpath = ''
+    unixmode = 0o660
+
+    def __init__(self, workers):
+        self.port = PORT
+        self.workers = workers
+
+
+def run(count):
+    '''
+    Run count workers and the clients, return (lines/second, list of
+    lines handled by each worker).
+    '''
+    # pylint: disable=W0212
+    section = {'password': crypt.crypt('benchpw', 'ab'),
+               'channels': ['#bench']}
+    listeners = plugin._Listeners()
+    sources = []
+    processes = []
+    for sockets in listeners.claim(Settings(count)):
+        pipe = multiprocessing.Pipe()
+        pipe[1].send(('snapshot', 1, {'bench': section}))
+        sources.append(plugin._PipeSource(pipe[1], lambda kind, data: None))
+        processes.append(multiprocessing.Process(
+                            target = plugin.io_process,
+                            args = (pipe, sockets)))
+    for process in processes:
+        process.start()
+    try:
+        clients = [multiprocessing.Process(target = client)
+                   for i in range(0, CLIENTS)]
+        total = CLIENTS * CONNECTIONS * LINES
+        shares = dict([(source, 0) for source in sources])
+        received = 0
+        start = time.time()
+        for process in clients:
+            process.start()
+        while received < total and time.time() - start < TIMEOUT:
+            for source in plugin._wait_any(sources, 0.5):
+                lines = len(source.read())
+                shares[source] += lines
+                received += lines
+        elapsed = time.time() - start
+        for process in clients:
+            process.join()
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        listeners.close()
+    if received < total:
+        print('  %d workers: only %d of %d lines' % (count, received, total))
+    return received / elapsed, [shares[source] for source in sources]
+
+
+def main():
+    ''' Indeed: main function. '''
+    print('%d clients x %d connections x %d lines, %d cores' %
+          (CLIENTS, CONNECTIONS, LINES, multiprocessing.cpu_count()))
+    for count in (1, 2, 4):
+        throughput, shares = run(count)
+        print('  %d workers: %10.0f lines/sec, per worker: %s' %
+              (count, throughput, ' '.join([str(s) for s in shares])))
+
+
+if __name__ == '__main__':
+    main()
@@ -62,7 +62,133 @@ conf.registerGlobalValue(Irccat, 'port',
     registry.NonNegativeInteger(12345,
                                 "The TCP port irccat will listen to."))
 
+conf.registerGlobalValue(Irccat, 'httpport',
+    registry.NonNegativeInteger(0, "The TCP port for the HTTP webhook,"
+                                   " 0 disables it."))
+
+conf.registerGlobalValue(Irccat, 'udpport',
+    registry.NonNegativeInteger(0, "The UDP port irccat will listen to,"
+                                   " 0 disables it."))
+
+
+class FileMode(registry.String):
+    ''' Value must be octal file permissions like 660. '''
+
+    def setValue(self, v):
+        try:
+            int(v, 8)
+        except ValueError:
+            self.error(v)
+        registry.String.setValue(self, v)
+
+
+conf.registerGlobalValue(Irccat, 'unixpath',
+    registry.String('', 'Path to a UNIX socket irccat will listen to,'
+                        ' empty disables it.'))
+
+conf.registerGlobalValue(Irccat, 'unixmode',
+    FileMode('660', 'Octal permissions of the UNIX socket.'))
+
+conf.registerGlobalValue(Irccat, 'unixtrust',
+    registry.Boolean(False, "Don't check passwords on the UNIX socket, its"
+                            " permissions decides who can send."))
+
+conf.registerGlobalValue(Irccat, 'tlsport',
+    registry.NonNegativeInteger(0, "The TCP port for clients using TLS,"
+                                   " 0 disables it."))
+
+conf.registerGlobalValue(Irccat, 'tlscert',
+    registry.String('', 'Path to the PEM certificate (chain) for tlsport.'))
+
+conf.registerGlobalValue(Irccat, 'tlskey',
+    registry.String('', 'Path to the PEM private key for tlsport, empty if'
+                        ' it is in the tlscert file.'))
+
+
+class Engine(registry.OnlySomeStrings):
+    ''' What runs the listeners. '''
+    validStrings = ('process', 'asyncio')
+
+
+conf.registerGlobalValue(Irccat, 'engine',
+    Engine('process', 'What serves the clients: process (twisted in forked'
+                      ' io processes) or asyncio (a thread in the bot'
+                      ' process, no webhook and one worker)'))
+
+conf.registerGlobalValue(Irccat, 'workers',
+    registry.PositiveInteger(1, 'Number of io processes accepting clients.'
+                                ' They share the TCP and UDP ports using'
+                                ' SO_REUSEPORT, only the first one listens'
+                                ' on the UNIX socket'))
+
+conf.registerGlobalValue(Irccat, 'spooldir',
+    registry.String('', 'Directory where lines for non-joined channels are'
+                        ' kept until the channel is joined, empty drops'
+                        ' them'))
+
+conf.registerGlobalValue(Irccat, 'spoolsize',
+    registry.PositiveInteger(64 << 20, 'Max size of spooldir (bytes), the'
+                                       ' oldest lines are dropped first'))
+
+conf.registerGlobalValue(Irccat, 'spoolage',
+    registry.PositiveInteger(86400, 'Spooled lines older than this'
+                                    ' (seconds) are dropped'))
+
+conf.registerGlobalValue(Irccat, 'spoolrate',
+    registry.PositiveFloat(1.0, 'Max lines/second replayed from spooldir'
+                                ' to a channel when joined again'))
+
 conf.registerGlobalValue(Irccat, 'privmsg',
     registry.Boolean(False, 'Use privmsgs instead of the default notices'))
 
+
+class Transport(registry.OnlySomeStrings):
+    ''' How messages are passed from io process to main process. '''
+    validStrings = ('pipe', 'shm')
+
+
+class RingOverflow(registry.OnlySomeStrings):
+    ''' What to do when the shm ring is full. '''
+    validStrings = ('block', 'drop-oldest', 'drop-newest')
+
+
+conf.registerGlobalValue(Irccat, 'transport',
+    Transport('pipe', 'How the io process passes messages to the bot:'
+                      ' pipe (pickled frames) or shm (shared memory ring)'))
+
+conf.registerGlobalValue(Irccat, 'ringsize',
+    registry.PositiveInteger(1 << 20,
+                             'Size of the shm transport ring (bytes)'))
+
+conf.registerGlobalValue(Irccat, 'ringoverflow',
+    RingOverflow('block', 'What the shm transport does when the ring is'
+                          ' full: block, drop-oldest or drop-newest'))
+
+conf.registerGlobalValue(Irccat, 'hostrate',
+    registry.Float(0.0, 'Max lines/second accepted from one client host,'
+                        ' 0 means no limit. Per-section limits are set'
+                        ' using the sectionlimit command'))
+
+conf.registerGlobalValue(Irccat, 'hostburst',
+    registry.PositiveInteger(20, 'Max # of lines a client host can send'
+                                 ' in a burst above hostrate'))
+
+conf.registerGlobalValue(Irccat, 'highwater',
+    registry.NonNegativeInteger(200, 'Pause reading from clients when this'
+                                     ' many messages waits in the irc send'
+                                     ' queues, 0 disables'))
+
+conf.registerGlobalValue(Irccat, 'lowwater',
+    registry.NonNegativeInteger(50, 'Resume reading from paused clients'
+                                    ' when the irc send queues are down to'
+                                    ' this many messages'))
+
+conf.registerGlobalValue(Irccat, 'digestdir',
+    registry.String('', 'Directory where all lines in a digest are saved,'
+                        ' empty for no digest files'))
+
+conf.registerGlobalValue(Irccat, 'digesturl',
+    registry.String('', 'URL for digestdir, linked from digest messages.'
+                        ' Empty links to the local file path'))
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
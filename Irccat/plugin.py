@@ -29,25 +29,51 @@
 '''
 Main plugin module. See README for usage and configuration.
 
-Here is two processes, the main process and the io_process.
-The main process has a separate listener_thread.
+Here is the main process with a separate listener_thread, and one or
+more io_process workers, all listening on the same ports using
+SO_REUSEPORT when there are several.
 
-The io_process gets data from a port and forwards it to the
-main process. The main process handles user commands. A separate
-thread gets data from the io_process and forwards to irc.
+The io_process gets data from the ports and forwards it to the
+main process. The main process handles user commands. The listener
+thread gets data from the workers and forwards to irc through the
+_Scheduler, also replaying the spool.
 
 Somewhat messy. Design effected by need to run twisted in a process
 so it vcan be restarted, and that the irc state can't be shared
-i. e., the separate process can't shuffle data to irc.
-
-Here are no critical zones, this is pure message passing. The
-io_process gets updated configurations from main. Main gets data
-to print from io_process.
- '''
-
+i. e., the separate process can't shuffle data to irc. The asyncio
+engine instead serves the clients from an _AsyncioWorker thread in
+the main process, handing messages over on a queue.
+
+The io_process gets updated configurations from main over a pipe.
+Main gets data to print from io_process over the same pipe, or from
+a shared memory ring.ShmRing with the shm transport; the ring only
+locks when dropping the oldest records on overflow. The critical zones
+are in the main process: _Config and the sends to the workers under
+Irccat.lock, and _Routes updated from both the main thread and the
+listener thread under its own lock.
+
+The listening sockets, spools and TLS contexts are module globals
+claimed again after a reload, so a draining instance and the new
+one can share them.
+'''
+import asyncio
+import collections
+import functools
 import crypt
+import errno
+import hashlib
+import hmac
+import ipaddress
 import multiprocessing
+import multiprocessing.connection
+import os
+import queue
 import random
+import re
+import socket
+import ssl
+import stat
+import struct
 import sys
 import time
 try:
@@ -55,30 +81,294 @@ try:
 except ImportError:
     import json
 
-from twisted.internet import reactor, protocol
+from twisted.internet import address, reactor, protocol, unix
 from twisted.protocols import basic
+from twisted.protocols import policies
+from twisted.web import resource
+from twisted.web import server
 
 from supybot import callbacks
 from supybot import ircmsgs
+from supybot import ircutils
 from supybot import log
 from supybot import world
+from supybot.commands import addConverter
 from supybot.commands import commalist
+from supybot.commands import optional
 from supybot.commands import threading
 from supybot.commands import wrap
 
 from . import config
+from . import ring
+from . import spool
 
 
 _HELP_URL = "https://github.com/leamas/supybot-irccat"
 
+# Optional section fields and their defaults.
+_OPTIONS = {'rate': 0,             # Lines/second, 0 means no limit.
+            'burst': 1,            # Max # of lines above rate.
+            'excess': 'drop',      # Lines above limit: drop or summary.
+            'dedup': 0,            # Dedup window (seconds), 0 disables.
+            'digest': 0,           # Lines relayed in digest window, or 0.
+            'digestwindow': 60,    # Digest window (seconds).
+            'priority': 'normal'}  # One of _LANES.
+
+# Priority lanes, served in this order.
+_LANES = ('high', 'normal', 'low')
+_HIGH_LANE = 0
+_NORMAL_LANE = 1
+
+
+def _message(text, channels, lane = _NORMAL_LANE):
+    ''' Return a (data, channels, lane, time) message for main process. '''
+    return text, channels, lane, time.time()
 
-def io_process(port, pipe):
-    ''' Run the twisted-governed data flow from port -> irc. '''
+
+class _Listeners(object):
+    '''
+    Listening sockets, bound in the main process and inherited by the io
+    processes. The instance is kept across 'reload Irccat', which runs
+    this module again in the same namespace, so the sockets are handed
+    over to new io processes without ever being closed and clients are
+    never refused. Sockets not claimed within KeepTime after release()
+    are closed e. g., on 'unload Irccat'.
+    '''
+
+    KeepTime = 30.0     # Seconds from release() until sockets are closed.
+
+    def __init__(self):
+        self.sockets = {}               # (kind, address, worker) -> socket
+        self.inodes = {}                # UNIX socket path -> file inode.
+        self.generation = 0             # Bumped on each claim().
+        self.lock = threading.Lock()
+
+    def _bind(self, kind, where, reuse_port = False):
+        '''
+        Return a new, non-blocking socket listening on where. Only with
+        reuse_port can other sockets, one per worker, bind the same port;
+        without it a clash with e. g. another bot fails.
+        '''
+        if kind == 'unix':
+            self._unlink_stale(where)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        elif kind == 'udp':
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if kind != 'unix':
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if reuse_port:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                where = ('', where)
+            sock.bind(where)
+            if kind == 'unix':
+                self.inodes[where] = os.stat(where).st_ino
+            if kind != 'udp':
+                sock.listen(50)
+            sock.setblocking(False)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def _unlink_stale(path):
+        '''
+        Remove a UNIX socket at path left by a previous run, i. e. one
+        refusing connections. Raise EADDRINUSE if something listens on
+        it, e. g. another bot.
+        '''
+        try:
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                return                  # Let bind() fail.
+        except OSError:
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return
+        except OSError:
+            return
+        finally:
+            probe.close()
+        raise OSError(errno.EADDRINUSE,
+                      'UNIX socket in use by another process', path)
+
+    def _close(self, key, sock):
+        ''' Close a socket no longer used, removing UNIX socket file. '''
+        sock.close()
+        if key[0] == 'unix':
+            try:
+                if os.stat(key[1]).st_ino == self.inodes.pop(key[1], None):
+                    os.unlink(key[1])
+            except OSError:
+                pass
+
+    def claim(self, config_):
+        '''
+        Return a {option: socket} dict for each worker, option being the
+        config option for the socket: port, tlsport, httpport, udpport or
+        unixpath. Sockets already bound are reused, those not used are
+        closed first. Several workers share TCP and UDP ports using
+        SO_REUSEPORT, which is only set when there are more than one.
+        '''
+        wanted = [('tcp', 'port', config_.port),
+                  ('tcp', 'tlsport', config_.tlsport),
+                  ('tcp', 'httpport', config_.httpport),
+                  ('udp', 'udpport', config_.udpport),
+                  ('unix', 'unixpath', config_.unixpath)]
+        reuse_port = config_.workers > 1
+        keys = [[(option, (kind, where, worker, reuse_port))
+                 for kind, option, where in wanted
+                 if where and not (kind == 'unix' and worker > 0)]
+                for worker in range(0, config_.workers)]
+        used = set([key for sockets in keys for option, key in sockets])
+        result = []
+        with self.lock:
+            self.generation += 1
+            for key in set(self.sockets) - used:
+                self._close(key, self.sockets.pop(key))
+            for sockets in keys:
+                for option, key in sockets:
+                    if key not in self.sockets:
+                        self.sockets[key] = self._bind(key[0], key[1],
+                                                       reuse_port)
+                result.append(dict([(option, self.sockets[key])
+                                    for option, key in sockets]))
+        if config_.unixpath:
+            os.chmod(config_.unixpath, config_.unixmode)
+        return result
+
+    def release(self):
+        ''' Close all sockets in KeepTime unless claimed again. '''
+        timer = threading.Timer(self.KeepTime, self.close, [self.generation])
+        timer.daemon = True
+        timer.start()
+
+    def close(self, generation = None):
+        ''' Close all sockets, if generation given only if not claimed. '''
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            for key, sock in self.sockets.items():
+                self._close(key, sock)
+            self.sockets = {}
+
+
+_LISTENERS = globals().get('_LISTENERS') or _Listeners()
+
+# Shared with a draining instance after reload: directory -> spool.Spool.
+_SPOOLS = globals().get('_SPOOLS', {})
+
+
+def _claim_spool(config_):
+    ''' Return the spool for config_, None if disabled. '''
+    for directory in list(_SPOOLS):
+        if directory != config_.spooldir:
+            _SPOOLS.pop(directory).close()
+    if not config_.spooldir:
+        return None
+    if config_.spooldir not in _SPOOLS:
+        _SPOOLS[config_.spooldir] = \
+            spool.Spool(config_.spooldir, config_.spoolsize, config_.spoolage)
+    spool_ = _SPOOLS[config_.spooldir]
+    spool_.max_bytes = config_.spoolsize
+    spool_.max_age = config_.spoolage
+    return spool_
+
+
+# Kept across reloads, so session tickets issued by an earlier instance
+# still resume: (certfile, keyfile, certfile mtime) -> ssl.SSLContext.
+_TLS_CONTEXTS = globals().get('_TLS_CONTEXTS', {})
+
+
+def _claim_tls(config_):
+    '''
+    Return the server ssl context for config_, None if TLS is disabled
+    or the certificate can't be loaded. The context is made in the main
+    process and inherited by all io processes, so they share the keys
+    protecting the session tickets and a client may resume its session
+    on any of them.
+    '''
+    if not config_.tlsport:
+        _TLS_CONTEXTS.clear()
+        return None
+    try:
+        key = (config_.tlscert, config_.tlskey,
+               os.path.getmtime(config_.tlscert))
+        if key not in _TLS_CONTEXTS:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.options &= ~ssl.OP_NO_TICKET
+            context.load_cert_chain(config_.tlscert, config_.tlskey or None)
+            _TLS_CONTEXTS.clear()
+            _TLS_CONTEXTS[key] = context
+    except (OSError, ssl.SSLError) as ex:
+        log.getPluginLogger('irccat.tls').error(
+            "Can't load TLS certificate, TLS disabled: " + str(ex))
+        config_.tlsport = 0
+        return None
+    return _TLS_CONTEXTS[key]
+
+
+def _adopt(sock, factory, mode = None):
+    '''
+    Serve factory on inherited listening sock, return twisted port. A
+    UNIX socket keeps mode.
+    '''
+    # pylint: disable=E1101,W0212
+    if sock.type == socket.SOCK_DGRAM:
+        port = reactor.adoptDatagramPort(sock.fileno(), sock.family, factory)
+    elif sock.family == socket.AF_UNIX:
+        # As adoptStreamPort(), which would chmod the socket to 0666.
+        port = unix.Port._fromListeningDescriptor(reactor, sock.fileno(),
+                                                  factory)
+        port.mode = mode
+        port.startListening()
+    else:
+        port = reactor.adoptStreamPort(sock.fileno(), sock.family, factory)
+    port.socket.setblocking(False)      # fromfd() applies any default
+    return port                         # timeout, making it blocking.
+
+
+def io_process(pipe, sockets, ring_ = None, unixmode = 0o660,
+               tls_context = None):
+    '''
+    Run the twisted-governed data flow from port(s) -> irc. sockets is
+    a {option: socket} dict from _Listeners.claim(), tls_context the
+    ssl context for the tlsport socket.
+    '''
     # pylint: disable=E1101
 
     logger = log.getPluginLogger('irccat.io')
-    logger.debug("Starting IO process on %d" % port)
-    reactor.listenTCP(port, IrccatFactory(pipe))
+    logger.debug("Starting IO process on %s" %
+                 str(sockets['port'].getsockname()))
+    factory = IrccatFactory(pipe[0], ring_)
+    assert pipe[0].poll(), "No initial config!"
+    factory.update(pipe[0].recv())
+    factory.ports.append(_adopt(sockets['port'], factory))
+    if 'tlsport' in sockets:
+        logger.debug("TLS listening")
+        factory.ports.append(_adopt(sockets['tlsport'],
+                                    _TLSFactory(factory, tls_context)))
+    if 'httpport' in sockets:
+        logger.debug("Webhook listening")
+        site = server.Site(_WebhookResource(factory.ingest))
+        factory.ports.append(_adopt(sockets['httpport'], site))
+    if 'udpport' in sockets:
+        logger.debug("UDP listening")
+        factory.ports.append(_adopt(sockets['udpport'],
+                                    _DatagramListener(factory.ingest)))
+    if 'unixpath' in sockets:
+        logger.debug("Listening on UNIX socket")
+        factory.ports.append(_adopt(sockets['unixpath'], factory, unixmode))
+    reactor.addReader(_ConfigReader(factory, pipe[0]))
     try:
         reactor.run()
     except Exception as ex:                          # pylint: disable=W0703
@@ -87,246 +377,2413 @@ def io_process(port, pipe):
 
 
 class _Blacklist(object):
-    ''' Handles blacklisting of faulty  clients. '''
+    '''
+    Handles blacklisting of faulty  clients. Hosts are tracked in a
+    bounded LRU table where entries expire when not seen for BlockTime.
+    Failures are also aggregated per /24 (IPv4) or /64 (IPv6) subnet,
+    blocking a whole subnet after SubnetFailMax failures in a row.
+    Clients on the UNIX socket have host None and are never blocked.
+    If set, notify(table, key) is called when a host ('hosts') or a
+    subnet ('subnets') gets blocked, so other workers can block() it.
+    '''
 
     FailMax = 8   # Max # of times
     BlockTime = 500  # Time we wait in blacklisted state (seconds).
+    MaxHosts = 65536      # Max # of hosts (and subnets) tracked.
+    SubnetFailMax = 64    # Max # of times for a subnet, 0 disables.
 
     def __init__(self):
-        self._state = {}
+        # Entries are [count, status, when, last seen], oldest first.
+        self._hosts = collections.OrderedDict()
+        self._subnets = collections.OrderedDict()
+        self.notify = None
         self.log = log.getPluginLogger('irccat.blacklist')
 
+    @staticmethod
+    def subnet(host):
+        ''' Return the /24 or /64 subnet key for host. '''
+        if ':' not in host:
+            return host.rpartition('.')[0]
+        try:
+            return ipaddress.IPv6Address(host).packed[:8]
+        except ValueError:
+            return host
+
+    def _expire(self, table, now):
+        ''' Drop entries not seen for BlockTime, and any above MaxHosts. '''
+        while table:
+            entry = next(iter(table.values()))
+            if now - entry[3] < self.BlockTime and len(table) <= self.MaxHosts:
+                return
+            table.popitem(last = False)
+
+    def _register(self, table, key, status, fail_max, now):
+        ''' Register event in table, return True when key gets blocked. '''
+        entry = table.pop(key, None)
+        if entry is None or entry[1] != status:
+            entry = [1, status, now, now]
+        else:
+            entry[0] += 1
+            entry[3] = now
+        table[key] = entry
+        self._expire(table, now)
+        return not status and entry[0] == fail_max
+
+    def _blocked(self, table, key, fail_max, now):
+        ''' Return True if key is blocked in table. '''
+        entry = table.get(key)
+        if entry is None or entry[1]:
+            return False
+        if entry[0] >= fail_max:
+            if now - entry[2] < self.BlockTime:
+                return True
+            else:
+                entry[0] = 1
+                entry[2] = now
+        return False
+
     def register(self, host, status):
         ''' Register an event coming from host (address) being OK/Fail. '''
-        if not host in self._state:
-            self._state[host] = (1, status, time.time())
-            return
-        count, oldstate, when = self._state[host]
-        if oldstate == status:
-            self._state[host] = (count + 1, oldstate, when)
-            if not status and count + 1 == self.FailMax:
-                self.log.warning("Blacklisting: " + host)
+        if host is None:
+            return
+        now = time.time()
+        if self._register(self._hosts, host, status, self.FailMax, now):
+            self.log.warning("Blacklisting: " + host)
+            if self.notify:
+                self.notify('hosts', host)
+        if self.SubnetFailMax:
+            subnet = self.subnet(host)
+            if self._register(self._subnets, subnet, status,
+                              self.SubnetFailMax, now):
+                self.log.warning("Blacklisting subnet of: " + host)
+                if self.notify:
+                    self.notify('subnets', subnet)
+
+    def block(self, table, key):
+        ''' Block a host or subnet blocked by another worker. '''
+        now = time.time()
+        if table == 'subnets':
+            table, fail_max = self._subnets, self.SubnetFailMax
         else:
-            self._state[host] = (1, status, time.time())
+            table, fail_max = self._hosts, self.FailMax
+        table.pop(key, None)
+        table[key] = [fail_max, False, now, now]
+        self._expire(table, now)
 
     def onList(self, host):
         ''' Return True if host is blacklisted i. e., should be blocked.'''
-        if not host in self._state:
+        if host is None:
             return False
-        count, oldstate, when = self._state[host]
-        if oldstate:
-            return False
-        if count >= self.FailMax:
-            if time.time() - when < self.BlockTime:
+        now = time.time()
+        if self._blocked(self._hosts, host, self.FailMax, now):
+            return True
+        if self.SubnetFailMax:
+            return self._blocked(self._subnets, self.subnet(host),
+                                 self.SubnetFailMax, now)
+        return False
+
+    def __len__(self):
+        ''' Return # of tracked hosts. '''
+        return len(self._hosts)
+
+
+class _AuthCache(object):
+    '''
+    Remembers recently verified (section, password) pairs, so that
+    crypt() isn't run for each and every line. Only the keyed digest
+    of the cleartext password is stored.
+    '''
+
+    MaxSize = 256    # Max # of cached credentials.
+    TTL = 600        # Time a verified credential is trusted (seconds).
+
+    def __init__(self, hasher = crypt.crypt):
+        self._hasher = hasher
+        self._key = os.urandom(32)
+        self._cache = collections.OrderedDict()
+
+    def verify(self, section, cleartext_pw, cipher_pw):
+        ''' Return True if cleartext_pw matches section's cipher_pw. '''
+        digest = hmac.new(self._key, cleartext_pw.encode(),
+                          hashlib.sha256).digest()
+        key = (section, cipher_pw, digest)
+        when = self._cache.get(key)
+        if when is not None:
+            if time.time() - when < self.TTL:
+                self._cache.move_to_end(key)
                 return True
-            else:
-                self._state[host] = (1, oldstate, time.time())
+            del self._cache[key]
+        if self._hasher(cleartext_pw, cipher_pw) != cipher_pw:
+            return False
+        self._cache[key] = time.time()
+        while len(self._cache) > self.MaxSize:
+            self._cache.popitem(last = False)
+        return True
+
+    def clear(self):
+        ''' Forget all verified credentials. '''
+        self._cache.clear()
+
+    def forget(self, section):
+        ''' Forget verified credentials for section. '''
+        for key in [k for k in self._cache if k[0] == section]:
+            del self._cache[key]
+
+
+class _TokenBuckets(object):
+    '''
+    Token buckets in a bounded LRU table. A bucket holds at most burst
+    tokens and is refilled with rate tokens/second; each line takes one.
+    An evicted bucket is the one idle the longest, likely full anyway.
+    '''
+
+    MaxBuckets = 65536    # Max # of buckets tracked.
+
+    def __init__(self):
+        self._buckets = collections.OrderedDict()    # key -> [tokens, when]
+
+    def take(self, key, rate, burst, now):
+        ''' Take a token from key's bucket, return False if it's empty. '''
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [burst, now]
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.MaxBuckets:
+                self._buckets.popitem(last = False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def refund(self, key, count):
+        ''' Give back count tokens taken from key's bucket but not used. '''
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket[0] += count
+
+    def __len__(self):
+        ''' Return # of tracked buckets. '''
+        return len(self._buckets)
+
+
+class _RateLimiter(object):
+    '''
+    Per-section and per-host rate limits, applied in the io_process so
+    that flooding clients never reach the main process. Lines above
+    the limits are dropped. The # of dropped lines is logged, and for
+    sections with excess policy 'summary' also sent to the section's
+    channels, SummaryInterval after the first dropped line.
+    '''
+
+    SummaryInterval = 10.0   # Time dropped lines are counted (seconds).
+
+    def __init__(self, sections, sink, host_rate = 0.0, host_burst = 1,
+                 call_later = reactor.callLater):
+        self.sections = sections
+        self.sink = sink
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.call_later = call_later
+        self._section_buckets = _TokenBuckets()
+        self._host_buckets = _TokenBuckets()
+        self._dropped = {}       # section -> # of lines dropped.
+        self.log = log.getPluginLogger('irccat.ratelimit')
+
+    def accept(self, section, host, text):
+        ''' Return True if a line from host to section is within limits. '''
+        now = time.time()
+        if self.host_rate > 0 and not self._host_buckets.take(
+                host, self.host_rate, self.host_burst, now):
+            self.drop(section)
+            return False
+        rate, burst, excess = self.sections.limits(section)
+        if rate > 0 and not self._section_buckets.take(
+                section, rate, burst, now):
+            self.drop(section)
+            return False
+        return True
+
+    def drop(self, section):
+        ''' Count a dropped line, start the summary timer if needed. '''
+        if section not in self._dropped:
+            self._dropped[section] = 0
+            self.call_later(self.SummaryInterval, self.summarize, section)
+        self._dropped[section] += 1
+
+    def summarize(self, section):
+        ''' Report lines dropped since first drop. '''
+        count = self._dropped.pop(section, 0)
+        self.log.warning("Rate limit: dropped %d lines for section %s"
+                         % (count, section))
+        try:
+            channels = self.sections.get(section)[1]
+        except KeyError:
+            return
+        if self.sections.limits(section)[2] == 'summary':
+            self.sink.send(_message(
+                '[irccat] %d lines dropped (rate limit)' % count,
+                channels, self.sections.lane(section)))
+
+    def flush(self):
+        ''' Shutting down: report all dropped lines now. '''
+        for section in list(self._dropped):
+            self.summarize(section)
+
+
+class _Dedup(object):
+    '''
+    Drops exact repeats of a line sent to a section within the section's
+    dedup window, counted from the first copy. When the window closes a
+    single 'line (repeated N times)' summary is sent. Each section has a
+    bounded table of recent lines, oldest first, swept by a timer.
+    '''
+
+    MaxLines = 4096          # Max # of lines remembered per section.
+    SweepInterval = 1.0      # Time between checks for closed windows.
+
+    def __init__(self, sections, sink, call_later = reactor.callLater):
+        self.sections = sections
+        self.sink = sink
+        self.call_later = call_later
+        self._tables = {}      # section -> OrderedDict text -> [ends, count]
+        self._timer = None
+
+    def accept(self, section, host, text):
+        ''' Return False if text is a repeat which should be dropped. '''
+        window = self.sections.option(section, 'dedup')
+        if not window:
+            return True
+        table = self._tables.setdefault(section, collections.OrderedDict())
+        now = time.time()
+        entry = table.get(text)
+        if entry is not None and now < entry[0]:
+            entry[1] += 1
+            return False
+        if entry is not None:                   # Ended, not yet swept.
+            del table[text]
+            self.close(section, text, entry[1])
+        table[text] = [now + window, 0]
+        if len(table) > self.MaxLines:
+            text, entry = table.popitem(last = False)
+            self.close(section, text, entry[1])
+        if self._timer is None:
+            self._timer = self.call_later(self.SweepInterval, self.sweep)
+        return True
+
+    def close(self, section, text, count):
+        ''' Window for text has ended, send summary if repeated. '''
+        if not count:
+            return
+        try:
+            channels = self.sections.get(section)[1]
+        except KeyError:
+            return
+        self.sink.send(_message('%s (repeated %d times)' % (text, count),
+                                channels, self.sections.lane(section)))
+
+    def sweep(self, now = None):
+        ''' Close all ended windows. '''
+        self._timer = None
+        now = time.time() if now is None else now
+        for section, table in list(self._tables.items()):
+            while table:
+                text, entry = next(iter(table.items()))
+                if entry[0] > now:
+                    break
+                del table[text]
+                self.close(section, text, entry[1])
+            if not table:
+                del self._tables[section]
+        if self._tables:
+            self._timer = self.call_later(self.SweepInterval, self.sweep)
+
+    def flush(self):
+        ''' Shutting down: close all windows now. '''
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self.sweep(float('inf'))
+
+
+class _Digest(object):
+    '''
+    Rollup of busy sections. Lines are counted in windows of digestwindow
+    seconds, starting at the first line. The first 'digest' lines in a
+    window are relayed, the rest are held back and posted as one digest
+    message when the window ends: count, first and last line and, when
+    a directory is configured, a link to a file with all of them. Files
+    older than MaxFileAge are removed, and the oldest ones when there are
+    more than MaxFiles.
+    '''
+
+    MaxFileLines = 10000     # Max # of lines held for a digest file.
+    MaxFileAge = 7 * 86400   # Digest files are removed after (seconds).
+    MaxFiles = 1000          # Max # of digest files kept.
+    FilePattern = re.compile(r'[\w.-]+-\d{8}-\d{6}-\d+-\d+\.txt$')
+
+    def __init__(self, sections, sink, directory = '', url = '',
+                 call_later = reactor.callLater):
+        self.sections = sections
+        self.sink = sink
+        self.directory = directory
+        self.url = url
+        self.call_later = call_later
+        self._windows = {}     # section -> [count, held, lines, timer]
+        self._serial = 0
+        self.log = log.getPluginLogger('irccat.digest')
+
+    def accept(self, section, host, text):
+        ''' Return False if text is held back for the digest. '''
+        threshold = self.sections.option(section, 'digest')
+        if not threshold:
+            return True
+        window = self._windows.get(section)
+        if window is None:
+            timer = self.call_later(
+                self.sections.option(section, 'digestwindow'),
+                self.close, section)
+            window = [0, 0, [], timer]
+            self._windows[section] = window
+        window[0] += 1
+        if window[0] <= threshold:
+            return True
+        window[1] += 1
+        lines = window[2]
+        if len(lines) < self.MaxFileLines:
+            lines.append(text)
+        else:
+            lines[-1] = text
         return False
 
+    def save(self, section, lines):
+        ''' Write lines to a new digest file, return link or None. '''
+        self._serial += 1
+        name = '%s-%s-%d-%d.txt' % (re.sub(r'[^\w.-]', '_', section),
+                                    time.strftime('%Y%m%d-%H%M%S'),
+                                    os.getpid(),        # Unique per worker.
+                                    self._serial)
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+        except IOError as ex:
+            self.log.warning("Can't write digest file: " + str(ex))
+            return None
+        self.prune()
+        return self.url.rstrip('/') + '/' + name if self.url else path
+
+    def prune(self, now = None):
+        '''
+        Remove digest files older than MaxFileAge, then the oldest ones
+        above MaxFiles. Other files in the directory are left alone.
+        '''
+        now = time.time() if now is None else now
+        files = []
+        try:
+            for name in os.listdir(self.directory):
+                if self.FilePattern.match(name):
+                    path = os.path.join(self.directory, name)
+                    files.append((os.path.getmtime(path), path))
+        except OSError:                 # Removed by another worker.
+            pass
+        files.sort()
+        for ix, (mtime, path) in enumerate(files):
+            if mtime >= now - self.MaxFileAge and \
+                    len(files) - ix <= self.MaxFiles:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def close(self, section):
+        ''' Window for section has ended, post digest if lines were held. '''
+        window = self._windows.pop(section, None)
+        if window is None:
+            return
+        held, lines, timer = window[1:]
+        if timer.active():
+            timer.cancel()
+        if not held:
+            return
+        try:
+            channels = self.sections.get(section)[1]
+        except KeyError:
+            return
+        msg = '[digest] %d more lines, first: %s' % (held, lines[0])
+        if held > 1:
+            msg += ', last: ' + lines[-1]
+        link = self.save(section, lines) if self.directory else None
+        if link:
+            msg += ', all: ' + link
+        self.sink.send(_message(msg, channels, self.sections.lane(section)))
+
+    def flush(self):
+        ''' Shutting down: post digests for all open windows now. '''
+        for section in list(self._windows):
+            self.close(section)
+
+
+class _FlowControl(object):
+    '''
+    Backpressure. The main process reports the # of messages waiting in
+    the irc send queues, and how many of them are in the high lane.
+    Above high_water reading from clients is paused, below low_water
+    it's resumed, so an overload ends up as TCP flow control instead of
+    growing queues. Sessions in the high lane are only paused by the
+    high lane depth, so a flood in lower lanes doesn't block them. A new
+    client isn't paused until its first line or frame is handled and
+    set_high() called, so it can authenticate in the high lane.
+    high_water 0 disables.
+    '''
+
+    def __init__(self, high_water, low_water):
+        self.high_water = high_water
+        self.low_water = low_water
+        self.paused = False             # Clients paused,
+        self.high_paused = False        # high lane sessions too.
+        self._transports = set()
+        self._high = set()              # Transports of high lane sessions.
+        self._new = set()               # Lane not yet known, not paused.
+        self.log = log.getPluginLogger('irccat.flow')
+
+    def _paused(self, transport):
+        ''' Return True if transport should be paused. '''
+        if transport in self._new:
+            return False
+        return self.high_paused if transport in self._high else self.paused
+
+    def add(self, transport):
+        ''' A client has connected, not paused until set_high(). '''
+        self._transports.add(transport)
+        self._new.add(transport)
+
+    def remove(self, transport):
+        ''' A client has disconnected. '''
+        self._transports.discard(transport)
+        self._high.discard(transport)
+        self._new.discard(transport)
+
+    def set_high(self, transport, high):
+        ''' transport is, or is no longer, a session in the high lane. '''
+        if transport not in self._transports:
+            return
+        was_paused = self._paused(transport)
+        self._new.discard(transport)
+        if high:
+            self._high.add(transport)
+        else:
+            self._high.discard(transport)
+        if was_paused and not self._paused(transport):
+            transport.resumeProducing()
+        elif self._paused(transport) and not was_paused:
+            transport.pauseProducing()
+
+    def __len__(self):
+        ''' Return # of connected clients. '''
+        return len(self._transports)
+
+    def __iter__(self):
+        ''' Iterate over a copy of the connected clients' transports. '''
+        return iter(list(self._transports))
+
+    def _hysteresis(self, paused, depth):
+        ''' Return new paused state given depth. '''
+        if not paused and depth >= self.high_water:
+            return True
+        if paused and depth <= self.low_water:
+            return False
+        return paused
+
+    def depth(self, depth, high_depth = 0):
+        '''
+        Main process has reported depth queued messages, high_depth of
+        them in the high lane.
+        '''
+        if not self.high_water:
+            return
+        was_paused = dict([(t, self._paused(t)) for t in self._transports])
+        paused = self._hysteresis(self.paused, depth)
+        if paused != self.paused:
+            self.log.info("Send queues at %d, %s clients" %
+                          (depth, 'pausing' if paused else 'resuming'))
+            self.paused = paused
+        high_paused = self._hysteresis(self.high_paused, high_depth)
+        if high_paused != self.high_paused:
+            self.log.info("High lane at %d, %s its sessions" %
+                          (high_depth, 'pausing' if high_paused
+                                       else 'resuming'))
+            self.high_paused = high_paused
+        for transport, was in was_paused.items():
+            if was and not self._paused(transport):
+                transport.resumeProducing()
+            elif self._paused(transport) and not was:
+                transport.pauseProducing()
+
 
 class _Config(object):
-    ''' Persistent stored section data. '''
+    '''
+    Persistent stored section data. Each change is appended to a
+    journal, which now and then is compacted into the snapshot file
+    by a background thread. Loading replays journal over snapshot.
+    '''
+
+    CompactEvery = 500   # Journal entries which triggers a compaction.
 
     def __init__(self):
         self.port = config.global_option('port').value
         self.privmsg = config.global_option('privmsg').value
+        self.transport = config.global_option('transport').value
+        self.ringsize = config.global_option('ringsize').value
+        self.ringoverflow = config.global_option('ringoverflow').value
+        self.httpport = config.global_option('httpport').value
+        self.udpport = config.global_option('udpport').value
+        self.unixpath = config.global_option('unixpath').value
+        self.unixmode = int(config.global_option('unixmode').value, 8)
+        self.tlsport = config.global_option('tlsport').value
+        self.tlscert = config.global_option('tlscert').value
+        self.tlskey = config.global_option('tlskey').value
+        self.workers = config.global_option('workers').value
+        self.engine = config.global_option('engine').value
+        self.spooldir = config.global_option('spooldir').value
+        self.spoolsize = config.global_option('spoolsize').value
+        self.spoolage = config.global_option('spoolage').value
+        self.spoolrate = config.global_option('spoolrate').value
         self._path = config.global_option('sectionspath').value
+        self._journal_path = self._path + '.journal'
+        self._lock = threading.Lock()
+        self._journal = []              # Entries not yet in snapshot.
+        self._compactor = None
+        self.log = log.getPluginLogger('irccat.config')
+        if self.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            self.log.warning("No SO_REUSEPORT, using one worker")
+            self.workers = 1
+        if self.tlsport and not self.tlscert:
+            self.log.warning("No tlscert, TLS disabled")
+            self.tlsport = 0
+        if self.engine == 'asyncio' and self.workers > 1:
+            self.log.warning("asyncio engine runs one worker")
+            self.workers = 1
+        if self.engine == 'asyncio' and self.httpport:
+            self.log.warning("No webhook in the asyncio engine")
+            self.httpport = 0
+        tcp_ports = [(option, getattr(self, option))
+                     for option in ('port', 'tlsport', 'httpport')
+                     if getattr(self, option)]
+        for ix, (option, port) in enumerate(tcp_ports):
+            for other, other_port in tcp_ports[ix + 1:]:
+                if port == other_port:
+                    why = "%s and %s are both port %d" % (option, other, port)
+                    self.log.error(why)
+                    raise ValueError(why)
+        self.version = 0
+        self._data = {}
         try:
-            self._data = json.load(open(self._path, 'r'))
+            stored = json.load(open(self._path, 'r'))
         except IOError:
-            self._data = {}
-            logger = log.getPluginLogger('irccat.config')
-            logger.warning("Can't find stored config, creating empty.")
-            self._dump()
+            stored = None
+            self.log.warning("Can't find stored config, creating empty.")
         except Exception:   # Unpickle throws just anything.
             # TODO: This is left over from pickle usage
-            self._data = {}
-            logger = log.getPluginLogger('irccat.config')
-            logger.warning("Bad stored config, creating empty.")
-            self._dump()
+            stored = None
+            self.log.warning("Bad stored config, creating empty.")
+        if stored and stored.get('format') == 2:
+            self.version = stored['version']
+            self._data = stored['sections']
+        elif stored:
+            self._data = stored          # Pre-journal plain dict.
+        self._replay()
+        self._journal_file = open(self._journal_path, 'a')
+        if stored is None:
+            self.compact()
+
+    def _apply(self, entry):
+        ''' Apply a journal entry unless it's already in snapshot. '''
+        if entry['v'] <= self.version:
+            return
+        if entry['op'] == 'upsert':
+            self._data[entry['name']] = entry['section']
+        else:
+            self._data.pop(entry['name'], None)
+        self.version = entry['v']
+        self._journal.append(entry)
 
-    def _dump(self):
-        ''' Update persistent data.'''
-        from pprint import pprint
-        pprint(self._data)
-        json.dump(self._data, open(self._path, 'w'))
+    def _replay(self):
+        ''' Apply journal, cutting off any torn tail from a crash. '''
+        good = 0
+        try:
+            with open(self._journal_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        self._apply(json.loads(line.decode()))
+                    except (ValueError, KeyError, TypeError):
+                        break
+                    good += len(line)
+                size = f.seek(0, os.SEEK_END)
+        except IOError:
+            return
+        if good < size:
+            self.log.warning("Damaged journal, dropping %d bytes at end."
+                             % (size - good))
+            with open(self._journal_path, 'r+b') as f:
+                f.truncate(good)
+
+    def _append(self, entry):
+        ''' Add entry to journal (lock held), maybe start compaction. '''
+        self._journal_file.write(json.dumps(entry) + '\n')
+        self._journal_file.flush()
+        os.fsync(self._journal_file.fileno())
+        self._journal.append(entry)
+        if len(self._journal) >= self.CompactEvery:
+            if not self._compactor or not self._compactor.is_alive():
+                self._compactor = threading.Thread(target = self.compact)
+                self._compactor.start()
+
+    @staticmethod
+    def _write_atomic(path, text):
+        ''' Replace file at path with text using temp file + rename. '''
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+        dirfd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+
+    def compact(self):
+        ''' Write a new snapshot, drop journal entries now in it. '''
+        with self._lock:
+            version = self.version
+            data = dict(self._data)
+        self._write_atomic(self._path, json.dumps(
+            {'format': 2, 'version': version, 'sections': data}))
+        with self._lock:
+            self._journal = [e for e in self._journal if e['v'] > version]
+            self._journal_file.close()
+            self._write_atomic(self._journal_path,
+                               ''.join([json.dumps(e) + '\n'
+                                        for e in self._journal]))
+            self._journal_file = open(self._journal_path, 'a')
+
+    def close(self):
+        ''' Wait for running compaction, close journal. '''
+        if self._compactor:
+            self._compactor.join()
+        with self._lock:
+            self._journal_file.close()
 
     def get(self, section_name):
         ''' Return (password, channels) tuple or raise KeyError. '''
         s = self._data[section_name]
         return s['password'], s['channels']
 
-    def update(self, section_name, password, channels):
+    def option(self, section_name, key):
+        ''' Return optional section field, see _OPTIONS; or KeyError. '''
+        return self._data[section_name].get(key, _OPTIONS[key])
+
+    def _store(self, section_name, section):
+        ''' Store and journal section (lock held). '''
+        self._data[section_name] = section
+        self.version += 1
+        self._append({'v': self.version, 'op': 'upsert',
+                      'name': section_name, 'section': section})
+
+    def update(self, section_name, password, channels, **fields):
         ''' Store section data for name, creating it if required. '''
-        self._data[section_name] = {'password': password, 'channels': channels}
-        self._dump()
+        with self._lock:
+            section = dict(self._data.get(section_name, {}),
+                           password = password, channels = channels,
+                           **fields)
+            self._store(section_name, section)
+
+    def modify(self, section_name, **fields):
+        ''' Set optional fields in existing section or raise KeyError. '''
+        with self._lock:
+            section = dict(self._data[section_name], **fields)
+            self._store(section_name, section)
 
     def remove(self, section_name):
         ''' Remove existing section or raise KeyError. '''
-        del(self._data[section_name])
-        self._dump()
+        with self._lock:
+            del(self._data[section_name])
+            self.version += 1
+            self._append({'v': self.version, 'op': 'delete',
+                          'name': section_name})
+
+    def snapshot(self):
+        ''' Return a ('snapshot', version, sections) update message. '''
+        return ('snapshot', self.version, dict(self._data))
+
+    def delta(self, section_name):
+        ''' Return upsert/delete update message for last section change. '''
+        if section_name in self._data:
+            return ('upsert', self.version, section_name,
+                    self._data[section_name])
+        return ('delete', self.version, section_name)
 
     def keys(self):
         ''' Return list of section names. '''
         return list(self._data.keys())
 
 
-class IrccatProtocol(basic.LineOnlyReceiver):
-    ''' Line protocol: parse line, forward to channel(s). '''
+class _Sections(object):
+    '''
+    The io_process copy of the section data, kept in sync using the
+    update messages from _Config.snapshot() and _Config.delta().
+    '''
 
-    delimiter = b'\n'
+    def __init__(self):
+        self.version = None
+        self._data = {}
+
+    def get(self, section_name):
+        ''' Return (password, channels) tuple or raise KeyError. '''
+        s = self._data[section_name]
+        return s['password'], s['channels']
+
+    def option(self, section_name, key):
+        ''' Return optional section field, default if unknown section. '''
+        return self._data.get(section_name, {}).get(key, _OPTIONS[key])
+
+    def lane(self, section_name):
+        ''' Return priority lane (index in _LANES) for section. '''
+        return _LANES.index(self.option(section_name, 'priority'))
+
+    def limits(self, section_name):
+        ''' Return (rate, burst, excess) tuple, no limit if unknown. '''
+        s = self._data.get(section_name, {})
+        return (s.get('rate', _OPTIONS['rate']),
+                s.get('burst', _OPTIONS['burst']),
+                s.get('excess', _OPTIONS['excess']))
+
+    def apply(self, update):
+        ''' Apply an update message, return False on version gap. '''
+        kind, version = update[0], update[1]
+        if kind == 'snapshot':
+            self._data = dict(update[2])
+        elif self.version is None or version != self.version + 1:
+            return False
+        elif kind == 'upsert':
+            self._data[update[2]] = update[3]
+        elif kind == 'delete':
+            self._data.pop(update[2], None)
+        self.version = version
+        return True
+
+
+class _Ingest(object):
+    '''
+    What all listeners share: blacklisting, authentication and filters.
+    Accepted lines are sent to the main process through msg_conn.
+    '''
 
-    def __init__(self, config_, blacklist, msg_conn):
-        self.config = config_
+    def __init__(self, sections, blacklist, auth_cache, filters, msg_conn):
+        self.sections = sections
         self.blacklist = blacklist
+        self.auth_cache = auth_cache
+        self.filters = filters
         self.msg_conn = msg_conn
+        self.log = log.getPluginLogger('irccat.ingest')
+
+    def warning(self, what, host):
+        ''' Log and register bad input warning. '''
+        what += ' from: ' + (host or 'UNIX socket')
+        self.log.warning(what)
+        if world.testing:
+            self.msg_conn.send(_message(what, ['#test']))
+        self.blacklist.register(host, False)
+
+    def authenticate(self, section, cleartext_pw, host, trusted = False):
+        '''
+        Return channels for section if password is OK, else None. A
+        trusted client only needs an existing section.
+        '''
+        try:
+            cipher_pw, channels = self.sections.get(section)
+        except KeyError:
+            self.warning("No such section: " + section, host)
+            return None
+        if not trusted and \
+                not self.auth_cache.verify(section, cleartext_pw, cipher_pw):
+            self.warning('Bad password: ' + cleartext_pw, host)
+            return None
+        if not channels:
+            self.warning('Empty channel list: ' + section, host)
+        return channels
+
+    def accept(self, section, text, channels, host):
+        ''' Return message for text, or None if some filter drops it. '''
+        for f in self.filters:
+            if not f.accept(section, host, text):
+                return None
+        return _message(text, channels, self.sections.lane(section))
+
+    def forward(self, section, text, channels, host):
+        ''' Send text to channels unless some filter drops it. '''
+        msg = self.accept(section, text, channels, host)
+        if msg:
+            self.log.debug("Sending " + text + " to: " + str(channels))
+            self.msg_conn.send(msg)
+
+    def forward_many(self, section, lines, channels, host):
+        ''' Send the accepted lines as one frame, return # accepted. '''
+        msgs = [self.accept(section, text, channels, host) for text in lines]
+        msgs = [m for m in msgs if m]
+        if msgs:
+            self.log.debug("Sending %d lines to: %s" %
+                           (len(msgs), str(channels)))
+            self.msg_conn.send_frame(msgs)
+        return len(msgs)
+
+    def line(self, text, host, trusted = False):
+        ''' Handle a complete 'section;password;data' line. '''
+        try:
+            section, cleartext_pw, data = text.split(';', 2)
+        except ValueError:
+            self.warning('Illegal format: ' + text, host)
+            return
+        channels = self.authenticate(section, cleartext_pw, host, trusted)
+        if channels is None:
+            return
+        self.blacklist.register(host, True)
+        self.forward(section, data, channels, host)
+
+
+# Frame: length of the rest, then head: length of section and password,
+# # of records. Each record: length, then text.
+_FRAME_LEN = struct.Struct('!I')
+_FRAME_HEAD = struct.Struct('!BBH')
+
+
+def _encode_frame(section, password, records):
+    ''' Return a frame for the framed protocol, records is a str list. '''
+    section = section.encode()
+    password = password.encode()
+    body = [_FRAME_HEAD.pack(len(section), len(password), len(records)),
+            section,
+            password]
+    for record in records:
+        record = record.encode()
+        body.extend([_FRAME_LEN.pack(len(record)), record])
+    body = b''.join(body)
+    return _FRAME_LEN.pack(len(body)) + body
+
+
+class _FrameDecoder(object):
+    '''
+    Parser for the framed protocol used by bulk producers, which starts
+    a connection with Magic. Frames are parsed from memoryview slices of
+    the received data; only an incomplete frame at its end is copied,
+    to be completed by the next feed(). Records are utf-8 text which may
+    hold newlines, undecodable bytes are replaced.
+    '''
+
+    Magic = b'\0IRCCAT1'
+    MaxFrame = 1 << 20     # Max size of a frame (bytes).
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    @staticmethod
+    def parse(view):
+        ''' Return (section, password, records) for a frame body. '''
+        try:
+            section_len, password_len, count = _FRAME_HEAD.unpack_from(view)
+            pos = _FRAME_HEAD.size
+            section = str(view[pos:pos + section_len], 'utf-8')
+            pos += section_len
+            password = str(view[pos:pos + password_len], 'utf-8')
+            pos += password_len
+            records = []
+            for i in range(0, count):             # pylint: disable=W0612
+                length = _FRAME_LEN.unpack_from(view, pos)[0]
+                pos += _FRAME_LEN.size
+                if pos + length > len(view):
+                    raise ValueError('Record beyond end of frame')
+                records.append(str(view[pos:pos + length], 'utf-8',
+                                   'replace'))
+                pos += length
+        except struct.error as ex:
+            raise ValueError(str(ex))
+        if pos != len(view):
+            raise ValueError('Garbage after records')
+        return section, password, records
+
+    def feed(self, data):
+        '''
+        Return list of (section, password, records) for all frames
+        completed by data. Raises ValueError on a bad frame.
+        '''
+        if self._buffer:
+            self._buffer += data
+            data = self._buffer
+        frames = []
+        pos = 0
+        with memoryview(data) as view:
+            while len(view) - pos >= _FRAME_LEN.size:
+                length = _FRAME_LEN.unpack_from(view, pos)[0]
+                if length > self.MaxFrame:
+                    raise ValueError('Frame too large: %d' % length)
+                end = pos + _FRAME_LEN.size + length
+                if end > len(view):
+                    break
+                frames.append(self.parse(view[pos + _FRAME_LEN.size:end]))
+                pos = end
+            self._buffer = bytearray(view[pos:])
+        return frames
+
+
+class IrccatProtocol(basic.LineOnlyReceiver):
+    '''
+    Line protocol: parse line, forward to channel(s). Each line is
+    either a complete 'section;password;data' message or, in session
+    mode, an 'AUTH section;password' line followed by plain data lines
+    which all goes to that section. Passwords are not checked for a
+    trusted client, see unixtrust.
+
+    A client starting with _FrameDecoder.Magic uses the framed protocol
+    instead. Each frame holds a section, a password and records which
+    are forwarded together; an empty password refers to an earlier frame
+    for the same section on the connection.
+    '''
+
+    delimiter = b'\n'
+
+    def __init__(self, ingest, trusted = False):
+        self.ingest = ingest
+        self.sections = ingest.sections
+        self.trusted = trusted
         self.peer = None
+        self.host = None                # None for a UNIX socket peer.
+        self.section = None             # Session mode: bound section,
+        self.cipher_pw = None           # its password when bound,
+        self.channels = None            # its channels,
+        self.version = None             # and sections version.
+        self.decoder = None             # Framed protocol: the decoder,
+        self.bound = {}                 # section -> password if verified.
+        self._head = b''                # First bytes, None when decided.
         self.log = log.getPluginLogger('irccat.protocol')
 
     def connectionMade(self):
         self.peer = self.transport.getPeer()
-        if self.blacklist.onList(self.peer.host):
+        self.host = getattr(self.peer, 'host', None)
+        if self.ingest.blacklist.onList(self.host):
             self.transport.abortConnection()
+        elif self.factory:
+            self.factory.flow.add(self.transport)
 
     def connectionLost(self, reason):            # pylint: disable=W0222
-        self.peer = None
+        if self.factory:
+            self.factory.lost(self.transport)
+        self.channels = None
+
+    def warning(self, what):
+        ''' Log and register bad input warning. '''
+        self.ingest.warning(what, self.host)
+
+    def authReceived(self, text):
+        ''' Handle 'AUTH section;password', bind session or hang up. '''
+        try:
+            section, cleartext_pw = text[len('AUTH '):].split(';', 1)
+        except ValueError:
+            self.warning('Illegal format: ' + text)
+            self.transport.loseConnection()
+            return
+        channels = self.ingest.authenticate(section, cleartext_pw,
+                                            self.host, self.trusted)
+        if channels is None:
+            self.transport.loseConnection()
+            return
+        self.section = section
+        self.cipher_pw = self.sections.get(section)[0]
+        self.channels = channels
+        self.version = self.sections.version
+        self.ingest.blacklist.register(self.host, True)
+        self.prioritize()
+
+    def prioritize(self):
+        '''
+        Tell flow control if this is a session using only sections in
+        the high lane, which aren't paused by lower lanes.
+        '''
+        if not self.factory:
+            return
+        if self.decoder:
+            sections = list(self.bound)
+        elif self.channels is not None:
+            sections = [self.section]
+        else:
+            sections = []
+        high = bool(sections) and all([self.sections.lane(s) == _HIGH_LANE
+                                       for s in sections])
+        self.factory.flow.set_high(self.transport, high)
+
+    def rebind(self):
+        ''' Sections has changed, update session or end it. '''
+        self.version = self.sections.version
+        try:
+            cipher_pw, channels = self.sections.get(self.section)
+        except KeyError:
+            cipher_pw = None
+        if cipher_pw != self.cipher_pw:
+            self.log.info("Section changed, closing session: " + self.section)
+            self.channels = None
+            self.transport.loseConnection()
+            return
+        self.channels = channels
+        self.prioritize()
+
+    def dataReceived(self, data):
+        ''' Pick line or framed protocol using first bytes, parse data. '''
+        if self.decoder:
+            self.framesReceived(data)
+            return
+        if self._head is None:
+            basic.LineOnlyReceiver.dataReceived(self, data)
+            return
+        data = self._head + data
+        magic = _FrameDecoder.Magic
+        if len(data) < len(magic) and magic.startswith(data):
+            self._head = data           # Wait for the rest.
+            return
+        self._head = None
+        if data.startswith(magic):
+            self.decoder = _FrameDecoder()
+            self.framesReceived(data[len(magic):])
+        else:
+            basic.LineOnlyReceiver.dataReceived(self, data)
+
+    def framesReceived(self, data):
+        ''' Handle framed protocol data. '''
+        try:
+            frames = self.decoder.feed(data)
+        except ValueError as ex:
+            self.warning('Bad frame: ' + str(ex))
+            self.transport.loseConnection()
+            return
+        for section, password, records in frames:
+            if self.transport.disconnecting:
+                return
+            self.frameReceived(section, password, records)
+
+    def frameReceived(self, section, password, records):
+        ''' Forward all lines in records, hang up if not authorized. '''
+        if password or section not in self.bound:
+            channels = self.ingest.authenticate(section, password,
+                                                self.host, self.trusted)
+            if channels is None:
+                self.transport.loseConnection()
+                return
+            self.bound[section] = self.sections.get(section)[0]
+            self.ingest.blacklist.register(self.host, True)
+            self.prioritize()
+        else:
+            try:
+                cipher_pw, channels = self.sections.get(section)
+            except KeyError:
+                cipher_pw = None
+            if cipher_pw != self.bound[section]:
+                self.log.info("Section changed, closing: " + section)
+                self.transport.loseConnection()
+                return
+            if self.version != self.sections.version:
+                self.version = self.sections.version
+                self.prioritize()       # Priority may have changed.
+        lines = [line for text in records for line in text.splitlines()]
+        self.ingest.forward_many(section, lines, channels, self.host)
 
     def lineReceived(self, text):
         ''' Handle one line of input from client. '''
 
-        def warning(what):
-            ''' Log and register bad input warning. '''
-            if self.peer:
-                what += ' from: ' + str(self.peer.host)
-            self.log.warning(what)
-            if world.testing:
-                self.msg_conn.send((what, ['#test']))
-            self.blacklist.register(self.peer.host, False)
-
         try:
             if sys.version_info[0] >= 3:
                 text = text.decode()
         except UnicodeDecodeError:
-            warning('Invalid encoding: ' + repr(text))
+            self.warning('Invalid encoding: ' + repr(text))
+            self.prioritize()
             return
 
-        try:
-            section, cleartext_pw, data = text.split(';', 2)
-        except ValueError:
-            warning('Illegal format: ' + text)
+        if self.channels is not None:
+            if self.version != self.sections.version:
+                self.rebind()
+                if self.channels is None:
+                    return
+            self.ingest.forward(self.section, text, self.channels,
+                                self.host)
             return
+        if text.startswith('AUTH '):
+            self.authReceived(text)
+            return
+        self.ingest.line(text, self.host, self.trusted)
+        self.prioritize()
+
+
+class _TLSProtocol(policies.ProtocolWrapper):
+    '''
+    Server side TLS using the ssl module's memory BIOs: decrypts what
+    the client sends for the wrapped IrccatProtocol and encrypts what
+    it writes. Twisted's own TLS support requires pyOpenSSL.
+    '''
+
+    def __init__(self, factory, wrapped):
+        policies.ProtocolWrapper.__init__(self, factory, wrapped)
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.tls = factory.context.wrap_bio(self.incoming, self.outgoing,
+                                            server_side = True)
+        self.handshaken = False
+
+    def flush(self):
+        ''' Send what TLS has to say to the client. '''
+        data = self.outgoing.read()
+        if data:
+            self.transport.write(data)
+
+    def write(self, data):
+        self.tls.write(data)
+        self.flush()
+
+    def writeSequence(self, data):
+        self.write(b''.join(data))
+
+    def dataReceived(self, data):
+        ''' Decrypt data, pass the plaintext to the wrapped protocol. '''
+        if self.disconnecting:
+            return
+        self.incoming.write(data)
+        chunks = []
         try:
-            cipher_pw, channels = self.config.get(section)
-        except KeyError:
-            warning("No such section: " + section)
+            if not self.handshaken:
+                self.tls.do_handshake()
+                self.handshaken = True
+            while True:
+                chunk = self.tls.read(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except ssl.SSLWantReadError:
+            pass
+        except ssl.SSLZeroReturnError:
+            self.loseConnection()
+        except ssl.SSLError as ex:
+            self.wrappedProtocol.warning('TLS: ' + str(ex))
+            self.loseConnection()
+        self.flush()
+        if chunks:
+            self.wrappedProtocol.dataReceived(b''.join(chunks))
+
+
+class _TLSFactory(policies.WrappingFactory):
+    ''' Serves the wrapped IrccatFactory's protocols using TLS. '''
+
+    protocol = _TLSProtocol
+
+    def __init__(self, wrapped, context):
+        policies.WrappingFactory.__init__(self, wrapped)
+        self.context = context
+
+
+class _DatagramListener(protocol.DatagramProtocol):
+    '''
+    UDP ingest: each datagram holds one or more 'section;password;data'
+    lines, handled like lines on a TCP connection. Nothing is replied.
+    Source addresses are easily forged, so UDP has a blacklist of its
+    own which isn't shared with the other workers and doesn't block
+    subnets; a forger can't get TCP clients or whole subnets blocked.
+    '''
+
+    maxPacketSize = 65535
+
+    def __init__(self, ingest):
+        blacklist = _Blacklist()
+        blacklist.SubnetFailMax = 0
+        self.ingest = _Ingest(ingest.sections,
+                              blacklist,
+                              ingest.auth_cache,
+                              ingest.filters,
+                              ingest.msg_conn)
+
+    def datagramReceived(self, data, addr):       # pylint: disable=C0103
+        ''' Handle all lines in a datagram from addr. '''
+        host = addr[0]
+        if self.ingest.blacklist.onList(host):
             return
-        if crypt.crypt(cleartext_pw, cipher_pw) != cipher_pw:
-            warning('Bad password: ' + cleartext_pw)
+        try:
+            text = data.decode()
+        except UnicodeDecodeError:
+            self.ingest.warning('Invalid encoding: ' + repr(data), host)
             return
-        if not channels:
-            warning('Empty channel list: ' + section)
-        self.log.debug("Sending " + data + " to: " + str(channels))
-        self.msg_conn.send((data, channels))
-        self.blacklist.register(self.peer.host, True)
+        for line in text.splitlines():
+            self.ingest.line(line, host)
+
+
+class _WebhookResource(resource.Resource):
+    '''
+    HTTP ingest: POST a JSON object with 'section', 'token' (the section
+    password) and 'lines', a list of strings. All accepted lines are
+    sent to the main process as one frame. Replies with a JSON object
+    with the # of accepted lines. Connections are kept alive as usual
+    in HTTP/1.1.
+    '''
+
+    isLeaf = True
+    MaxBody = 1 << 20      # Max request size (bytes).
+
+    def __init__(self, ingest):
+        resource.Resource.__init__(self)
+        self.ingest = ingest
+
+    def reply(self, request, code, body):
+        ''' Set response code and return body as JSON. '''
+        request.setResponseCode(code)
+        request.setHeader(b'content-type', b'application/json')
+        return json.dumps(body).encode()
+
+    def render_POST(self, request):               # pylint: disable=C0103
+        ''' Handle a webhook request. '''
+        host = request.getClientAddress().host
+        if self.ingest.blacklist.onList(host):
+            return self.reply(request, 403, {'error': 'blocked'})
+        body = request.content.read(self.MaxBody + 1)
+        try:
+            if len(body) > self.MaxBody:
+                raise ValueError('Request too large')
+            data = json.loads(body.decode())
+            section, token, lines = \
+                data['section'], data['token'], data['lines']
+            if not isinstance(lines, list) or not all(
+                    [isinstance(x, str) for x in [section, token] + lines]):
+                raise TypeError('Bad types')
+        except (ValueError, KeyError, TypeError) as ex:
+            self.ingest.warning('Illegal webhook request: ' + str(ex), host)
+            return self.reply(request, 400, {'error': 'bad request'})
+        channels = self.ingest.authenticate(section, token, host)
+        if channels is None:
+            return self.reply(request, 403, {'error': 'not authorized'})
+        self.ingest.blacklist.register(host, True)
+        lines = [line for text in lines for line in text.splitlines()]
+        accepted = self.ingest.forward_many(section, lines, channels, host)
+        return self.reply(request, 200, {'accepted': accepted})
+
+
+class _Batcher(object):
+    '''
+    Collects messages for the main process and sends them as frames
+    i. e., lists of (data, channels, lane, time) tuples. A frame is sent
+    when it's full, when the oldest message in it has waited Deadline
+    seconds or at once for a high priority message. Quacks like the
+    pipe end, so protocols just call send().
+    '''
+
+    MaxFrame = 64      # Max # of messages in a frame.
+    Deadline = 0.01    # Max time a message waits for a frame (seconds).
+
+    def __init__(self, conn, call_later = reactor.callLater):
+        self.conn = conn
+        self.call_later = call_later
+        self.sent = 0      # Messages passed to conn, so far.
+        self._pending = []
+        self._timer = None
+
+    def send(self, msg):
+        ''' Queue a _message() for the main process. '''
+        self.sent += 1
+        self._pending.append(msg)
+        if len(self._pending) >= self.MaxFrame or msg[2] < _NORMAL_LANE:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.call_later(self.Deadline, self.flush)
+
+    def send_frame(self, msgs):
+        ''' Send msgs as one frame, after any pending messages. '''
+        self.flush()
+        self.sent += len(msgs)
+        self.conn.send(('frame', msgs))
+
+    def flush(self):
+        ''' Send all pending messages as one frame. '''
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            frame, self._pending = self._pending, []
+            self.conn.send(('frame', frame))
+
+
+# Record header: length of channels, lane, time.
+_RECORD_HEAD = struct.Struct('<HBd')
+
+
+def _encode_record(data, channels, lane, when):
+    ''' Return shm ring record for a _message(). '''
+    channels = ','.join(channels).encode()
+    return _RECORD_HEAD.pack(len(channels), lane, when) + channels + \
+        data.encode()
+
+
+def _decode_record(view):
+    ''' Return _message() tuple from a ring record memoryview. '''
+    length, lane, when = _RECORD_HEAD.unpack_from(view)
+    start = _RECORD_HEAD.size
+    channels = str(view[start:start + length], 'utf-8')
+    data = str(view[start + length:], 'utf-8')
+    return data, channels.split(',') if channels else [], lane, when
+
+
+class _RingWriter(object):
+    ''' Quacks like the pipe end, writes frames to a ShmRing. '''
+
+    def __init__(self, ring_):
+        self.ring = ring_
+
+    def send(self, msg):
+        ''' Store all messages in a ('frame', frame), wake up consumer. '''
+        self.ring.put_many([_encode_record(*m) for m in msg[1]])
+        self.ring.notify()
+
+
+class _PipeSource(object):
+    '''
+    Message frames from io_process, pipe transport. The pipe carries
+    (kind, payload) tuples, kind 'frame' is data and anything else is
+    passed to the control(kind, payload) callback. closed is set when
+    the io_process has exited and all it sent is read.
+    '''
+
+    def __init__(self, conn, control):
+        self.conn = conn
+        self.control = control
+        self.closed = False
+
+    def wait(self, timeout):
+        ''' Return True if a frame is available within timeout. '''
+        return self.conn.poll(timeout)
+
+    def handles(self):
+        ''' Return what to wait for, see multiprocessing.connection.wait. '''
+        return [self.conn]
+
+    def read(self):
+        ''' Return next frame i. e., list of _message() tuples. '''
+        try:
+            kind, payload = self.conn.recv()
+        except EOFError:
+            self.closed = True
+            return []
+        if kind == 'frame':
+            return payload
+        self.control(kind, payload)
+        return []
+
+
+class _RingSource(object):
+    '''
+    Message frames from io_process, shm transport. The pipe only
+    carries control messages, handled as in _PipeSource.
+    '''
+
+    def __init__(self, ring_, conn, control):
+        self.ring = ring_
+        self.conn = conn
+        self.control = control
+        self.closed = False
+
+    def wait(self, timeout):
+        ''' Return True if records are available within timeout. '''
+        try:
+            while self.conn.poll():
+                self.control(*self.conn.recv())
+        except EOFError:
+            self.closed = True          # read() takes what's left.
+            return True
+        return self.ring.wait(timeout)
+
+    def handles(self):
+        ''' Return what to wait for, see multiprocessing.connection.wait. '''
+        return [self.conn, self.ring.fileno()]
+
+    def read(self):
+        ''' Return all available messages as list of _message() tuples. '''
+        return self.ring.consume(_decode_record)
+
+
+class _QueueConn(object):
+    '''
+    The asyncio engine's end of the connection to the listener thread:
+    (kind, payload) tuples on a thread-safe queue, not pickled, and a
+    socketpair ringing when there is something to read. None marks EOF.
+    '''
+
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.bell, self._bell_w = socket.socketpair()
+        self.bell.setblocking(False)
+        self._bell_w.setblocking(False)
+
+    def send(self, msg):
+        ''' Queue msg, wake up the listener thread. '''
+        self.queue.put(msg)
+        try:
+            self._bell_w.send(b'\0')
+        except BlockingIOError:
+            pass                        # Already ringing.
+
+    def close(self):
+        ''' Engine has exited. '''
+        self.send(None)
+
+
+class _QueueSource(object):
+    ''' Message frames from the asyncio engine, like _PipeSource. '''
+
+    def __init__(self, conn, control):
+        self.conn = conn
+        self.control = control
+        self.closed = False
+
+    def wait(self, timeout):
+        ''' Return True if a frame is available within timeout. '''
+        if timeout and self.conn.queue.empty():
+            multiprocessing.connection.wait([self.conn.bell], timeout)
+        return not self.conn.queue.empty()
+
+    def handles(self):
+        ''' Return what to wait for, see multiprocessing.connection.wait. '''
+        return [self.conn.bell]
+
+    def read(self):
+        ''' Return next frame i. e., list of _message() tuples. '''
+        try:
+            self.conn.bell.recv(4096)
+        except BlockingIOError:
+            pass
+        try:
+            msg = self.conn.queue.get_nowait()
+        except queue.Empty:
+            return []
+        if msg is None:
+            self.closed = True
+            return []
+        kind, payload = msg
+        if kind == 'frame':
+            return payload
+        self.control(kind, payload)
+        return []
+
+
+class _ConfigReader(object):
+    ''' Reactor reader picking up config updates from main process. '''
+
+    def __init__(self, factory, conn):
+        self.factory = factory
+        self.conn = conn
+
+    def fileno(self):
+        ''' Required by reactor.addReader(). '''
+        return self.conn.fileno()
+
+    def logPrefix(self):
+        ''' Required by reactor.addReader(). '''
+        return 'irccat-config'
+
+    def doRead(self):
+        ''' Main process has sent something, update factory. '''
+        try:
+            while self.conn.poll():
+                self.factory.receive(self.conn.recv())
+        except EOFError:
+            reactor.removeReader(self)
+
+    def connectionLost(self, reason):
+        ''' Main process is gone, nothing more to read. '''
+        reactor.removeReader(self)
 
 
 class IrccatFactory(protocol.Factory):
     ''' Twisted factory producing a Protocol using buildProtocol. '''
 
-    def __init__(self, pipe):
-        self.pipe = pipe
+    def __init__(self, conn, ring_ = None, hasher = crypt.crypt,
+                 call_later = reactor.callLater):
+        self.conn = conn                # Our end of the main process pipe.
+        self.call_later = call_later
         self.blacklist = _Blacklist()
-        assert self.pipe[0].poll(), "No initial config!"
-        self.config = self.pipe[0].recv()
+        self.blacklist.notify = \
+            lambda table, key: self.conn.send(('block', (table, key)))
+        self.auth_cache = _AuthCache(hasher)
+        if ring_:
+            self.batcher = _Batcher(_RingWriter(ring_), call_later)
+        else:
+            self.batcher = _Batcher(self.conn, call_later)
+        self.sections = _Sections()
+        # Filters applied to each line, in order.
+        self.filters = [
+            _Dedup(self.sections, self.batcher, call_later),
+            _Digest(self.sections,
+                    self.batcher,
+                    config.global_option('digestdir').value,
+                    config.global_option('digesturl').value,
+                    call_later),
+            _RateLimiter(self.sections,
+                         self.batcher,
+                         config.global_option('hostrate').value,
+                         config.global_option('hostburst').value,
+                         call_later)]
+        self.ingest = _Ingest(self.sections,
+                              self.blacklist,
+                              self.auth_cache,
+                              self.filters,
+                              self.batcher)
+        self.flow = _FlowControl(config.global_option('highwater').value,
+                                 config.global_option('lowwater').value)
+        self.unix_trust = config.global_option('unixtrust').value
+        self.ports = []                 # Set up by io_process().
+        self.draining = False
+        self.resync = False
+        self.log = log.getPluginLogger('irccat.factory')
+
+    def receive(self, msg):
+        ''' Handle a config update or control message from main process. '''
+        if msg[0] == 'depth':
+            self.flow.depth(*msg[1])
+        elif msg[0] == 'block':
+            self.blacklist.block(*msg[1])
+        elif msg[0] == 'drain':
+            self.drain(msg[1])
+        else:
+            self.update(msg)
+
+    def update(self, update):
+        '''
+        Apply a config update from main process, dropping affected
+        cached credentials. On a version gap ask for a new snapshot
+        and ignore deltas until it arrives.
+        '''
+        if update[0] == 'snapshot':
+            self.auth_cache.clear()
+            self.resync = False
+        elif self.resync:
+            return
+        else:
+            self.auth_cache.forget(update[2])
+        if not self.sections.apply(update):
+            self.log.warning("Config version gap, requesting snapshot")
+            self.resync = True
+            self.conn.send(('resync', self.sections.version))
+
+    def drain(self, timeout):
+        '''
+        The plugin is reloaded or unloaded: stop accepting clients,
+        leaving the listening sockets to the next io_process. Exit when
+        all open connections are closed, or after timeout.
+        '''
+        self.log.info("Draining %d connections" % len(self.flow))
+        self.draining = True
+        self.stop_listening()
+        if not len(self.flow):
+            self.drained()
+        else:
+            self.call_later(timeout, self.drained)
+
+    def stop_listening(self):
+        ''' Stop accepting clients, leaving the sockets open. '''
+        for port in self.ports:
+            # Not stopListening(), which would unlink a UNIX socket.
+            port.stopReading()
+
+    def stop(self):
+        ''' All done, exit. '''
+        reactor.stop()
+
+    def drained(self):
+        '''
+        Cut clients still connected, send what's left including held
+        back dedup and digest lines to main process, confirm and exit.
+        '''
+        if not self.draining:
+            return
+        self.draining = False
+        aborted = len(self.flow)
+        for transport in self.flow:
+            transport.abortConnection()
+        for f in self.filters:
+            f.flush()
+        self.batcher.flush()
+        self.conn.send(('drained', {'sent': self.batcher.sent,
+                                    'aborted': aborted}))
+        self.stop()
+
+    def lost(self, transport):
+        ''' A client has disconnected, exit when last one if draining. '''
+        self.flow.remove(transport)
+        if self.draining and not len(self.flow):
+            self.drained()
 
     def buildProtocol(self, addr):
-        if self.pipe[0].poll():
-            self.config = self.pipe[0].recv()
-        return IrccatProtocol(self.config, self.blacklist, self.pipe[0])
+        trusted = isinstance(addr, address.UNIXAddress) and self.unix_trust
+        proto = IrccatProtocol(self.ingest, trusted)
+        proto.factory = self
+        return proto
+
+
+class _LoopTimer(object):
+    ''' loop.call_later() quacking like a twisted DelayedCall. '''
+
+    def __init__(self, loop, delay, func, *args):
+        self.called = False
+        self._handle = loop.call_later(delay, self._call, func, args)
+
+    def _call(self, func, args):
+        ''' The timer has expired. '''
+        self.called = True
+        func(*args)
+
+    def active(self):
+        ''' Return True unless called or cancelled. '''
+        return not self.called and not self._handle.cancelled()
+
+    def cancel(self):
+        ''' Don't call it. '''
+        self._handle.cancel()
+
+
+class _StreamTransport(object):
+    '''
+    Quacks like the twisted transport which IrccatProtocol and
+    _FlowControl uses, wrapping an asyncio transport.
+    '''
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.disconnecting = False
+
+    def getPeer(self):
+        ''' Return twisted address of peer. '''
+        peer = self.transport.get_extra_info('peername')
+        if not isinstance(peer, tuple):
+            return address.UNIXAddress(peer)
+        if ':' in peer[0]:
+            return address.IPv6Address('TCP', peer[0], peer[1])
+        return address.IPv4Address('TCP', peer[0], peer[1])
+
+    def loseConnection(self):
+        ''' Close after sending what's buffered. '''
+        self.disconnecting = True
+        self.transport.close()
+
+    def abortConnection(self):
+        ''' Close at once. '''
+        self.disconnecting = True
+        self.transport.abort()
+
+    def pauseProducing(self):
+        ''' Stop reading from client. '''
+        self.transport.pause_reading()
+
+    def resumeProducing(self):
+        ''' Read from client again. '''
+        self.transport.resume_reading()
+
+
+class _AsyncioProtocol(asyncio.Protocol):
+    ''' Runs an IrccatProtocol on an asyncio connection. '''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.proto = None
+
+    def connection_made(self, transport):
+        transport = _StreamTransport(transport)
+        self.proto = self.factory.buildProtocol(transport.getPeer())
+        self.proto.makeConnection(transport)
+
+    def data_received(self, data):
+        self.proto.dataReceived(data)
+
+    def connection_lost(self, exc):
+        self.proto.connectionLost(exc)
+
+
+class _AsyncioDatagram(asyncio.DatagramProtocol):
+    ''' Runs a _DatagramListener on an asyncio datagram endpoint. '''
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    def datagram_received(self, data, addr):
+        self.listener.datagramReceived(data, addr)
+
+
+class _AsyncioFactory(IrccatFactory):
+    '''
+    IrccatFactory for the asyncio engine, running on loop in a thread
+    of the main process instead of in a twisted io_process. It serves
+    copies of the listening sockets, closed when draining.
+    '''
+
+    def __init__(self, conn, loop):
+        self.loop = loop
+        IrccatFactory.__init__(self, conn,
+                               call_later = functools.partial(_LoopTimer,
+                                                              loop))
+
+    async def listen(self, sockets, tls_context = None):
+        '''
+        Start serving sockets from _Listeners.claim(), tlsport using
+        tls_context.
+        '''
+        for option in ('port', 'tlsport', 'unixpath'):
+            if option in sockets:
+                self.ports.append(await self.loop.create_server(
+                    lambda: _AsyncioProtocol(self),
+                    sock = sockets[option].dup(),
+                    ssl = tls_context if option == 'tlsport' else None))
+        if 'udpport' in sockets:
+            transport = (await self.loop.create_datagram_endpoint(
+                lambda: _AsyncioDatagram(_DatagramListener(self.ingest)),
+                sock = sockets['udpport'].dup()))[0]
+            self.ports.append(transport)
+
+    def stop_listening(self):
+        ''' Close our copies of the sockets. '''
+        for port in self.ports:
+            port.close()
+
+    def stop(self):
+        ''' All done, exit the thread. '''
+        self.loop.stop()
+
+
+def _split_target(target):
+    ''' Split '[network/]channel' into (network or None, channel). '''
+    if target[0] not in '#&+!' and '/' in target:
+        network, channel = target.split('/', 1)
+        return network, channel
+    return None, target
+
+
+def _get_target(irc, msg, args, state):
+    ''' Converter for a section target, a [network/]channel. '''
+    network, channel = _split_target(args[0])
+    if network == '' or not irc.isChannel(channel):
+        state.errorInvalid('channel', args[0])
+    state.args.append(args.pop(0))
+
+
+addConverter('irccatTarget', _get_target)
+
+
+class _Routes(object):
+    '''
+    Index of joined channels: normalized channel name -> tuple of Irc
+    objects which have joined it. Updated from the main thread on joins
+    and parts and from listener_thread when it finds a zombie irc, so
+    updates are serialized by a lock. Lookups don't lock; entries are
+    replaced, never mutated in place.
+    '''
+
+    def __init__(self):
+        self._index = {}
+        self._lock = threading.Lock()
+
+    def _remove(self, irc, key):
+        ''' Remove irc from entry key, lock held. '''
+        ircs = tuple([i for i in self._index.get(key, ()) if i is not irc])
+        if ircs:
+            self._index[key] = ircs
+        else:
+            self._index.pop(key, None)
+
+    def add(self, irc, channel):
+        ''' irc has joined channel. '''
+        key = ircutils.toLower(channel)
+        with self._lock:
+            ircs = self._index.get(key, ())
+            if irc not in ircs:
+                self._index[key] = ircs + (irc,)
+
+    def remove(self, irc, channel):
+        ''' irc has left channel. '''
+        with self._lock:
+            self._remove(irc, ircutils.toLower(channel))
+
+    def drop(self, irc):
+        ''' irc has left all channels. '''
+        with self._lock:
+            for key in list(self._index.keys()):
+                self._remove(irc, key)
+
+    def rebuild(self, ircs):
+        ''' Create index from scratch using state in ircs. '''
+        index = {}
+        for irc in ircs:
+            for channel in irc.state.channels:
+                key = ircutils.toLower(channel)
+                index[key] = index.get(key, ()) + (irc,)
+        with self._lock:
+            self._index = index
+
+    def lookup(self, target):
+        ''' Return (channel, ircs) for a [network/]channel target. '''
+        network, channel = _split_target(target)
+        ircs = self._index.get(ircutils.toLower(channel), ())
+        if network:
+            network = network.lower()
+            ircs = [i for i in ircs if i.network.lower() == network]
+        return channel, ircs
+
+
+class _WaitStats(object):
+    '''
+    Queue wait times for a lane, from the io_process got a line until it
+    was handed to irc. Updated by listener_thread, read by commands.
+    '''
+
+    Samples = 1000       # # of recent waits kept for percentiles.
+
+    def __init__(self):
+        self.count = 0
+        self.max = 0.0
+        self._recent = collections.deque(maxlen = self.Samples)
+        self._lock = threading.Lock()
+
+    def add(self, wait):
+        ''' Register a line which waited wait seconds. '''
+        with self._lock:
+            self.count += 1
+            self.max = max(self.max, wait)
+            self._recent.append(wait)
+
+    def summary(self):
+        ''' Return a one-line description of the waits. '''
+        with self._lock:
+            recent = sorted(self._recent)
+            count, max_ = self.count, self.max
+        if not recent:
+            return 'no lines'
+        p50 = recent[len(recent) // 2]
+        p99 = recent[min(len(recent) - 1, len(recent) * 99 // 100)]
+        return '%d lines, p50 %.2fs, p99 %.2fs, max %.2fs' % (
+            count, p50, p99, max_)
+
+
+class _Scheduler(object):
+    '''
+    Outbound scheduler between listener_thread and the irc send queues.
+    Messages wait in per-channel queues in each priority lane, and each
+    irc send queue is only topped up to QueueTarget messages. The first
+    non-empty lane is served, picking channels by deficit round robin so
+    a noisy channel can't starve the others. Lines waiting for the same
+    channel are joined into one message up to the irc line length. Only
+    used by listener_thread.
+    '''
+
+    QueueTarget = 2      # Max # of our messages in an irc send queue.
+    Quantum = 512        # Bytes a channel may send in each round.
+    LineBytes = 512      # Max irc line length, including CRLF.
+    PrefixBytes = 100    # Reserved for the ':nick!user@host ' prefix.
+    Separator = ' | '    # Between joined lines.
+
+    def __init__(self, privmsg = False):
+        self.privmsg = privmsg
+        self.pending = 0       # # of lines waiting,
+        self.high_pending = 0  # of which in the high lane.
+        self.stats = [_WaitStats() for lane in _LANES]
+        self._ircs = {}        # irc -> lanes, (active channels, entries)
+
+    def put(self, irc, channel, text, lane = _NORMAL_LANE, when = None):
+        ''' Queue text for channel on irc, got by io_process at when. '''
+        if irc not in self._ircs:
+            self._ircs[irc] = [(collections.deque(), {}) for l in _LANES]
+        active, entries = self._ircs[irc][lane]
+        entry = entries.get(channel)
+        if entry is None:
+            # [deficit, in turn?, deque of (text, bytes, when)]
+            entry = [0, False, collections.deque()]
+            entries[channel] = entry
+            active.append(channel)
+        when = time.time() if when is None else when
+        entry[2].append((text, len(text.encode()), when))
+        self.pending += 1
+        if lane == _HIGH_LANE:
+            self.high_pending += 1
+
+    def _group(self, channel, lines):
+        ''' Return (# of lines, bytes) for next message from lines. '''
+        room = self.LineBytes - self.PrefixBytes - \
+            len(('PRIVMSG %s :\r\n' % channel).encode())
+        count, size = 1, lines[0][1]
+        sep = len(self.Separator)
+        while count < len(lines) and size + sep + lines[count][1] <= room:
+            size += sep + lines[count][1]
+            count += 1
+        return count, size
+
+    def _next(self, active, entries):
+        ''' Return (channel, lines) for next message using DRR. '''
+        while True:
+            channel = active[0]
+            entry = entries[channel]
+            if not entry[1]:
+                entry[0] += self.Quantum
+                entry[1] = True
+            count, size = self._group(channel, entry[2])
+            if size <= entry[0]:
+                break
+            entry[1] = False
+            active.rotate(-1)
+        entry[0] -= size
+        lines = [entry[2].popleft() for i in range(0, count)]
+        self.pending -= count
+        if not entry[2]:
+            del entries[channel]
+            active.popleft()
+        return channel, lines
+
+    def pump(self, room = None):
+        '''
+        Move messages to irc send queues which have room, i. e. less
+        than room (default QueueTarget) messages.
+        '''
+        room = self.QueueTarget if room is None else room
+        for irc, lanes in list(self._ircs.items()):
+            if irc.zombie:
+                for lane, (active, entries) in enumerate(lanes):
+                    count = sum([len(e[2]) for e in entries.values()])
+                    self.pending -= count
+                    if lane == _HIGH_LANE:
+                        self.high_pending -= count
+                del self._ircs[irc]
+                continue
+            for lane, (active, entries) in enumerate(lanes):
+                while active and len(irc.queue) < room:
+                    channel, lines = self._next(active, entries)
+                    if lane == _HIGH_LANE:
+                        self.high_pending -= len(lines)
+                    now = time.time()
+                    for line in lines:
+                        self.stats[lane].add(now - line[2])
+                    text = self.Separator.join([line[0] for line in lines])
+                    if self.privmsg:
+                        irc.queueMsg(ircmsgs.privmsg(channel, text))
+                    else:
+                        irc.queueMsg(ircmsgs.notice(channel, text))
+            if not any([active for active, entries in lanes]):
+                del self._ircs[irc]
+
+    def flush(self):
+        ''' Move all waiting messages to the irc send queues. '''
+        self.pump(float('inf'))
+
+
+class _Worker(object):
+    '''
+    One io_process with its pipe and message source, listening on the
+    sockets from _Listeners.claim(), tlsport using tls_context.
+    '''
+
+    def __init__(self, config_, sockets, control, tls_context = None):
+        self.received = 0               # Messages read from io_process.
+        self.drained = None             # Its 'drained' confirmation.
+        self.pipe = multiprocessing.Pipe()
+        self.pipe[1].send(config_.snapshot())
+        control = functools.partial(control, self)
+        if config_.transport == 'shm':
+            self.ring = ring.ShmRing(config_.ringsize, config_.ringoverflow)
+            self.source = _RingSource(self.ring, self.pipe[1], control)
+        else:
+            self.ring = None
+            self.source = _PipeSource(self.pipe[1], control)
+        self.process = multiprocessing.Process(
+                            target = io_process,
+                            args = (self.pipe, sockets, self.ring,
+                                    config_.unixmode, tls_context))
+
+    def start(self):
+        ''' Start io_process, drop our copy of its pipe end. '''
+        self.process.start()
+        self.pipe[0].close()            # EOF on pipe[1] when it exits.
+
+    def terminate(self):
+        ''' Stop io_process at once. '''
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def join(self, timeout):
+        ''' Wait for io_process to exit. '''
+        self.process.join(timeout)
+
+    def send(self, msg):
+        ''' Send config update or control message to io_process. '''
+        try:
+            self.pipe[1].send(msg)
+        except OSError:
+            pass                        # Exited after draining.
+
+    def stop(self, logger):
+        '''
+        Terminate io_process if still running, release the ring. Return
+        (sent, received, aborted) where sent and aborted are None unless
+        the io_process has confirmed that it's drained.
+        '''
+        self.terminate()
+        self.join(5)
+        if self.drained:
+            result = (self.drained['sent'], self.received,
+                      self.drained['aborted'])
+            logger.info("io_process drained: %d lines sent, %d received,"
+                        " %d clients cut" % result)
+        else:
+            result = (None, self.received, None)
+            logger.warning("io_process did not drain, %d lines received"
+                           % self.received)
+        if self.ring:
+            logger.info("shm ring counters: " + str(self.ring.counters()))
+            self.ring.close()
+            self.ring.unlink()
+        return result
+
+
+class _AsyncioWorker(_Worker):
+    '''
+    The asyncio engine: like _Worker, but serving the sockets using an
+    asyncio loop in a thread of the bot process. Messages are handed to
+    the listener thread on a queue, and config updates are called on
+    the loop, so nothing is pickled.
+    '''
+
+    def __init__(self, config_, sockets, control, tls_context = None):
+        # pylint: disable=W0231
+        self.received = 0
+        self.drained = None
+        self.ring = None
+        self.sockets = sockets
+        self.tls_context = tls_context
+        self.conn = _QueueConn()
+        self.source = _QueueSource(self.conn,
+                                   functools.partial(control, self))
+        self.loop = asyncio.new_event_loop()
+        self.factory = _AsyncioFactory(self.conn, self.loop)
+        self.factory.update(config_.snapshot())
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.log = log.getPluginLogger('irccat.asyncio')
+
+    def run(self):
+        ''' Thread: serve clients until drained or terminated. '''
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(
+                self.factory.listen(self.sockets, self.tls_context))
+            self.loop.run_forever()
+        except Exception as ex:                      # pylint: disable=W0703
+            self.log.error("Exception in asyncio engine: " + str(ex),
+                           exc_info = True)
+        finally:
+            self.factory.stop_listening()
+            for transport in self.factory.flow:
+                transport.abortConnection()
+            self.loop.run_until_complete(asyncio.sleep(0))
+            self.loop.close()
+            self.conn.close()
+        self.log.info("asyncio engine: exiting")
+
+    def start(self):
+        ''' Start the thread. '''
+        self.thread.start()
+
+    def send(self, msg):
+        ''' Pass config update or control message to the engine. '''
+        try:
+            self.loop.call_soon_threadsafe(self.factory.receive, msg)
+        except RuntimeError:
+            pass                        # Loop closed after draining.
+
+    def terminate(self):
+        ''' Stop the engine at once. '''
+        try:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        except RuntimeError:
+            pass
+
+    def join(self, timeout):
+        ''' Wait for the thread to exit. '''
+        self.thread.join(timeout)
+
+
+def _wait_any(sources, timeout):
+    ''' Return the sources with data, waiting at most timeout for some. '''
+    ready = [s for s in sources if s.wait(0)]
+    if not ready:
+        handles = [h for s in sources for h in s.handles()]
+        if multiprocessing.connection.wait(handles, timeout):
+            ready = [s for s in sources if s.wait(0)]
+    return ready
 
 
 class Irccat(callbacks.Plugin):
     '''
     Main plugin.
 
-    Runs the dataflow from TCP port -> irc in a separate thread,
-    governed by twisted's reactor.run(). Commands are executed in
-    main thread. The critical zone is self.config, a _Config instance.
+    Runs the dataflow from TCP port -> irc in one or more io_process
+    workers, governed by twisted's reactor.run(), and a listener thread
+    writing to irc. Commands are executed in main thread. The critical
+    zone is self.config, a _Config instance, and the pipes to the
+    workers, all guarded by self.lock.
     '''
     # pylint: disable=E1101,R0904
 
     threaded = True
     admin = 'owner'       # The capability required to manage data.
+    DrainTime = 10.0      # Max time for io processes to finish clients.
+    ReplayBurst = 5       # Max # of spooled lines replayed at once.
+    ExpireEvery = 60.0    # Seconds between dropping old spooled lines.
 
     def __init__(self, irc):
         callbacks.Plugin.__init__(self, irc)
         self.log = log.getPluginLogger('irccat.irccat')
         self.config = _Config()
-
-        self.pipe = multiprocessing.Pipe()
-        self.pipe[1].send(self.config)
-        self.process = multiprocessing.Process(
-                            target = io_process,
-                            args = (self.config.port, self.pipe))
-        self.process.start()
-
+        self.routes = _Routes()
+        self.routes.rebuild(world.ircs)
+        self.scheduler = _Scheduler(self.config.privmsg)
+        self.spool = _claim_spool(self.config)
+        self.tls_context = _claim_tls(self.config)
+        self.replay_buckets = _TokenBuckets()
+        self.expired = 0.0                # Last spool.expire() call.
+
+        self.lock = threading.Lock()      # Serializes sends to io_process.
+        self.workers = []
+        if self.config.engine == 'asyncio':
+            worker_class = _AsyncioWorker
+        else:
+            worker_class = _Worker
+        for sockets in _LISTENERS.claim(self.config):
+            worker = worker_class(self.config, sockets, self.control,
+                                  self.tls_context)
+            worker.start()
+            self.workers.append(worker)
+
+        self.depth = (0, 0)               # Last reported queue depths.
+        self.deadline = None              # When draining must be done.
+        self.drain_stats = []             # From _Worker.stop() when done.
         self.listen_abort = False
         self.thread = threading.Thread(target = self.listener_thread)
         self.thread.start()
 
+    def doJoin(self, irc, msg):
+        ''' Update routes when we join channel(s). '''
+        if ircutils.strEqual(msg.nick, irc.nick):
+            for channel in msg.args[0].split(','):
+                self.routes.add(irc.getRealIrc(), channel)
+
+    def doPart(self, irc, msg):
+        ''' Update routes when we leave channel(s). '''
+        if ircutils.strEqual(msg.nick, irc.nick):
+            for channel in msg.args[0].split(','):
+                self.routes.remove(irc.getRealIrc(), channel)
+
+    def doKick(self, irc, msg):
+        ''' Update routes when we are kicked from channel(s). '''
+        channels = msg.args[0].split(',')
+        nicks = msg.args[1].split(',')
+        if len(channels) == 1:
+            channels = channels * len(nicks)
+        for channel, nick in zip(channels, nicks):
+            if ircutils.strEqual(nick, irc.nick):
+                self.routes.remove(irc.getRealIrc(), channel)
+
+    def doQuit(self, irc, msg):
+        ''' Update routes when we quit the network. '''
+        if ircutils.strEqual(msg.nick, irc.nick):
+            self.routes.drop(irc.getRealIrc())
+
+    def reset(self):
+        ''' Some network has reconnected, its channels are gone. '''
+        callbacks.Plugin.reset(self)
+        self.routes.rebuild(world.ircs)
+
+    def deliver(self, msg, channels, lane, when):
+        ''' Schedule msg for all channels in priority lane. '''
+        for target in channels:
+            channel, ircs = self.routes.lookup(target)
+            delivered = False
+            for irc in ircs:
+                if irc.zombie:
+                    self.routes.drop(irc)
+                else:
+                    self.scheduler.put(irc, channel, msg, lane, when)
+                    delivered = True
+            if delivered:
+                continue
+            if self.spool:
+                self.spool.append(target, msg, lane, when)
+            else:
+                self.log.warning(
+                    "Can't write to non-joined channel: " + target)
+        self.scheduler.pump()
+
+    def replay(self):
+        '''
+        Deliver spooled lines to channels which are joined again, at
+        most spoolrate lines/second to each. Every ExpireEvery seconds
+        drop lines older than spoolage also for channels never rejoined.
+        '''
+        now = time.time()
+        if now - self.expired >= self.ExpireEvery:
+            self.expired = now
+            self.spool.expire(now)
+        for target in self.spool.targets():
+            if not self.routes.lookup(target)[1]:
+                continue
+            count = 0
+            while count < self.ReplayBurst and \
+                    self.replay_buckets.take(target, self.config.spoolrate,
+                                             self.ReplayBurst, now):
+                count += 1
+            if not count:
+                continue
+            lines = self.spool.take(target, count, now)
+            self.replay_buckets.refund(target, count - len(lines))
+            for msg, lane, when in lines:
+                self.deliver(msg, [target], lane, when)
+
+    def broadcast(self, msg):
+        ''' Send msg to all workers, self.lock must be held. '''
+        for worker in self.workers:
+            worker.send(msg)
+
+    def control(self, worker, kind, payload):
+        ''' Handle a control message from a worker's io_process. '''
+        if kind == 'resync':
+            self.log.info("io_process at version %s, sending snapshot" %
+                          payload)
+            with self.lock:
+                worker.send(self.config.snapshot())
+        elif kind == 'block':
+            with self.lock:
+                for other in self.workers:
+                    if other is not worker:
+                        other.send((kind, payload))
+        elif kind == 'drained':
+            worker.drained = payload
+        else:
+            self.log.warning("Unknown control message: " + kind)
+
+    def report_depth(self):
+        ''' Tell io_process about changed # of messages in irc queues. '''
+        depth = sum([len(irc.queue) for irc in world.ircs])
+        depth = (depth + self.scheduler.pending, self.scheduler.high_pending)
+        if depth != self.depth:
+            self.depth = depth
+            with self.lock:
+                self.broadcast(('depth', depth))
+
     def listener_thread(self):
-        ''' Take messages from process, write them to irc.'''
+        '''
+        Take message frames from workers, write them to irc. After die()
+        runs until all workers have exited and their lines are handed
+        to irc, or the deadline has passed. Lines still waiting in the
+        scheduler then go to the irc send queues at once, unless the bot
+        is dying.
+        '''
+        owners = dict([(w.source, w) for w in self.workers])
+        sources = list(owners)
+        forced = False
         while not self.listen_abort:
             try:
-                if not self.pipe[1].poll(0.5):
-                    continue
-                msg, channels = self.pipe[1].recv()
-                for channel in channels:
-                    for irc in world.ircs:
-                        if channel in irc.state.channels:
-                            if self.config.privmsg:
-                                irc.queueMsg(ircmsgs.privmsg(channel, msg))
-                            else:
-                                irc.queueMsg(ircmsgs.notice(channel, msg))
-                        else:
-                            self.log.warning(
-                                "Can't write to non-joined channel: " + channel)
-            except EOFError:
-                self.listen_abort = True
+                if not sources and not self.scheduler.pending:
+                    break
+                if self.deadline and time.time() > self.deadline:
+                    if forced or not sources:
+                        self.drain_timeout()
+                        break
+                    forced = True               # Read what's left, but
+                    self.deadline += 2          # not for long.
+                    for source in sources:
+                        owners[source].terminate()
+                timeout = 0.05 if self.scheduler.pending else 0.5
+                for source in _wait_any(sources, timeout):
+                    msgs = source.read()
+                    owners[source].received += len(msgs)
+                    for msg in msgs:
+                        self.deliver(*msg)
+                    if source.closed:
+                        sources.remove(source)
+                if self.spool:
+                    self.replay()
+                self.scheduler.pump()
+                self.report_depth()
             except Exception:
                 self.log.debug("LISTEN: Exception", exc_info = True)
                 self.listen_abort = True
+        self.drain_stats = [w.stop(self.log) for w in self.workers]
         self.log.debug("LISTEN: exiting")
 
+    def drain_timeout(self):
+        ''' Deadline passed: queue what's left in irc, or drop if dying. '''
+        if world.dying:
+            self.log.warning("Drain timeout, %d lines not sent"
+                             % self.scheduler.pending)
+            return
+        self.log.info("Drain timeout, queueing %d lines in irc"
+                      % self.scheduler.pending)
+        self.scheduler.flush()
+
     def die(self, cmd = False):                   # pylint: disable=W0221
-        ''' Tear down reactor thread and die. '''
+        '''
+        Let the io processes finish their open connections, cutting
+        those still open after DrainTime, flush and confirm. The listener
+        thread delivers all they send until the pipes are empty. A
+        reloaded plugin takes over the listening sockets meanwhile; when
+        the bot is shutting down wait for the listener thread instead.
+        '''
 
         self.log.debug("Dying...")
-        self.process.terminate()
-        self.listen_abort = True
-        self.thread.join()
+        self.deadline = time.time() + self.DrainTime + 5
+        with self.lock:
+            self.broadcast(('drain', self.DrainTime))
+        _LISTENERS.release()
+        self.config.close()
+        if world.dying:
+            self.thread.join(self.DrainTime + 10)
         if not cmd:
             callbacks.Plugin.die(self)
 
-    def sectiondata(self, irc, msg, args, section_name, password, channels):
-        """ <section name> <password> <channel[,channel...]>
+    def sectiondata(self, irc, msg, args, section_name, password, channels,
+                    priority):
+        """ <section name> <password> <[network/]channel[,...]> [<priority>]
 
         Update a section with name, password and a comma-separated list
-        of channels which should be connected to this section. Creates
-        new section if it doesn't exist.
+        of channels which should be connected to this section. A channel
+        can be prefixed with a network e. g., libera/#chan. Creates
+        new section if it doesn't exist. <priority> is high, normal or
+        low; messages from sections with higher priority are sent first.
+        The default is normal, or the existing section's priority.
         """
         salts = 'abcdcefghijklmnopqrstauvABCDEFGHIJKLMNOPQRSTUVXYZ123456789'
 
         salt = random.choice(salts) + random.choice(salts)
         cipher_pw = crypt.crypt(password, salt)
-        self.config.update(section_name, cipher_pw, channels)
-        self.pipe[1].send(self.config)
+        fields = {'priority': priority} if priority else {}
+        with self.lock:
+            self.config.update(section_name, cipher_pw, channels, **fields)
+            self.broadcast(self.config.delta(section_name))
         irc.replySuccess()
 
     sectiondata = wrap(sectiondata, [admin,
                                      'somethingWithoutSpaces',
                                      'somethingWithoutSpaces',
-                                     commalist('validChannel')])
+                                     commalist('irccatTarget'),
+                                     optional(('literal', _LANES))])
 
     def sectionkill(self, irc, msg, args, section_name):
         """ <section name>
@@ -334,16 +2791,46 @@ class Irccat(callbacks.Plugin):
         Removes an existing section given it's name.
         """
 
-        try:
-            self.config.remove(section_name)
-        except KeyError:
-            irc.reply("Error: no such section")
-            return
-        self.pipe[1].send(self.config)
+        with self.lock:
+            try:
+                self.config.remove(section_name)
+            except KeyError:
+                irc.reply("Error: no such section")
+                return
+            self.broadcast(self.config.delta(section_name))
         irc.replySuccess()
 
     sectionkill = wrap(sectionkill, [admin, 'somethingWithoutSpaces'])
 
+    def sectionlimit(self, irc, msg, args, section_name, rate, burst, excess):
+        """ <section name> <rate> <burst> [drop|summary]
+
+        Limit a section to <rate> lines per second, allowing bursts of
+        up to <burst> lines. Lines above the limit are dropped; using
+        summary the number of dropped lines is also sent to the section's
+        channels. A rate of 0 removes the limit.
+        """
+        if rate < 0:
+            irc.errorInvalid('rate', str(rate))
+            return
+        with self.lock:
+            try:
+                self.config.modify(section_name, rate = rate, burst = burst,
+                                   excess = excess)
+            except KeyError:
+                irc.reply("Error: no such section")
+                return
+            self.broadcast(self.config.delta(section_name))
+        irc.replySuccess()
+
+    sectionlimit = wrap(sectionlimit, [admin,
+                                       'somethingWithoutSpaces',
+                                       'float',
+                                       'positiveInt',
+                                       optional(('literal',
+                                                 ('drop', 'summary')),
+                                                'drop')])
+
     def sectionshow(self, irc, msg, args, section_name):
         """ <section name>
 
@@ -356,10 +2843,79 @@ class Irccat(callbacks.Plugin):
             irc.reply("Error: no such section")
             return
         msg = password + ' ' + ','.join(channels)
+        rate = self.config.option(section_name, 'rate')
+        if rate:
+            msg += ' (limit: %s/s, burst %d, %s)' % (
+                rate, self.config.option(section_name, 'burst'),
+                self.config.option(section_name, 'excess'))
+        priority = self.config.option(section_name, 'priority')
+        if priority != 'normal':
+            msg += ' (priority: %s)' % priority
+        dedup = self.config.option(section_name, 'dedup')
+        if dedup:
+            msg += ' (dedup: %ds)' % dedup
+        digest = self.config.option(section_name, 'digest')
+        if digest:
+            msg += ' (digest: %d lines/%ds)' % (
+                digest, self.config.option(section_name, 'digestwindow'))
         irc.reply(msg)
 
     sectionshow = wrap(sectionshow, [admin, 'somethingWithoutSpaces'])
 
+    def sectiondedup(self, irc, msg, args, section_name, window):
+        """ <section name> <seconds>
+
+        Drop lines sent to a section which are exact repeats of a line
+        sent less than <seconds> ago. When the time has passed, a single
+        line with the number of repeats is sent. 0 disables.
+        """
+        with self.lock:
+            try:
+                self.config.modify(section_name, dedup = window)
+            except KeyError:
+                irc.reply("Error: no such section")
+                return
+            self.broadcast(self.config.delta(section_name))
+        irc.replySuccess()
+
+    sectiondedup = wrap(sectiondedup, [admin,
+                                       'somethingWithoutSpaces',
+                                       'nonNegativeInt'])
+
+    def sectiondigest(self, irc, msg, args, section_name, threshold, window):
+        """ <section name> <lines> [<seconds>]
+
+        Relay at most <lines> lines to a section during <seconds>, 60 by
+        default. Further lines are posted as one digest message when the
+        time has passed. 0 lines disables.
+        """
+        with self.lock:
+            try:
+                self.config.modify(section_name, digest = threshold,
+                                   digestwindow = window)
+            except KeyError:
+                irc.reply("Error: no such section")
+                return
+            self.broadcast(self.config.delta(section_name))
+        irc.replySuccess()
+
+    sectiondigest = wrap(sectiondigest, [admin,
+                                         'somethingWithoutSpaces',
+                                         'nonNegativeInt',
+                                         optional('positiveInt', 60)])
+
+    def sectionstats(self, irc, msg, args):
+        """ <takes no arguments>
+
+        Show time lines have waited from irccat got them until they were
+        handed to irc, for each priority lane.
+        """
+        irc.reply('; '.join(['%s: %s' % (lane, stats.summary())
+                             for lane, stats in zip(_LANES,
+                                                    self.scheduler.stats)]))
+
+    sectionstats = wrap(sectionstats, [admin])
+
     def sectionlist(self, irc, msg, args):
         """ <takes no arguments>
 
@@ -0,0 +1,273 @@
+###
+# Copyright (c) 2013, Alec Leamas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Single producer, single consumer ring buffer in shared memory.
+
+Records are length-prefixed byte strings. The producer (io_process)
+owns the head, the consumer (listener_thread) owns the tail, so no
+locking is needed except when the producer drops the oldest records
+on overflow. A pipe is used as doorbell so the consumer can sleep in
+select() while the ring is empty.
+
+Layout: a 64 byte header with head, tail and counters as 64-bit
+little-endian words, followed by the data area. Head and tail are
+byte counts which only grow, position is count % capacity. A record
+which doesn't fit before the end of the data area is preceded by a
+wrap marker (or, if less than 4 bytes remain, nothing) and written
+at the start.
+ '''
+
+import errno
+import multiprocessing
+import os
+import select
+import struct
+import time
+
+from multiprocessing import shared_memory
+
+_WORD = struct.Struct('<Q')
+_LEN = struct.Struct('<I')
+_WRAP = 0xffffffff
+
+_HEAD = 0
+_TAIL = 8
+COUNTERS = ('written', 'dropped_newest', 'dropped_oldest', 'blocked')
+_COUNTER_OFFSET = dict([(c, 16 + 8 * i) for i, c in enumerate(COUNTERS)])
+_DATA = 64
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest')
+
+
+class ShmRing(object):
+    ''' Ring of length-prefixed records in a SharedMemory block. '''
+
+    BlockTimeout = 5.0     # Max time 'block' waits for space (seconds).
+
+    def __init__(self, capacity, overflow = 'block'):
+        assert overflow in OVERFLOW_POLICIES, 'Bad policy: ' + overflow
+        self.capacity = capacity
+        self.overflow = overflow
+        self.shm = shared_memory.SharedMemory(create = True,
+                                              size = _DATA + capacity)
+        self.buf = self.shm.buf
+        self.buf[0:_DATA] = bytes(_DATA)
+        self._lock = multiprocessing.Lock()
+        self._bell_r, self._bell_w = os.pipe()
+        os.set_blocking(self._bell_r, False)
+        os.set_blocking(self._bell_w, False)
+
+    def _get(self, offset):
+        ''' Read header word at offset. '''
+        return _WORD.unpack_from(self.buf, offset)[0]
+
+    def _set(self, offset, value):
+        ''' Write header word at offset. '''
+        _WORD.pack_into(self.buf, offset, value)
+
+    def _add(self, counter, count):
+        ''' Add count to a counter. '''
+        if count:
+            offset = _COUNTER_OFFSET[counter]
+            self._set(offset, self._get(offset) + count)
+
+    def _record_at(self, tail):
+        ''' Return (size, skip) for the entry at tail; size None if wrap. '''
+        pos = tail % self.capacity
+        to_end = self.capacity - pos
+        if to_end < _LEN.size:
+            return None, to_end
+        size = _LEN.unpack_from(self.buf, _DATA + pos)[0]
+        if size == _WRAP:
+            return None, to_end
+        return size, _LEN.size + size
+
+    def _make_room(self, head, needed):
+        '''
+        Producer side, ring is too full for needed bytes at head. Return
+        new tail when there is room, or None if record should be dropped.
+        '''
+        tail = self._get(_TAIL)
+        if self.capacity - (head - tail) >= needed:
+            return tail
+        if self.overflow == 'drop-newest':
+            return None
+        if self.overflow == 'drop-oldest':     # Lock is held.
+            while self.capacity - (head - tail) < needed:
+                size, skip = self._record_at(tail)
+                tail += skip
+                if size is not None:
+                    self._add('dropped_oldest', 1)
+            self._set(_TAIL, tail)
+            return tail
+        self._add('blocked', 1)
+        deadline = time.time() + self.BlockTimeout
+        while time.time() < deadline:
+            self.notify()
+            time.sleep(0.001)
+            tail = self._get(_TAIL)
+            if self.capacity - (head - tail) >= needed:
+                return tail
+        return None
+
+    def _put_many(self, payloads):
+        ''' Producer side: store payloads, publish head once. '''
+        capacity = self.capacity
+        buf = self.buf
+        head = self._get(_HEAD)
+        tail = self._get(_TAIL)
+        written = 0
+        dropped = 0
+        for i, payload in enumerate(payloads):
+            size = _LEN.size + len(payload)
+            if size > capacity // 2:
+                dropped += 1
+                continue
+            pos = head % capacity
+            to_end = capacity - pos
+            needed = size if to_end >= size else to_end + size
+            if capacity - (head - tail) < needed:
+                self._set(_HEAD, head)
+                tail = self._make_room(head, needed)
+                if tail is None and self.overflow == 'block':
+                    dropped += len(payloads) - i   # Don't block again.
+                    break
+                if tail is None:
+                    dropped += 1
+                    tail = self._get(_TAIL)
+                    continue
+            if to_end < size:
+                if to_end >= _LEN.size:
+                    _LEN.pack_into(buf, _DATA + pos, _WRAP)
+                head += to_end
+                pos = 0
+            _LEN.pack_into(buf, _DATA + pos, len(payload))
+            start = _DATA + pos + _LEN.size
+            buf[start:start + len(payload)] = payload
+            head += size
+            written += 1
+        self._set(_HEAD, head)
+        self._add('written', written)
+        self._add('dropped_newest', dropped)
+        return written
+
+    def put_many(self, payloads):
+        ''' Producer side: append payloads, return # of stored ones. '''
+        if self.overflow == 'drop-oldest':
+            with self._lock:
+                return self._put_many(payloads)
+        return self._put_many(payloads)
+
+    def put(self, payload):
+        ''' Producer side: append payload, return False if dropped. '''
+        return self.put_many([payload]) == 1
+
+    def notify(self):
+        ''' Producer side: ring the doorbell. '''
+        try:
+            os.write(self._bell_w, b'\0')
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout):
+        ''' Consumer side: wait for data, return True if there is some. '''
+        if self._get(_HEAD) != self._get(_TAIL):
+            return True
+        readable = select.select([self._bell_r], [], [], timeout)[0]
+        if readable:
+            try:
+                while os.read(self._bell_r, 4096):
+                    pass
+            except OSError as ex:
+                if ex.errno != errno.EAGAIN:
+                    raise
+        return self._get(_HEAD) != self._get(_TAIL)
+
+    def fileno(self):
+        ''' Consumer side: the doorbell, readable after notify(). '''
+        return self._bell_r
+
+    def consume(self, decode):
+        '''
+        Consumer side: return list of decode(view) for the records
+        available when called. The view is a memoryview into the ring,
+        only valid during the call.
+        '''
+        locked = self.overflow == 'drop-oldest'
+        capacity = self.capacity
+        buf = self.buf
+        result = []
+        if locked:
+            self._lock.acquire()
+        try:
+            head = self._get(_HEAD)
+            tail = self._get(_TAIL)
+            try:
+                while tail < head:
+                    pos = tail % capacity
+                    to_end = capacity - pos
+                    if to_end < _LEN.size:
+                        tail += to_end
+                        continue
+                    size = _LEN.unpack_from(buf, _DATA + pos)[0]
+                    if size == _WRAP:
+                        tail += to_end
+                        continue
+                    start = _DATA + pos + _LEN.size
+                    view = buf[start:start + size]
+                    tail += _LEN.size + size
+                    try:
+                        result.append(decode(view))
+                    finally:
+                        view.release()
+            finally:
+                self._set(_TAIL, tail)
+        finally:
+            if locked:
+                self._lock.release()
+        return result
+
+    def counters(self):
+        ''' Return dict of counter values. '''
+        return dict([(c, self._get(_COUNTER_OFFSET[c])) for c in COUNTERS])
+
+    def close(self):
+        ''' Release the memory, owner also removes it. '''
+        self.buf = None
+        self.shm.close()
+        for fd in (self._bell_r, self._bell_w):
+            os.close(fd)
+
+    def unlink(self):
+        ''' Remove the shared memory block (owner only, after close()). '''
+        self.shm.unlink()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,269 @@
+###
+# Copyright (c) 2013, Alec Leamas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Disk spool for messages which can't be delivered to irc right now.
+
+Each channel has a directory holding an append-only log split into
+segments, named by a sequence number which is global for the spool so
+the oldest segment can be found, and a cursor file with the position
+of the next record to replay. Records are a header with the length of
+the text, time and lane followed by the utf-8 text. Segments are read
+using mmap and removed when replayed. Records older than max_age are
+skipped, whole segments are removed when older than max_age or, oldest
+first, when the spool is larger than max_bytes.
+'''
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+from urllib.parse import quote, unquote
+
+_RECORD = struct.Struct('<IdB')        # Length of text, time, lane.
+_SUFFIX = '.seg'
+
+
+class _Channel(object):
+    ''' The segments and cursor for one channel. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.sizes = {}                 # Segment seq -> size.
+        for name in os.listdir(path):
+            if name.endswith(_SUFFIX):
+                seq = int(name[:-len(_SUFFIX)])
+                self.sizes[seq] = os.path.getsize(self.segment(seq))
+        self.segments = sorted(self.sizes)
+        self.file = None                # Last segment, open for append.
+        try:
+            with open(os.path.join(path, 'cursor')) as f:
+                seq, offset = f.read().split()
+            self.cursor = (int(seq), int(offset))
+        except (IOError, ValueError):
+            self.cursor = (0, 0)
+        if self.segments:
+            self._recover(self.segments[-1])
+
+    def segment(self, seq):
+        ''' Return path to segment seq. '''
+        return os.path.join(self.path, '%010d%s' % (seq, _SUFFIX))
+
+    def _recover(self, seq):
+        ''' Cut a record torn by a crash at the end of segment seq. '''
+        size = self.sizes[seq]
+        offset = 0
+        if size:
+            with open(self.segment(seq), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) \
+                        as view:
+                    while offset + _RECORD.size <= size:
+                        end = offset + _RECORD.size + \
+                            _RECORD.unpack_from(view, offset)[0]
+                        if end > size:
+                            break
+                        offset = end
+        if offset < size:
+            os.truncate(self.segment(seq), offset)
+            self.sizes[seq] = offset
+
+    def bytes(self):
+        ''' Return total size of all segments. '''
+        return sum(self.sizes.values())
+
+    def pending(self):
+        ''' Return True if there are records not yet replayed. '''
+        if not self.segments:
+            return False
+        last = self.segments[-1]
+        return self.cursor < (last, self.sizes[last])
+
+    def append(self, record, next_seq, segment_size):
+        ''' Append record, starting a new segment if needed. '''
+        last = self.segments[-1] if self.segments else None
+        if self.file is None or \
+                self.sizes[last] + len(record) > segment_size:
+            if self.file is not None:
+                self.file.close()
+            if last is None or self.sizes[last]:
+                last = next_seq()
+                self.segments.append(last)
+                self.sizes[last] = 0
+            self.file = open(self.segment(last), 'ab')
+        self.file.write(record)
+        self.file.flush()
+        self.sizes[last] += len(record)
+
+    def remove(self, seq):
+        ''' Remove segment seq, return its size. '''
+        if seq == self.segments[-1] and self.file is not None:
+            self.file.close()
+            self.file = None
+        self.segments.remove(seq)
+        try:
+            os.unlink(self.segment(seq))
+        except OSError:
+            pass
+        return self.sizes.pop(seq)
+
+    def _save_cursor(self):
+        ''' Store cursor atomically. '''
+        path = os.path.join(self.path, 'cursor')
+        with open(path + '.tmp', 'w') as f:
+            f.write('%d %d' % self.cursor)
+        os.rename(path + '.tmp', path)
+
+    def take(self, count, oldest):
+        '''
+        Return list of up to count (text, lane, time) records from cursor,
+        skipping those older than oldest, and the # of bytes removed.
+        The cursor is only stored if it has moved.
+        '''
+        result = []
+        removed = 0
+        start = self.cursor
+        while len(result) < count and self.pending():
+            seq, offset = self.cursor
+            if seq not in self.sizes:               # Removed, use next.
+                seq = min([s for s in self.segments if s > seq])
+                offset = 0
+            size = self.sizes[seq]
+            if offset >= size:
+                if seq == self.segments[-1]:
+                    break
+                removed += self.remove(seq)         # Replayed.
+                self.cursor = (seq + 1, 0)
+                continue
+            with open(self.segment(seq), 'rb') as f:
+                with mmap.mmap(f.fileno(), size, access = mmap.ACCESS_READ) \
+                        as view:
+                    while offset < size and len(result) < count:
+                        length, when, lane = _RECORD.unpack_from(view, offset)
+                        start = offset + _RECORD.size
+                        offset = start + length
+                        if when >= oldest:
+                            text = view[start:offset].decode('utf-8')
+                            result.append((text, lane, when))
+            self.cursor = (seq, offset)
+        if self.cursor != start:
+            self._save_cursor()
+        return result, removed
+
+    def close(self):
+        ''' Close the open segment. '''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class Spool(object):
+    ''' Bounded, disk-backed queues of messages keyed by channel. '''
+
+    SegmentSize = 1 << 20           # Max size of a segment (bytes).
+
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._channels = {}             # target -> _Channel
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                self._channels[unquote(name)] = _Channel(path)
+        self._seq = max([c.segments[-1] for c in self._channels.values()
+                         if c.segments] + [0])
+        self.bytes = sum([c.bytes() for c in self._channels.values()])
+
+    def _next_seq(self):
+        ''' Return a new segment sequence number. '''
+        self._seq += 1
+        return self._seq
+
+    def append(self, target, text, lane, when):
+        ''' Store a message for target. '''
+        data = text.encode('utf-8')
+        record = _RECORD.pack(len(data), when, lane) + data
+        with self._lock:
+            channel = self._channels.get(target)
+            if channel is None:
+                path = os.path.join(self.directory, quote(target, safe = ''))
+                if not os.path.isdir(path):
+                    os.mkdir(path)
+                channel = _Channel(path)
+                self._channels[target] = channel
+            channel.append(record, self._next_seq, self.SegmentSize)
+            self.bytes += len(record)
+            if self.bytes > self.max_bytes:
+                self._expire(time.time())
+
+    def targets(self):
+        ''' Return list of targets with messages to replay. '''
+        with self._lock:
+            return [t for t, c in self._channels.items() if c.pending()]
+
+    def take(self, target, count, now = None):
+        ''' Remove and return up to count (text, lane, time) for target. '''
+        now = time.time() if now is None else now
+        with self._lock:
+            channel = self._channels.get(target)
+            if channel is None:
+                return []
+            result, removed = channel.take(count, now - self.max_age)
+            self.bytes -= removed
+            return result
+
+    def _expire(self, now):
+        ''' Remove segments older than max_age, then oldest until small. '''
+        for channel in self._channels.values():
+            for seq in list(channel.segments):
+                if os.path.getmtime(channel.segment(seq)) < now - self.max_age:
+                    self.bytes -= channel.remove(seq)
+        while self.bytes > self.max_bytes:
+            seq, channel = min([(c.segments[0], c)
+                                for c in self._channels.values()
+                                if c.segments], key = lambda e: e[0])
+            self.bytes -= channel.remove(seq)
+
+    def expire(self, now = None):
+        ''' Drop old messages, and the oldest ones if over max_bytes. '''
+        with self._lock:
+            self._expire(time.time() if now is None else now)
+
+    def close(self):
+        ''' Close all open files. '''
+        with self._lock:
+            for channel in self._channels.values():
+                channel.close()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -37,23 +37,44 @@
 # pylint: disable=R0904
 
 
+import crypt
+import http.client
+import json
 import os
 import os.path
+import shutil
 import socket
+import ssl
 import subprocess
+import tempfile
+import threading
 
 from supybot.test import *
 
 from . import config
 from . import plugin as irccat
+from . import ring
+from . import spool
 
 CLIENT = os.path.join(os.path.dirname(__file__), 'irccat')
 
 def clear_sections(testcase):
-    if os.path.exists('test-sections.json'):
-        os.unlink('test-sections.json')
+    for path in ['test-sections.json', 'test-sections.json.journal']:
+        if os.path.exists(path):
+            os.unlink(path)
     config.global_option('sectionspath').setValue('test-sections.json')
     config.global_option('port').setValue(23456)
+    config.global_option('transport').setValue('pipe')
+    config.global_option('httpport').setValue(0)
+    config.global_option('udpport').setValue(0)
+    config.global_option('unixpath').setValue('')
+    config.global_option('unixtrust').setValue(False)
+    config.global_option('tlsport').setValue(0)
+    config.global_option('workers').setValue(1)
+    config.global_option('engine').setValue('process')
+    config.global_option('spooldir').setValue('')
+    config.global_option('highwater').setValue(200)
+    config.global_option('lowwater').setValue(50)
 
 def communicate(msg, sendonly):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -74,6 +95,18 @@ def communicate(msg, sendonly):
         s.close()
 
 
+def received_lines(testcase, count):
+    ''' Return at least count lines sent to the channel, uncoalesced. '''
+    lines = []
+    while len(lines) < count:
+        msg = testcase.getMsg(' ')
+        testcase.assertIsNot(msg, None)
+        if msg.command in ('NOTICE', 'PRIVMSG') and \
+                msg.args[0] == testcase.channel:    # Not replies, WHO etc.
+            lines.extend(msg.args[1].split(irccat._Scheduler.Separator))
+    return lines
+
+
 class IrccatTestList(PluginTestCase):
     plugins = ('Irccat', 'User')
 
@@ -117,6 +150,588 @@ class IrccatTestCopy(ChannelPluginTestCase):
         communicate(b'ivaru22;ivarpw22;ivar data\n', sendonly=True)
         self.assertRegexp(' ', 'No such section.*')
 
+    def testPartJoin(self):
+        prefix = self.irc.nick + '!user@host.tld'
+        self.irc.feedMsg(ircmsgs.part('#test', prefix = prefix))
+        communicate(b'ivar;ivarpw;ivar data\n', sendonly=True)
+        self.assertNoResponse(' ', 1)
+        self.irc.feedMsg(ircmsgs.join('#test', prefix = prefix))
+        while self.irc.takeMsg():      # Drop WHO, MODE etc. after JOIN.
+            pass
+        communicate(b'ivar;ivarpw;ivar data\n', sendonly=True)
+        self.assertResponse(' ', 'ivar data')
+
+    def testFrames(self):
+        # pylint: disable=W0212
+        data = irccat._FrameDecoder.Magic + \
+            irccat._encode_frame('ivar', 'ivarpw',
+                                 ['line 1', 'line 2\nl;3']) + \
+            irccat._encode_frame('ivar', '', ['line 4'])
+        communicate(data, sendonly=True)
+        lines = received_lines(self, 4)
+        self.assertEqual(lines, ['line 1', 'line 2', 'l;3', 'line 4'])
+
+    def testFramesBadPw(self):
+        # pylint: disable=W0212
+        communicate(irccat._FrameDecoder.Magic +
+                    irccat._encode_frame('ivar', '', ['line 1']),
+                    sendonly=True)
+        self.assertRegexp(' ', 'Bad password.*')
+
+    def testNetworkTarget(self):
+        self.assertNotError('sectiondata ivar ivarpw %s/#test' %
+                            self.irc.network, private = True)
+        communicate(b'ivar;ivarpw;ivar data\n', sendonly=True)
+        self.assertResponse(' ', 'ivar data')
+        self.assertNotError('sectiondata ivar ivarpw nosuchnet/#test',
+                            private = True)
+        communicate(b'ivar;ivarpw;ivar data\n', sendonly=True)
+        self.assertNoResponse(' ', 1)
+
+    def testSession(self):
+        communicate(b'AUTH ivar;ivarpw\nline 1\nline 2\n', sendonly=True)
+        self.assertResponse(' ', 'line 1')
+        self.assertResponse(' ', 'line 2')
+
+    def testSessionKilled(self):
+        s = socket.create_connection(('localhost', 23456))
+        try:
+            s.sendall(b'AUTH ivar;ivarpw\nline 1\n')
+            self.assertResponse(' ', 'line 1')
+            self.assertNotError('sectionkill ivar', private = True)
+            time.sleep(0.2)
+            s.sendall(b'line 2\n')
+            self.assertNoResponse(' ', 1)
+        finally:
+            s.close()
+
+    def testSectionLimit(self):
+        self.assertNotError('sectionlimit ivar 0.01 2', private = True)
+        communicate(b'AUTH ivar;ivarpw\nline 1\nline 2\nline 3\n',
+                    sendonly=True)
+        self.assertResponse(' ', 'line 1')
+        self.assertResponse(' ', 'line 2')
+        self.assertNoResponse(' ', 1)
+        communicate(b'ivar;ivarpw;line 4\n', sendonly=True)
+        self.assertNoResponse(' ', 1)
+
+    def testDedup(self):
+        self.assertNotError('sectiondedup ivar 1', private = True)
+        communicate(b'AUTH ivar;ivarpw\nsame\nsame\nother\nsame\n',
+                    sendonly=True)
+        self.assertResponse(' ', 'same')
+        self.assertResponse(' ', 'other')
+        self.assertResponse(' ', 'same (repeated 2 times)')
+
+    def testDigest(self):
+        self.assertNotError('sectiondigest ivar 1 1', private = True)
+        communicate(b'AUTH ivar;ivarpw\nline 1\nline 2\nline 3\nline 4\n',
+                    sendonly=True)
+        self.assertResponse(' ', 'line 1')
+        self.assertResponse(
+            ' ', '[digest] 3 more lines, first: line 2, last: line 4')
+
+    def testBackpressure(self):
+        config.global_option('highwater').setValue(3)
+        config.global_option('lowwater').setValue(1)
+        self.assertNotError('reload Irccat', private = True)
+        s = socket.create_connection(('localhost', 23456))
+        try:
+            s.sendall(b'AUTH ivar;ivarpw\nline 1\nline 2\nline 3\n')
+            time.sleep(1.5)
+            s.sendall(b'line 4\n')
+            time.sleep(1)
+            scheduler = self.irc.getCallback('Irccat').scheduler
+            self.assertEqual(len(self.irc.queue) + scheduler.pending, 3)
+            for i in range(1, 5):
+                self.assertResponse(' ', 'line %d' % i)
+        finally:
+            s.close()
+
+    def testSessionBadPw(self):
+        communicate(b'AUTH ivar;ivarpw22\nline 1\n', sendonly=True)
+        self.assertRegexp(' ', 'Bad password.*')
+        self.assertNoResponse(' ', 1)
+
+
+class IrccatTestShm(ChannelPluginTestCase):
+    plugins = ('Irccat', 'User')
+    channel = '#test'
+
+    def setUp(self, nick='test'):      # pylint: disable=W0221
+        clear_sections(self)
+        config.global_option('transport').setValue('shm')
+        ChannelPluginTestCase.setUp(self)
+        self.assertNotError('reload Irccat', private = True)
+        self.assertNotError('register suptest suptest', private = True)
+        self.assertNotError('sectiondata ivar ivarpw #test', private = True)
+
+    def tearDown(self):
+        config.global_option('transport').setValue('pipe')
+        ChannelPluginTestCase.tearDown(self)
+
+    def testCopy(self):
+        communicate(b'ivar;ivarpw;ivar d\xc3\xa5ta\n', sendonly=True)
+        self.assertResponse(' ', 'ivar d\xe5ta')
+
+    def testBadPw(self):
+        communicate(b'ivar;ivarpw22;ivar data\n', sendonly=True)
+        self.assertRegexp(' ', 'Bad password.*')
+
+
+class DrainTests(object):
+    ''' Draining on reload, run using the engine of the test case. '''
+    engine = None
+
+    def testDrain(self):
+        self.assertNotError('sectiondedup ivar 60', private = True)
+        plugin = self.irc.getCallback('Irccat')
+        plugin.DrainTime = 1
+        session = socket.create_connection(('localhost', 23456))
+        try:
+            session.sendall(b'AUTH ivar;ivarpw\nline 1\nline 1\nline 1\n')
+            self.assertResponse(' ', 'line 1')
+            self.feedMsg('reload Irccat', private = True)
+            plugin.thread.join(5)
+        finally:
+            session.close()
+        self.assertFalse(plugin.thread.is_alive())
+        worker = plugin.workers[0]
+        if self.engine == 'asyncio':
+            self.assertFalse(worker.thread.is_alive())
+        else:
+            self.assertFalse(worker.process.is_alive())
+        self.assertEqual(plugin.drain_stats, [(2, 2, 1)])
+        msgs = [self.getMsg(' ') for i in range(0, 2)]
+        self.assertIn('line 1 (repeated 2 times)',
+                      [m.args[1] for m in msgs if m])
+
+
+class IrccatTestAsyncio(DrainTests, ChannelPluginTestCase):
+    plugins = ('Irccat', 'User')
+    channel = '#test'
+    engine = 'asyncio'
+
+    def setUp(self, nick='test'):      # pylint: disable=W0221
+        clear_sections(self)
+        config.global_option('engine').setValue('asyncio')
+        config.global_option('udpport').setValue(23458)
+        ChannelPluginTestCase.setUp(self)
+        self.assertNotError('reload Irccat', private = True)
+        self.assertNotError('register suptest suptest', private = True)
+        self.assertNotError('sectiondata ivar ivarpw #test', private = True)
+
+    def tearDown(self):
+        config.global_option('engine').setValue('process')
+        config.global_option('udpport').setValue(0)
+        ChannelPluginTestCase.tearDown(self)
+
+    def testCopy(self):
+        workers = self.irc.getCallback('Irccat').workers
+        self.assertIsInstance(workers[0], irccat._AsyncioWorker)
+        communicate(b'ivar;ivarpw;ivar d\xc3\xa5ta\n', sendonly=True)
+        self.assertResponse(' ', 'ivar d\xe5ta')
+
+    def testBadPw(self):
+        communicate(b'ivar;ivarpw22;ivar data\n', sendonly=True)
+        self.assertRegexp(' ', 'Bad password.*')
+
+    def testSession(self):
+        communicate(b'AUTH ivar;ivarpw\nline 1\n', sendonly=True)
+        self.assertResponse(' ', 'line 1')
+
+    def testDatagram(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.sendto(b'ivar;ivarpw;line 1\n', ('localhost', 23458))
+        finally:
+            sock.close()
+        self.assertResponse(' ', 'line 1')
+
+
+class TlsTests(object):
+    ''' TLS tests, run using the engine of the test case. '''
+    plugins = ('Irccat', 'User')
+    channel = '#test'
+    engine = None
+
+    def setUp(self, nick='test'):      # pylint: disable=W0221
+        clear_sections(self)
+        self.dir = tempfile.mkdtemp()
+        self.cert = os.path.join(self.dir, 'cert.pem')
+        key = os.path.join(self.dir, 'key.pem')
+        subprocess.check_output(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-keyout', key, '-out', self.cert, '-days', '1',
+             '-subj', '/CN=localhost',
+             '-addext', 'subjectAltName=DNS:localhost'],
+            stderr = subprocess.STDOUT)
+        config.global_option('engine').setValue(self.engine)
+        config.global_option('tlsport').setValue(23459)
+        config.global_option('tlscert').setValue(self.cert)
+        config.global_option('tlskey').setValue(key)
+        self.context = ssl.create_default_context(cafile = self.cert)
+        ChannelPluginTestCase.setUp(self)
+        self.assertNotError('reload Irccat', private = True)
+        self.assertNotError('register suptest suptest', private = True)
+        self.assertNotError('sectiondata ivar ivarpw #test', private = True)
+
+    def tearDown(self):
+        config.global_option('engine').setValue('process')
+        config.global_option('tlsport').setValue(0)
+        config.global_option('tlscert').setValue('')
+        config.global_option('tlskey').setValue('')
+        ChannelPluginTestCase.tearDown(self)
+        shutil.rmtree(self.dir)
+
+    def send(self, data, session = None):
+        '''
+        Send data using TLS, resuming session if given. Return the new
+        session and whether session was reused.
+        '''
+        sock = self.context.wrap_socket(
+                    socket.create_connection(('localhost', 23459)),
+                    server_hostname = 'localhost',
+                    session = session)
+        try:
+            sock.sendall(data)
+            sock.settimeout(0.1)
+            for i in range(0, 50):      # Ticket is sent after handshake.
+                if sock.session.has_ticket:
+                    break
+                try:
+                    sock.recv(1)
+                except socket.timeout:
+                    pass
+            return sock.session, sock.session_reused
+        finally:
+            sock.close()
+
+    def testCopy(self):
+        self.send(b'ivar;ivarpw;ivar d\xc3\xa5ta\n')
+        self.assertResponse(' ', 'ivar d\xe5ta')
+
+    def testBadPw(self):
+        self.send(b'ivar;ivarpw22;ivar data\n')
+        self.assertRegexp(' ', 'Bad password.*')
+
+    def testPlaintext(self):
+        sock = socket.create_connection(('localhost', 23459))
+        try:
+            sock.sendall(b'ivar;ivarpw;in the clear\n')
+        finally:
+            sock.close()
+        msg = self.getMsg(' ', timeout = 1)
+        self.assertFalse(msg and msg.args[1] == 'in the clear')
+
+    def testResume(self):
+        session, reused = self.send(b'AUTH ivar;ivarpw\nline 1\n')
+        self.assertFalse(reused)
+        self.assertResponse(' ', 'line 1')
+        self.feedMsg('reload Irccat', private = True)
+        session, reused = self.send(b'AUTH ivar;ivarpw\nline 2\n', session)
+        self.assertTrue(reused)
+        msgs = [self.getMsg(' ') for i in range(0, 2)]
+        self.assertIn('line 2', [m.args[1] for m in msgs if m])
+
+    def testIrccat(self):
+        cmd = 'seq -f "line %%g" 1 200 | IRCCAT_PASSWORD=ivarpw %s -c %s' \
+              ' localhost 23459 ivar -'
+        subprocess.check_call(cmd % (CLIENT, self.cert), shell = True)
+        lines = received_lines(self, 200)
+        self.assertEqual(lines, ['line %d' % i for i in range(1, 201)])
+        cmd = 'IRCCAT_PASSWORD=ivarpw %s -c %s localhost 23459 ivar ivar data'
+        subprocess.check_call(cmd % (CLIENT, self.cert), shell = True)
+        self.assertResponse(' ', 'ivar data')
+
+    def testIrccatUntrusted(self):
+        cmd = 'IRCCAT_PASSWORD=ivarpw %s -t localhost 23459 ivar ivar data'
+        with self.assertRaises(subprocess.CalledProcessError):
+            subprocess.check_output(cmd % CLIENT, shell = True)
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl required')
+class IrccatTestTls(TlsTests, ChannelPluginTestCase):
+    engine = 'process'
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl required')
+class IrccatTestTlsAsyncio(TlsTests, ChannelPluginTestCase):
+    engine = 'asyncio'
+
+
+class IrccatTestWebhook(ChannelPluginTestCase):
+    plugins = ('Irccat', 'User')
+    channel = '#test'
+
+    def setUp(self, nick='test'):      # pylint: disable=W0221
+        clear_sections(self)
+        config.global_option('httpport').setValue(23457)
+        ChannelPluginTestCase.setUp(self)
+        self.assertNotError('reload Irccat', private = True)
+        self.assertNotError('register suptest suptest', private = True)
+        self.assertNotError('sectiondata ivar ivarpw #test', private = True)
+        self.conn = http.client.HTTPConnection('localhost', 23457)
+
+    def tearDown(self):
+        self.conn.close()
+        config.global_option('httpport').setValue(0)
+        ChannelPluginTestCase.tearDown(self)
+
+    def post(self, body):
+        self.conn.request('POST', '/', body,
+                          {'Content-Type': 'application/json'})
+        response = self.conn.getresponse()
+        return response.status, json.loads(response.read().decode())
+
+    def testPost(self):
+        body = {'section': 'ivar', 'token': 'ivarpw',
+                'lines': ['line 1', 'line 2\nline 3']}
+        self.assertEqual(self.post(json.dumps(body)), (200, {'accepted': 3}))
+        for i in range(1, 4):
+            self.assertResponse(' ', 'line %d' % i)
+        body['lines'] = ['line 4']
+        self.assertEqual(self.post(json.dumps(body)), (200, {'accepted': 1}))
+        self.assertResponse(' ', 'line 4')
+
+    def testBadToken(self):
+        body = {'section': 'ivar', 'token': 'ivarpw22', 'lines': ['data']}
+        self.assertEqual(self.post(json.dumps(body))[0], 403)
+        self.assertRegexp(' ', 'Bad password.*')
+
+    def testBadRequest(self):
+        self.assertEqual(self.post('{"section": "ivar"}')[0], 400)
+        self.assertRegexp(' ', 'Illegal webhook request.*')
+        body = {'section': 'ivar', 'token': 'ivarpw', 'lines': [1]}
+        self.assertEqual(self.post(json.dumps(body))[0], 400)
+
+
+class IrccatTestUdp(ChannelPluginTestCase):
+    plugins = ('Irccat', 'User')
+    channel = '#test'
+
+    def setUp(self, nick='test'):      # pylint: disable=W0221
+        clear_sections(self)
+        config.global_option('udpport').setValue(23458)
+        ChannelPluginTestCase.setUp(self)
+        self.assertNotError('reload Irccat', private = True)
+        self.assertNotError('register suptest suptest', private = True)
+        self.assertNotError('sectiondata ivar ivarpw #test', private = True)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sock.close()
+        config.global_option('udpport').setValue(0)
+        ChannelPluginTestCase.tearDown(self)
+
+    def testDatagram(self):
+        self.sock.sendto(b'ivar;ivarpw;line 1\nivar;ivarpw;line 2\n',
+                         ('localhost', 23458))
+        self.assertResponse(' ', 'line 1')
+        self.assertResponse(' ', 'line 2')
+
+    def testBadPw(self):
+        self.sock.sendto(b'ivar;ivarpw22;line 1', ('localhost', 23458))
+        self.assertRegexp(' ', 'Bad password.*')
+
+
+class IrccatTestWorkers(ChannelPluginTestCase):
+    plugins = ('Irccat', 'User')
+    channel = '#test'
+
+    def setUp(self, nick='test'):      # pylint: disable=W0221
+        clear_sections(self)
+        config.global_option('workers').setValue(3)
+        ChannelPluginTestCase.setUp(self)
+        self.assertNotError('reload Irccat', private = True)
+        self.assertNotError('register suptest suptest', private = True)
+        self.assertNotError('sectiondata ivar ivarpw #test', private = True)
+
+    def tearDown(self):
+        config.global_option('workers').setValue(1)
+        config.global_option('transport').setValue('pipe')
+        ChannelPluginTestCase.tearDown(self)
+
+    def copy(self):
+        workers = self.irc.getCallback('Irccat').workers
+        self.assertEqual(len(workers), 3)
+        for i in range(0, 30):
+            communicate(b'ivar;ivarpw;line %d\n' % i, sendonly=True)
+        lines = received_lines(self, 30)
+        self.assertEqual(sorted(lines),
+                         sorted(['line %d' % i for i in range(0, 30)]))
+
+    def testCopy(self):
+        self.copy()
+
+    def testShm(self):
+        config.global_option('transport').setValue('shm')
+        self.assertNotError('reload Irccat', private = True)
+        self.copy()
+
+
+class IrccatTestReload(DrainTests, ChannelPluginTestCase):
+    plugins = ('Irccat', 'User')
+    channel = '#test'
+    engine = 'process'
+
+    def setUp(self, nick='test'):      # pylint: disable=W0221
+        clear_sections(self)
+        ChannelPluginTestCase.setUp(self)
+        self.assertNotError('reload Irccat', private = True)
+        self.assertNotError('register suptest suptest', private = True)
+        self.assertNotError('sectiondata ivar ivarpw #test', private = True)
+
+    def testReload(self):
+        session = socket.create_connection(('localhost', 23456))
+        session.sendall(b'AUTH ivar;ivarpw\nsession 1\n')
+
+        def send():
+            for i in range(0, 100):
+                communicate(b'ivar;ivarpw;line %d\n' % i, sendonly=True)
+                time.sleep(0.01)
+
+        sender = threading.Thread(target = send)
+        sender.start()
+        try:
+            time.sleep(0.3)
+            self.feedMsg('reload Irccat', private = True)
+            time.sleep(0.3)
+            session.sendall(b'session 2\n')  # Served by the old worker.
+        finally:
+            sender.join()
+            session.close()
+        expected = ['line %d' % i for i in range(0, 100)]
+        expected += ['session 1', 'session 2']
+        lines = received_lines(self, len(expected))
+        self.assertEqual(sorted(lines), sorted(expected))
+
+
+    def testDrainBacklog(self):
+        # The test irc is never emptied while draining, like a throttled
+        # one with more lines than it can send before the deadline.
+        plugin = self.irc.getCallback('Irccat')
+        plugin.DrainTime = 0
+        expected = ['line %d %s' % (i, 'x' * 300) for i in range(0, 10)]
+        session = socket.create_connection(('localhost', 23456))
+        try:
+            session.sendall(b'AUTH ivar;ivarpw\n' +
+                            ''.join([l + '\n' for l in expected]).encode())
+            for i in range(0, 50):
+                if plugin.scheduler.pending == 8:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(plugin.scheduler.pending, 8)
+            self.feedMsg('reload Irccat', private = True)
+            plugin.thread.join(10)
+        finally:
+            session.close()
+        self.assertFalse(plugin.thread.is_alive())
+        self.assertEqual(plugin.scheduler.pending, 0)
+        self.assertEqual(received_lines(self, 10), expected)
+
+
+class IrccatTestSpool(ChannelPluginTestCase):
+    plugins = ('Irccat', 'User')
+    channel = '#test'
+
+    def setUp(self, nick='test'):      # pylint: disable=W0221
+        clear_sections(self)
+        self.spooldir = tempfile.mkdtemp()
+        config.global_option('spooldir').setValue(self.spooldir)
+        config.global_option('spoolrate').setValue(100.0)
+        ChannelPluginTestCase.setUp(self)
+        self.assertNotError('reload Irccat', private = True)
+        self.assertNotError('register suptest suptest', private = True)
+        self.assertNotError('sectiondata ivar ivarpw #test', private = True)
+
+    def tearDown(self):
+        config.global_option('spooldir').setValue('')
+        config.global_option('spoolrate').setValue(1.0)
+        ChannelPluginTestCase.tearDown(self)
+        shutil.rmtree(self.spooldir)
+
+    def testReplay(self):
+        prefix = self.irc.nick + '!user@host.tld'
+        self.irc.feedMsg(ircmsgs.part('#test', prefix = prefix))
+        for i in range(0, 3):
+            communicate(b'ivar;ivarpw;line %d\n' % i, sendonly=True)
+        self.assertNoResponse(' ', 1)
+        self.assertEqual(self.irc.getCallback('Irccat').spool.targets(),
+                         ['#test'])
+        self.irc.feedMsg(ircmsgs.join('#test', prefix = prefix))
+        lines = received_lines(self, 3)
+        self.assertEqual(lines, ['line 0', 'line 1', 'line 2'])
+
+    def testExpire(self):
+        plugin = self.irc.getCallback('Irccat')
+        prefix = self.irc.nick + '!user@host.tld'
+        self.irc.feedMsg(ircmsgs.part('#test', prefix = prefix))
+        communicate(b'ivar;ivarpw;line 0\n', sendonly=True)
+        self.assertNoResponse(' ', 1)
+        self.assertEqual(plugin.spool.targets(), ['#test'])
+        plugin.spool.max_age = 0
+        plugin.ExpireEvery = 0.1
+        for i in range(0, 40):
+            if not plugin.spool.targets():
+                break
+            time.sleep(0.05)
+        self.assertEqual(plugin.spool.targets(), [])
+        self.assertEqual(plugin.spool.bytes, 0)
+
+
+class IrccatTestUnix(ChannelPluginTestCase):
+    plugins = ('Irccat', 'User')
+    channel = '#test'
+    path = os.path.abspath('test-irccat.sock')
+
+    def setUp(self, nick='test'):      # pylint: disable=W0221
+        clear_sections(self)
+        config.global_option('unixpath').setValue(self.path)
+        ChannelPluginTestCase.setUp(self)
+        self.assertNotError('reload Irccat', private = True)
+        self.assertNotError('register suptest suptest', private = True)
+        self.assertNotError('sectiondata ivar ivarpw #test', private = True)
+
+    def tearDown(self):
+        config.global_option('unixpath').setValue('')
+        config.global_option('unixtrust').setValue(False)
+        ChannelPluginTestCase.tearDown(self)
+
+    def send(self, data):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            for i in range(0, 50):      # Reloaded io_process starting up.
+                try:
+                    s.connect(self.path)
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            s.sendall(data)
+        finally:
+            s.close()
+
+    def testUnix(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o660)
+        self.send(b'ivar;ivarpw;line 1\n')
+        self.assertResponse(' ', 'line 1')
+
+    def testBadPw(self):
+        self.send(b'ivar;ivarpw22;line 1\n')
+        self.assertResponse(' ', 'Bad password: ivarpw22 from: UNIX socket')
+
+    def testTrusted(self):
+        config.global_option('unixtrust').setValue(True)
+        self.assertNotError('reload Irccat', private = True)
+        self.send(b'ivar;;line 1\nnosuchsection;;line 2\n')
+        self.assertResponse(' ', 'line 1')
+        self.assertRegexp(' ', 'No such section.*')
+        cmd = '%s -a -u %s ivar line 3' % (CLIENT, self.path)
+        env = dict(os.environ)
+        env.pop('IRCCAT_PASSWORD', None)
+        subprocess.check_call(cmd, shell = True, env = env)
+        self.assertResponse(' ', 'line 3')
+
 
 class IrccatTestIrccat(ChannelPluginTestCase):
     plugins = ('Irccat', 'User')
@@ -142,6 +757,80 @@ class IrccatTestIrccat(ChannelPluginTestCase):
         p.communicate(b'ivarpw\n')
         self.assertResponse(' ', 'ivar data')
 
+    def testIrccatSession(self):
+        cmd = 'IRCCAT_PASSWORD=ivarpw %s -a' \
+              ' localhost 23456 ivar ivar data'
+        subprocess.check_call(cmd % CLIENT, shell = True)
+        self.assertResponse(' ', 'ivar data')
+
+    def testIrccatStream(self):
+        cmd = 'seq -f "line %%g" 1 200 | IRCCAT_PASSWORD=ivarpw %s' \
+              ' localhost 23456 ivar -'
+        subprocess.check_call(cmd % CLIENT, shell = True)
+        lines = received_lines(self, 200)
+        self.assertEqual(lines, ['line %d' % i for i in range(1, 201)])
+
+    def testIrccatStreamStdinPw(self):
+        cmd = '%s -s localhost 23456 ivar -'
+        p = subprocess.Popen(cmd % CLIENT, shell = True,
+                             stdin = subprocess.PIPE)
+        p.communicate(b'ivarpw\nivar data')
+        self.assertEqual(p.returncode, 0)
+        self.assertResponse(' ', 'ivar data')
+
+    def testIrccatStreamFramed(self):
+        cmd = 'seq -f "line %%g" 1 200 | IRCCAT_PASSWORD=ivarpw %s -f' \
+              ' localhost 23456 ivar -'
+        subprocess.check_call(cmd % CLIENT, shell = True)
+        lines = received_lines(self, 200)
+        self.assertEqual(lines, ['line %d' % i for i in range(1, 201)])
+
+    def testIrccatStreamFramedLongPw(self):
+        cmd = 'echo data | IRCCAT_PASSWORD=%s %s -f localhost 23456 ivar -'
+        p = subprocess.Popen(cmd % ('x' * 256, CLIENT), shell = True,
+                             stdout = subprocess.PIPE)
+        out = p.communicate()[0]
+        self.assertEqual(p.returncode, 1)
+        self.assertIn(b'255 bytes', out)
+
+    def testIrccatStreamNoServer(self):
+        cmd = 'echo data | IRCCAT_PASSWORD=ivarpw %s -w 1' \
+              ' localhost 23457 ivar -'
+        with self.assertRaises(subprocess.CalledProcessError):
+            subprocess.check_output(cmd % CLIENT, shell = True,
+                                    stderr = subprocess.STDOUT)
+
+    def testIrccatStreamHangUp(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('localhost', 0))
+        server.listen(50)
+        accepted = []
+
+        def hang_up():
+            while True:
+                try:
+                    conn = server.accept()[0]
+                except OSError:
+                    return
+                accepted.append(conn)
+                conn.close()
+
+        thread = threading.Thread(target = hang_up)
+        thread.start()
+        cmd = 'yes line | IRCCAT_PASSWORD=ivarpw %s -w 2 -b 100' \
+              ' localhost %d ivar -'
+        try:
+            with self.assertRaises(subprocess.CalledProcessError):
+                subprocess.check_output(cmd % (CLIENT,
+                                               server.getsockname()[1]),
+                                        shell = True, timeout = 30,
+                                        stderr = subprocess.STDOUT)
+        finally:
+            server.shutdown(socket.SHUT_RDWR)
+            server.close()
+            thread.join()
+        self.assertTrue(len(accepted) <= 4)
+
     def testIrccatBadCmdline(self):
         cmd = 'IRCCAT_PASSWORD=ivarpw %s' \
               ' localhost 23456'
@@ -175,6 +864,33 @@ class IrccatTestData(PluginTestCase):
     def testShow(self):
         self.assertRegexp('sectionshow yngve', '.*#al-bot-test$')
 
+    def testLimit(self):
+        self.assertNotError('sectionlimit yngve 2.5 10 summary')
+        self.assertRegexp('sectionshow yngve',
+                          '.*#al-bot-test .limit: 2.5/s, burst 10, summary.$')
+        self.assertNotError('sectiondata yngve yngve #al-bot-test')
+        self.assertRegexp('sectionshow yngve', '.*burst 10.*')
+        self.assertError('sectionlimit yngve -1 10')
+        self.assertResponse('sectionlimit tore 1 1', 'Error: no such section')
+
+    def testDedup(self):
+        self.assertNotError('sectiondedup yngve 30')
+        self.assertRegexp('sectionshow yngve', '.*#al-bot-test .dedup: 30s.$')
+        self.assertResponse('sectiondedup tore 1', 'Error: no such section')
+
+    def testDigest(self):
+        self.assertNotError('sectiondigest yngve 20')
+        self.assertRegexp('sectionshow yngve', '.*[(]digest: 20 lines/60s[)]$')
+        self.assertResponse('sectiondigest tore 1', 'Error: no such section')
+
+    def testPriority(self):
+        self.assertNotError('sectiondata yngve yngve #al-bot-test high')
+        self.assertRegexp('sectionshow yngve', '.*[(]priority: high[)]$')
+        self.assertNotError('sectiondata yngve yngve2 #al-bot-test')
+        self.assertRegexp('sectionshow yngve', '.*[(]priority: high[)]$')
+        self.assertError('sectiondata yngve yngve #al-bot-test urgent')
+        self.assertRegexp('sectionstats', '^high: no lines; normal: .*')
+
     def testKill(self):
         self.assertNotError('sectionkill yngve')
         self.assertResponse('sectionlist', 'ivar')
@@ -207,5 +923,883 @@ class BlacklistTest(SupyTestCase):
             self.blacklist.register(host, False)
         self.assertTrue(self.blacklist.onList(host))
 
+    def testShare(self):
+        self.blacklist = irccat._Blacklist()    # pylint: disable=W0212
+        other = irccat._Blacklist()             # pylint: disable=W0212
+        self.blacklist.notify = other.block
+        self.blacklist.SubnetFailMax = other.SubnetFailMax = 10
+        host = '132.132.132.132'
+        for i in range(0, self.blacklist.FailMax):   # pylint: disable=W0612
+            self.blacklist.register(host, False)
+        self.assertTrue(other.onList(host))
+        self.assertFalse(other.onList('132.132.132.133'))
+        self.blacklist.register('132.132.132.133', False)
+        self.assertFalse(other.onList('132.132.132.134'))
+        self.blacklist.register('132.132.132.133', False)
+        self.assertTrue(other.onList('132.132.132.134'))
+
+    def testDatagram(self):
+        # pylint: disable=W0212
+        self.blacklist = irccat._Blacklist()
+        self.blacklist.notify = lambda table, key: self.fail(key)
+        sections = irccat._Sections()
+        ingest = irccat._Ingest(sections, self.blacklist, irccat._AuthCache(),
+                                [], MsgConn())
+        listener = irccat._DatagramListener(ingest)
+        for i in range(0, 100):
+            listener.datagramReceived(b'ivar;pw;data\n',
+                                      ('132.132.132.%d' % (i % 10), 1234))
+        self.assertTrue(listener.ingest.blacklist.onList('132.132.132.1'))
+        self.assertFalse(listener.ingest.blacklist.onList('132.132.132.11'))
+        self.assertFalse(self.blacklist.onList('132.132.132.1'))
+
+    def testBounded(self):
+        self.blacklist = irccat._Blacklist()    # pylint: disable=W0212
+        self.blacklist.MaxHosts = 100
+        self.blacklist.SubnetFailMax = 0
+        for i in range(0, 1000):
+            for j in range(0, self.blacklist.FailMax):  # pylint: disable=W0612
+                self.blacklist.register('10.0.%d.%d' % (i // 256, i % 256),
+                                        False)
+        self.assertEqual(len(self.blacklist), 100)
+        self.assertTrue(self.blacklist.onList('10.0.3.231'))
+        self.assertFalse(self.blacklist.onList('10.0.0.1'))
+
+    def testExpire(self):
+        self.blacklist = irccat._Blacklist()    # pylint: disable=W0212
+        self.blacklist.BlockTime = 0.1
+        self.blacklist.register('10.0.0.1', False)
+        time.sleep(0.15)
+        self.blacklist.register('10.0.0.2', False)
+        self.assertEqual(len(self.blacklist), 1)
+
+    def testSubnet(self):
+        self.blacklist = irccat._Blacklist()    # pylint: disable=W0212
+        self.blacklist.FailMax = 100
+        self.blacklist.SubnetFailMax = 4
+        for host in ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4',
+                     '2001:db8::1', '2001:db8::2', '2001:db8::3',
+                     '2001:db8::4']:
+            self.assertFalse(self.blacklist.onList(host))
+            self.blacklist.register(host, False)
+        self.assertTrue(self.blacklist.onList('10.0.0.99'))
+        self.assertFalse(self.blacklist.onList('10.0.1.1'))
+        self.assertTrue(self.blacklist.onList('2001:db8::99'))
+        self.assertFalse(self.blacklist.onList('2001:db8:0:1::1'))
+
+
+class FrameConn(object):
+
+    def __init__(self):
+        self.frames = []
+
+    def send(self, msg):
+        kind, frame = msg
+        assert kind == 'frame'
+        self.frames.append(frame)
+
+
+class BatcherTest(SupyTestCase):
+
+    def testFullFrame(self):
+        conn = FrameConn()
+        batcher = irccat._Batcher(conn)          # pylint: disable=W0212
+        batcher.MaxFrame = 3
+        for i in range(0, 7):
+            batcher.send(('line %d' % i, ['#test'], 1, 0.0))
+        self.assertEqual([len(f) for f in conn.frames], [3, 3])
+        batcher.flush()
+        self.assertEqual([len(f) for f in conn.frames], [3, 3, 1])
+        self.assertEqual(conn.frames[2], [('line 6', ['#test'], 1, 0.0)])
+
+    def testHighPriority(self):
+        conn = FrameConn()
+        batcher = irccat._Batcher(conn)          # pylint: disable=W0212
+        batcher.send(('line 1', ['#test'], 2, 0.0))
+        batcher.send(('alert', ['#test'], 0, 0.0))
+        self.assertEqual([len(f) for f in conn.frames], [2])
+
+    def testSendFrame(self):
+        conn = FrameConn()
+        batcher = irccat._Batcher(conn)          # pylint: disable=W0212
+        batcher.send(('line 1', ['#test'], 1, 0.0))
+        batcher.send_frame([('line %d' % i, ['#test'], 1, 0.0)
+                            for i in range(2, 100)])
+        self.assertEqual([len(f) for f in conn.frames], [1, 98])
+
+    def testEmptyFlush(self):
+        conn = FrameConn()
+        batcher = irccat._Batcher(conn)          # pylint: disable=W0212
+        batcher.flush()
+        self.assertEqual(conn.frames, [])
+
+
+class DedupTest(SupyTestCase):
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.sections = irccat._Sections()      # pylint: disable=W0212
+        ivar = {'password': 'pw', 'channels': ['#test'], 'dedup': 60}
+        yngve = {'password': 'pw', 'channels': ['#test']}
+        self.sections.apply(('snapshot', 1, {'ivar': ivar, 'yngve': yngve}))
+        self.sink = MsgConn()
+        self.dedup = irccat._Dedup(self.sections,  # pylint: disable=W0212
+                                   self.sink)
+
+    def testRepeats(self):
+        accepted = [self.dedup.accept('ivar', 'h', t)
+                    for t in ['a', 'b', 'a', 'a', 'b', 'c']]
+        self.assertEqual(accepted, [True, True, False, False, False, True])
+        self.assertTrue(self.dedup.accept('yngve', 'h', 'a'))
+        self.assertTrue(self.dedup.accept('yngve', 'h', 'a'))
+        self.dedup.sweep(time.time() + 30)
+        self.assertEqual(self.sink.msgs, [])
+        self.dedup.sweep(time.time() + 61)
+        self.assertEqual(self.sink.msgs,
+                         [('a (repeated 2 times)', ['#test'], 1),
+                          ('b (repeated 1 times)', ['#test'], 1)])
+        self.assertTrue(self.dedup.accept('ivar', 'h', 'a'))
+
+    def testFlush(self):
+        for text in ['a', 'a', 'b']:
+            self.dedup.accept('ivar', 'h', text)
+        self.dedup.flush()
+        self.assertEqual(self.sink.msgs,
+                         [('a (repeated 1 times)', ['#test'], 1)])
+        self.assertTrue(self.dedup.accept('ivar', 'h', 'a'))
+
+    def testBounded(self):
+        self.dedup.MaxLines = 2
+        for text in ['a', 'a', 'b', 'c', 'a']:
+            self.dedup.accept('ivar', 'h', text)
+        self.assertEqual(self.sink.msgs,
+                         [('a (repeated 1 times)', ['#test'], 1)])
+
+
+class DigestTest(SupyTestCase):
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.sections = irccat._Sections()      # pylint: disable=W0212
+        ivar = {'password': 'pw', 'channels': ['#test'], 'digest': 2}
+        self.sections.apply(('snapshot', 1, {'ivar/x': ivar}))
+        self.sink = MsgConn()
+
+    def feed(self, digest, count):
+        return [digest.accept('ivar/x', 'h', 'line %d' % i)
+                for i in range(1, count + 1)]
+
+    def testDigest(self):
+        digest = irccat._Digest(self.sections,   # pylint: disable=W0212
+                                self.sink)
+        self.assertEqual(self.feed(digest, 5),
+                         [True, True, False, False, False])
+        digest.close('ivar/x')
+        self.assertEqual(self.feed(digest, 3), [True, True, False])
+        digest.close('ivar/x')
+        digest.close('ivar/x')
+        self.assertEqual(self.sink.msgs, [
+            ('[digest] 3 more lines, first: line 3, last: line 5',
+             ['#test'], 1),
+            ('[digest] 1 more lines, first: line 3', ['#test'], 1)])
+
+    def testFlush(self):
+        digest = irccat._Digest(self.sections,   # pylint: disable=W0212
+                                self.sink)
+        self.feed(digest, 3)
+        digest.flush()
+        self.assertEqual(self.sink.msgs, [
+            ('[digest] 1 more lines, first: line 3', ['#test'], 1)])
+
+    def testFile(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            digest = irccat._Digest(self.sections,   # pylint: disable=W0212
+                                    self.sink, tmpdir, 'http://h/d')
+            digest.MaxFileLines = 2
+            self.feed(digest, 6)
+            digest.close('ivar/x')
+            link = self.sink.msgs[0][0].split(', all: ')[1]
+            self.assertTrue(link.startswith('http://h/d/ivar_x-'))
+            path = os.path.join(tmpdir, link[len('http://h/d/'):])
+            with open(path) as f:
+                self.assertEqual(f.read(), 'line 3\nline 6\n')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testPrune(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            digest = irccat._Digest(self.sections,   # pylint: disable=W0212
+                                    self.sink, tmpdir)
+            digest.MaxFiles = 3
+            names = ['x-20260101-00000%d-1-1.txt' % i for i in range(0, 5)]
+            for i, name in enumerate(names + ['index.html']):
+                path = os.path.join(tmpdir, name)
+                open(path, 'w').close()
+                os.utime(path, (1000 + i, 1000 + i))
+            digest.prune(now = 1000 + digest.MaxFileAge)
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ['index.html'] + names[2:])
+            digest.prune(now = 1000 + digest.MaxFileAge + 4)
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             ['index.html'] + names[4:])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class FakeTransport(object):
+
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+class FrameDecoderTest(SupyTestCase):
+    # pylint: disable=W0212
+
+    def testSplit(self):
+        data = irccat._encode_frame('s\xe5', 'pw', ['a\nb', '', 'c\0d']) + \
+            irccat._encode_frame('s', '', ['e'])
+        decoder = irccat._FrameDecoder()
+        frames = []
+        for i in range(0, len(data)):
+            frames.extend(decoder.feed(data[i:i + 1]))
+        self.assertEqual(frames, [('s\xe5', 'pw', ['a\nb', '', 'c\0d']),
+                                  ('s', '', ['e'])])
+        self.assertEqual(decoder.feed(data), frames)
+
+    def testBinary(self):
+        frame = irccat._encode_frame('s', 'pw', ['x'])[:-1] + b'\xff'
+        self.assertEqual(irccat._FrameDecoder().feed(frame),
+                         [('s', 'pw', ['\ufffd'])])
+
+    def testBad(self):
+        decoder = irccat._FrameDecoder()
+        decoder.MaxFrame = 100
+        self.assertRaises(ValueError, decoder.feed, b'\0\0\1\0')
+        for body in [b'\0',                                   # Short head.
+                     irccat._FRAME_HEAD.pack(1, 0, 1) + b's' +
+                     irccat._FRAME_LEN.pack(9) + b'abc',      # Long record.
+                     irccat._FRAME_HEAD.pack(1, 0, 0) + b'sxx']:   # Garbage.
+            self.assertRaises(ValueError, irccat._FrameDecoder().feed,
+                              irccat._FRAME_LEN.pack(len(body)) + body)
+
+
+class FileModeTest(SupyTestCase):
+
+    def testFileMode(self):
+        mode = config.FileMode('660', 'help')
+        mode.setValue('600')
+        self.assertEqual(mode.value, '600')
+        self.assertRaises(registry.InvalidRegistryValue, mode.setValue, '9x')
+
+
+class FlowControlTest(SupyTestCase):
+
+    def testPauseResume(self):
+        flow = irccat._FlowControl(10, 2)       # pylint: disable=W0212
+        t1 = FakeTransport()
+        flow.add(t1)
+        flow.set_high(t1, False)
+        flow.depth(9)
+        self.assertFalse(t1.paused)
+        flow.depth(10)
+        self.assertTrue(t1.paused)
+        t2 = FakeTransport()
+        flow.add(t2)
+        self.assertFalse(t2.paused)
+        flow.set_high(t2, False)
+        self.assertTrue(t2.paused)
+        flow.depth(5)
+        self.assertTrue(t1.paused)
+        flow.remove(t2)
+        flow.depth(2)
+        self.assertFalse(t1.paused)
+        self.assertTrue(t2.paused)
+
+    def testHighLane(self):
+        flow = irccat._FlowControl(10, 2)       # pylint: disable=W0212
+        t1 = FakeTransport()
+        t2 = FakeTransport()
+        flow.add(t1)
+        flow.add(t2)
+        flow.set_high(t1, False)
+        flow.set_high(t2, True)
+        flow.depth(10, 0)
+        self.assertTrue(t1.paused)
+        self.assertFalse(t2.paused)
+        flow.depth(20, 10)
+        self.assertTrue(t2.paused)
+        flow.depth(20, 2)
+        self.assertTrue(t1.paused)
+        self.assertFalse(t2.paused)
+        flow.set_high(t2, False)
+        self.assertTrue(t2.paused)
+        flow.depth(2, 0)
+        self.assertFalse(t1.paused)
+        self.assertFalse(t2.paused)
+
+    def testAddedWhilePaused(self):
+        flow = irccat._FlowControl(10, 2)       # pylint: disable=W0212
+        flow.depth(10, 0)
+        t1 = FakeTransport()
+        t2 = FakeTransport()
+        flow.add(t1)
+        flow.add(t2)
+        flow.depth(20, 0)
+        self.assertFalse(t1.paused)
+        self.assertFalse(t2.paused)
+        flow.set_high(t1, True)                 # AUTH for a high section.
+        flow.set_high(t2, False)
+        self.assertFalse(t1.paused)
+        self.assertTrue(t2.paused)
+        flow.depth(2, 0)
+        self.assertFalse(t2.paused)
+
+    def testDisabled(self):
+        flow = irccat._FlowControl(0, 0)         # pylint: disable=W0212
+        t1 = FakeTransport()
+        flow.add(t1)
+        flow.depth(1000)
+        self.assertFalse(t1.paused)
+
+
+class MsgConn(object):
+
+    def __init__(self):
+        self.msgs = []
+
+    def send(self, msg):
+        data, channels, lane, when = msg
+        assert abs(when - time.time()) < 1
+        self.msgs.append((data, channels, lane))
+
+
+class TokenBucketsTest(SupyTestCase):
+
+    def testTake(self):
+        buckets = irccat._TokenBuckets()         # pylint: disable=W0212
+        self.assertTrue(buckets.take('a', 1, 2, 100.0))
+        self.assertTrue(buckets.take('a', 1, 2, 100.0))
+        self.assertFalse(buckets.take('a', 1, 2, 100.0))
+        self.assertFalse(buckets.take('a', 1, 2, 100.5))
+        self.assertTrue(buckets.take('a', 1, 2, 101.0))
+        self.assertTrue(buckets.take('a', 1, 2, 200.0))
+        self.assertTrue(buckets.take('a', 1, 2, 200.0))
+        self.assertFalse(buckets.take('a', 1, 2, 200.0))
+
+    def testRefund(self):
+        buckets = irccat._TokenBuckets()         # pylint: disable=W0212
+        buckets.refund('a', 1)
+        self.assertEqual(len(buckets), 0)
+        self.assertTrue(buckets.take('a', 1, 2, 100.0))
+        self.assertTrue(buckets.take('a', 1, 2, 100.0))
+        buckets.refund('a', 1)
+        self.assertTrue(buckets.take('a', 1, 2, 100.0))
+        self.assertFalse(buckets.take('a', 1, 2, 100.0))
+
+    def testBounded(self):
+        buckets = irccat._TokenBuckets()         # pylint: disable=W0212
+        buckets.MaxBuckets = 2
+        for key in ['a', 'b', 'c']:
+            buckets.take(key, 1, 1, 100.0)
+        self.assertEqual(len(buckets), 2)
+        self.assertTrue(buckets.take('a', 1, 1, 100.0))
+        self.assertFalse(buckets.take('c', 1, 1, 100.0))
+
+
+class RateLimiterTest(SupyTestCase):
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.sections = irccat._Sections()      # pylint: disable=W0212
+        ivar = {'password': 'pw', 'channels': ['#test'], 'priority': 'high',
+                'rate': 0.001, 'burst': 2, 'excess': 'summary'}
+        yngve = {'password': 'pw', 'channels': ['#test']}
+        self.sections.apply(('snapshot', 1, {'ivar': ivar, 'yngve': yngve}))
+
+    def limiter(self, *args):
+        sink = MsgConn()
+        return sink, irccat._RateLimiter(        # pylint: disable=W0212
+            self.sections, sink, *args)
+
+    def testSection(self):
+        sink, limiter = self.limiter()
+        allowed = [limiter.accept('ivar', 'h', 'x') for i in range(0, 5)]
+        self.assertEqual(allowed, [True, True, False, False, False])
+        self.assertTrue(all([limiter.accept('yngve', 'h', 'x')
+                             for i in range(0, 5)]))
+        limiter.summarize('ivar')
+        self.assertEqual(sink.msgs,
+                         [('[irccat] 3 lines dropped (rate limit)',
+                           ['#test'], 0)])
+
+    def testHost(self):
+        sink, limiter = self.limiter(0.001, 3)
+        allowed = [limiter.accept('yngve', 'h1', 'x') for i in range(0, 4)]
+        self.assertEqual(allowed, [True, True, True, False])
+        self.assertTrue(limiter.accept('yngve', 'h2', 'x'))
+        limiter.summarize('yngve')
+        self.assertEqual(sink.msgs, [])
+
+    def testFlush(self):
+        sink, limiter = self.limiter()
+        for i in range(0, 3):
+            limiter.accept('ivar', 'h', 'x')
+        limiter.flush()
+        self.assertEqual(sink.msgs,
+                         [('[irccat] 1 lines dropped (rate limit)',
+                           ['#test'], 0)])
+
+
+class RingTest(SupyTestCase):
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.ring = None
+
+    def tearDown(self):
+        if self.ring:
+            self.ring.close()
+            self.ring.unlink()
+        SupyTestCase.tearDown(self)
+
+    def testRoundtrip(self):
+        self.ring = ring.ShmRing(256)
+        self.assertFalse(self.ring.wait(0))
+        for i in range(0, 100):
+            self.assertTrue(self.ring.put(b'record %d' % i))
+            self.ring.notify()
+            self.assertTrue(self.ring.wait(0.1))
+            self.assertEqual(self.ring.consume(bytes), [b'record %d' % i])
+        self.assertEqual(self.ring.counters()['written'], 100)
+
+    def testMessage(self):
+        self.ring = ring.ShmRing(256)
+        msg = ('d\xe5ta', ['#a', '#b'], 2, 1234.5)
+        # pylint: disable=W0212
+        self.ring.put(irccat._encode_record(*msg))
+        self.assertEqual(self.ring.consume(irccat._decode_record), [msg])
+
+    def testDropNewest(self):
+        self.ring = ring.ShmRing(64, 'drop-newest')
+        results = [self.ring.put(b'%08d' % i) for i in range(0, 8)]
+        self.assertEqual(results, [True] * 5 + [False] * 3)
+        self.assertEqual(self.ring.consume(bytes),
+                         [b'%08d' % i for i in range(0, 5)])
+        self.assertEqual(self.ring.counters()['dropped_newest'], 3)
+
+    def testDropOldest(self):
+        self.ring = ring.ShmRing(64, 'drop-oldest')
+        for i in range(0, 8):
+            self.assertTrue(self.ring.put(b'%08d' % i))
+        self.assertEqual(self.ring.consume(bytes),
+                         [b'%08d' % i for i in range(3, 8)])
+        self.assertEqual(self.ring.counters()['dropped_oldest'], 3)
+
+    def testBlock(self):
+        self.ring = ring.ShmRing(64, 'block')
+        self.ring.BlockTimeout = 0.1
+        for i in range(0, 5):
+            self.assertTrue(self.ring.put(b'%08d' % i))
+        self.assertFalse(self.ring.put(b'toomuch!'))
+        counters = self.ring.counters()
+        self.assertEqual(counters['blocked'], 1)
+        self.assertEqual(counters['dropped_newest'], 1)
+
+    def testTooLarge(self):
+        self.ring = ring.ShmRing(64)
+        self.assertFalse(self.ring.put(b'x' * 40))
+
+
+class FakeState(object):
+
+    def __init__(self, channels):
+        self.channels = channels
+
+
+class FakeIrc(object):
+
+    def __init__(self, network, channels = ()):
+        self.network = network
+        self.state = FakeState(channels)
+        self.queue = []
+        self.zombie = False
+
+    def queueMsg(self, msg):
+        self.queue.append(msg)
+
+
+class ListenersTest(SupyTestCase):
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'irccat.sock')
+        self.listeners = irccat._Listeners()    # pylint: disable=W0212
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        SupyTestCase.tearDown(self)
+
+    def testStaleUnix(self):
+        old = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old.bind(self.path)
+        old.close()                     # Socket file is left behind.
+        sock = self.listeners._bind('unix', self.path)  # pylint: disable=W0212
+        sock.close()
+
+    def testLiveUnix(self):
+        other = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            other.bind(self.path)
+            other.listen(1)
+            with self.assertRaises(OSError):
+                self.listeners._bind('unix',            # pylint: disable=W0212
+                                     self.path)
+            self.assertTrue(os.path.exists(self.path))
+        finally:
+            other.close()
+
+    def testPortClash(self):
+        # pylint: disable=W0212
+        sock = self.listeners._bind('tcp', 0)
+        try:
+            port = sock.getsockname()[1]
+            self.assertRaises(OSError, self.listeners._bind, 'tcp', port)
+        finally:
+            sock.close()
+
+
+class RoutesTest(SupyTestCase):
+
+    def testRoutes(self):
+        libera = FakeIrc('libera', ['#a', '#B'])
+        oftc = FakeIrc('oftc', ['#b'])
+        routes = irccat._Routes()               # pylint: disable=W0212
+        routes.rebuild([libera, oftc])
+        self.assertEqual(routes.lookup('#b'), ('#b', (libera, oftc)))
+        self.assertEqual(routes.lookup('OFTC/#B'), ('#B', [oftc]))
+        self.assertEqual(routes.lookup('#c'), ('#c', ()))
+        routes.add(oftc, '#C')
+        self.assertEqual(routes.lookup('#c'), ('#c', (oftc,)))
+        routes.remove(libera, '#b')
+        self.assertEqual(routes.lookup('#b'), ('#b', (oftc,)))
+        routes.drop(oftc)
+        self.assertEqual(routes.lookup('#b'), ('#b', ()))
+        self.assertEqual(routes.lookup('#a'), ('#a', (libera,)))
+
+    def testSplit(self):
+        # pylint: disable=W0212
+        self.assertEqual(irccat._split_target('#a/b'), (None, '#a/b'))
+        self.assertEqual(irccat._split_target('net/#a/b'), ('net', '#a/b'))
+
+
+class SchedulerTest(SupyTestCase):
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.irc = FakeIrc('libera')
+        self.scheduler = irccat._Scheduler()     # pylint: disable=W0212
+        self.scheduler.QueueTarget = 1
+
+    def send(self, count):
+        sent = []
+        for i in range(0, count):               # pylint: disable=W0612
+            self.scheduler.pump()
+            if self.irc.queue:
+                msg = self.irc.queue.pop(0)
+                sent.append((msg.args[0], msg.args[1]))
+        return sent
+
+    def testFair(self):
+        for i in range(0, 10):
+            self.scheduler.put(self.irc, '#noisy', '%d %s' % (i, 'x' * 300))
+        self.scheduler.put(self.irc, '#quiet', 'alert')
+        self.assertEqual(self.scheduler.pending, 11)
+        sent = self.send(3)
+        self.assertIn(('#quiet', 'alert'), sent)
+        self.assertEqual(len(self.send(20)), 8)
+        self.assertEqual(self.scheduler.pending, 0)
+
+    def testCoalesce(self):
+        self.scheduler.privmsg = True
+        for text in ['a', 'b', 'c', 'x' * 400, 'd']:
+            self.scheduler.put(self.irc, '#a', text)
+        self.assertEqual(self.send(5), [('#a', 'a | b | c'),
+                                        ('#a', 'x' * 400),
+                                        ('#a', 'd')])
+        self.assertEqual(self.irc.queue, [])
+
+    def testLanes(self):
+        now = time.time()
+        for i in range(0, 3):
+            self.scheduler.put(self.irc, '#a', 'x' * 300, 2, now - 10)
+        self.scheduler.put(self.irc, '#b', 'build', 1, now - 5)
+        self.scheduler.put(self.irc, '#a', 'alert', 0, now - 1)
+        self.assertEqual([text[:5] for channel, text in self.send(5)],
+                         ['alert', 'build', 'xxxxx', 'xxxxx', 'xxxxx'])
+        stats = self.scheduler.stats
+        self.assertEqual([s.count for s in stats], [1, 1, 3])
+        self.assertTrue(1 <= stats[0].max < 2)
+        self.assertTrue(stats[2].max >= 10)
+        self.assertTrue(stats[0].summary().startswith('1 lines, p50 1.'))
+
+    def testZombie(self):
+        self.scheduler.put(self.irc, '#a', 'a')
+        self.scheduler.put(self.irc, '#a', 'b')
+        self.scheduler.pump()
+        self.irc.zombie = True
+        self.scheduler.pump()
+        self.assertEqual(self.scheduler.pending, 0)
+        self.assertEqual(len(self.irc.queue), 1)
+
+
+class SpoolTest(SupyTestCase):
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.spool = spool.Spool(self.dir, 1 << 20, 3600)
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.dir)
+        SupyTestCase.tearDown(self)
+
+    def fill(self, count, target = '#a', when = None):
+        when = time.time() if when is None else when
+        for i in range(0, count):
+            self.spool.append(target, 'line %d' % i, 1, when)
+
+    def testTake(self):
+        self.fill(3)
+        self.spool.append('net/#b', 'd\xe5ta', 0, 1234.5)
+        self.assertEqual(sorted(self.spool.targets()), ['#a', 'net/#b'])
+        self.assertEqual([t for t, l, w in self.spool.take('#a', 2)],
+                         ['line 0', 'line 1'])
+        self.assertEqual([t for t, l, w in self.spool.take('#a', 2)],
+                         ['line 2'])
+        self.assertEqual(self.spool.take('net/#b', 5, 1235),
+                         [('d\xe5ta', 0, 1234.5)])
+        self.assertEqual(self.spool.targets(), [])
+
+    def testCursorUnmoved(self):
+        self.fill(2)
+        self.spool.take('#a', 1)
+        cursor = os.path.join(self.dir, '%23a', 'cursor')
+        os.unlink(cursor)
+        self.assertEqual(self.spool.take('#a', 0), [])
+        self.assertFalse(os.path.exists(cursor))
+        self.spool.take('#a', 1)
+        self.assertTrue(os.path.exists(cursor))
+
+    def testRotate(self):
+        self.spool.SegmentSize = 100
+        self.fill(20)
+        segments = [n for n in os.listdir(os.path.join(self.dir, '%23a'))
+                    if n.endswith('.seg')]
+        self.assertTrue(len(segments) > 3)
+        self.assertEqual(len(self.spool.take('#a', 100)), 20)
+        segments = [n for n in os.listdir(os.path.join(self.dir, '%23a'))
+                    if n.endswith('.seg')]
+        self.assertEqual(len(segments), 1)        # The one appended to.
+
+    def testReopen(self):
+        self.fill(5)
+        self.spool.take('#a', 2)
+        self.spool.close()
+        with open(os.path.join(self.dir, '%23a', '0000000001.seg'), 'ab') \
+                as f:
+            f.write(b'torn')
+        self.spool = spool.Spool(self.dir, 1 << 20, 3600)
+        self.fill(1)
+        self.assertEqual([t for t, l, w in self.spool.take('#a', 10)],
+                         ['line 2', 'line 3', 'line 4', 'line 0'])
+
+    def testMaxBytes(self):
+        self.spool.SegmentSize = 100
+        self.spool.max_bytes = 300
+        self.fill(50, '#old')
+        self.fill(1, '#new')
+        self.assertTrue(self.spool.bytes <= 300)
+        self.assertEqual(len(self.spool.take('#new', 10)), 1)
+        lines = [t for t, l, w in self.spool.take('#old', 100)]
+        self.assertTrue(0 < len(lines) < 50)
+        self.assertEqual(lines[-1], 'line 49')
+
+    def testMaxAge(self):
+        now = time.time()
+        self.fill(2, when = now - 7200)
+        self.fill(2, when = now)
+        self.assertEqual(len(self.spool.take('#a', 10)), 2)
+        self.fill(2)
+        self.spool.expire(now + 7200)
+        self.assertEqual(self.spool.targets(), [])
+        self.assertEqual(self.spool.bytes, 0)
+
+
+class ConfigTest(SupyTestCase):
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        clear_sections(self)
+        self.config = irccat._Config()          # pylint: disable=W0212
+
+    def tearDown(self):
+        self.config.close()
+        SupyTestCase.tearDown(self)
+
+    def reopen(self):
+        self.config.close()
+        self.config = irccat._Config()          # pylint: disable=W0212
+
+    def testReplay(self):
+        self.config.update('ivar', 'pw', ['#a'])
+        self.config.update('yngve', 'pw2', ['#b'])
+        self.config.remove('ivar')
+        self.reopen()
+        self.assertEqual(self.config.keys(), ['yngve'])
+        self.assertEqual(self.config.get('yngve'), ('pw2', ['#b']))
+        self.assertEqual(self.config.version, 3)
+
+    def testCompact(self):
+        self.config.CompactEvery = 4
+        for i in range(0, 10):
+            self.config.update('s%d' % i, 'pw', ['#a'])
+        self.config.close()
+        with open('test-sections.json') as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot['format'], 2)
+        self.assertTrue(snapshot['version'] >= 4)
+        with open('test-sections.json.journal') as f:
+            self.assertEqual(len(f.readlines()), 10 - snapshot['version'])
+        self.config = irccat._Config()          # pylint: disable=W0212
+        self.assertEqual(len(self.config.keys()), 10)
+        self.assertEqual(self.config.version, 10)
+
+    def testTornJournal(self):
+        self.config.update('ivar', 'pw', ['#a'])
+        self.config.close()
+        with open('test-sections.json.journal', 'a') as f:
+            f.write('{"v": 2, "op": "ups')
+        self.config = irccat._Config()          # pylint: disable=W0212
+        self.assertEqual(self.config.keys(), ['ivar'])
+        self.config.update('yngve', 'pw', ['#a'])
+        self.reopen()
+        self.assertEqual(sorted(self.config.keys()), ['ivar', 'yngve'])
+
+    def testLimit(self):
+        self.config.update('ivar', 'pw', ['#a'])
+        self.assertEqual(self.config.option('ivar', 'rate'), 0)
+        self.config.modify('ivar', rate = 0.5, excess = 'summary')
+        self.config.update('ivar', 'pw2', ['#b'])
+        self.reopen()
+        self.assertEqual(self.config.get('ivar'), ('pw2', ['#b']))
+        self.assertEqual(self.config.option('ivar', 'rate'), 0.5)
+        self.assertEqual(self.config.option('ivar', 'excess'), 'summary')
+        self.assertEqual(self.config.option('ivar', 'burst'), 1)
+        self.assertRaises(KeyError, self.config.modify, 'yngve', rate = 1)
+
+    def testOldFormat(self):
+        self.config.close()
+        with open('test-sections.json', 'w') as f:
+            json.dump({'ivar': {'password': 'pw', 'channels': ['#a']}}, f)
+        self.config = irccat._Config()          # pylint: disable=W0212
+        self.assertEqual(self.config.get('ivar'), ('pw', ['#a']))
+
+    def testDuplicatePort(self):
+        config.global_option('httpport').setValue(23456)
+        try:
+            self.assertRaises(ValueError, self.reopen)
+        finally:
+            config.global_option('httpport').setValue(0)
+        self.config = irccat._Config()          # pylint: disable=W0212
+
+
+class SectionsTest(SupyTestCase):
+
+    def testApply(self):
+        sections = irccat._Sections()           # pylint: disable=W0212
+        self.assertFalse(sections.apply(('upsert', 1, 'a', {})))
+        ivar = {'password': 'pw', 'channels': ['#test']}
+        self.assertTrue(sections.apply(('snapshot', 3, {'ivar': ivar})))
+        self.assertEqual(sections.get('ivar'), ('pw', ['#test']))
+        yngve = {'password': 'pw2', 'channels': ['#a']}
+        self.assertTrue(sections.apply(('upsert', 4, 'yngve', yngve)))
+        self.assertEqual(sections.get('yngve'), ('pw2', ['#a']))
+        self.assertTrue(sections.apply(('delete', 5, 'ivar')))
+        self.assertRaises(KeyError, sections.get, 'ivar')
+        self.assertFalse(sections.apply(('delete', 7, 'yngve')))
+        self.assertEqual(sections.version, 5)
+
+
+class AuthCacheTest(SupyTestCase):
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.calls = 0
+        self.cipher_pw = crypt.crypt('ivarpw', 'ab')
+
+    def hasher(self, cleartext_pw, cipher_pw):
+        self.calls += 1
+        return crypt.crypt(cleartext_pw, cipher_pw)
+
+    def testCached(self):
+        cache = irccat._AuthCache(self.hasher)   # pylint: disable=W0212
+        for i in range(0, 5):                     # pylint: disable=W0612
+            self.assertTrue(cache.verify('ivar', 'ivarpw', self.cipher_pw))
+        self.assertEqual(self.calls, 1)
+
+    def testBadPwNotCached(self):
+        cache = irccat._AuthCache(self.hasher)   # pylint: disable=W0212
+        self.assertFalse(cache.verify('ivar', 'bad', self.cipher_pw))
+        self.assertFalse(cache.verify('ivar', 'bad', self.cipher_pw))
+        self.assertEqual(self.calls, 2)
+
+    def testOtherCipher(self):
+        cache = irccat._AuthCache(self.hasher)   # pylint: disable=W0212
+        self.assertTrue(cache.verify('ivar', 'ivarpw', self.cipher_pw))
+        new_cipher = crypt.crypt('ivarpw', 'cd')
+        self.assertTrue(cache.verify('ivar', 'ivarpw', new_cipher))
+        self.assertEqual(self.calls, 2)
+
+    def testExpire(self):
+        cache = irccat._AuthCache(self.hasher)   # pylint: disable=W0212
+        cache.TTL = 0.1
+        self.assertTrue(cache.verify('ivar', 'ivarpw', self.cipher_pw))
+        time.sleep(0.15)
+        self.assertTrue(cache.verify('ivar', 'ivarpw', self.cipher_pw))
+        self.assertEqual(self.calls, 2)
+
+    def testBounded(self):
+        cache = irccat._AuthCache(self.hasher)   # pylint: disable=W0212
+        cache.MaxSize = 2
+        for section in ['a', 'b', 'c', 'a']:
+            cache.verify(section, 'ivarpw', self.cipher_pw)
+        self.assertEqual(self.calls, 4)
+
+    def testForget(self):
+        cache = irccat._AuthCache(self.hasher)   # pylint: disable=W0212
+        cache.verify('ivar', 'ivarpw', self.cipher_pw)
+        cache.verify('yngve', 'ivarpw', self.cipher_pw)
+        cache.forget('ivar')
+        cache.verify('ivar', 'ivarpw', self.cipher_pw)
+        cache.verify('yngve', 'ivarpw', self.cipher_pw)
+        self.assertEqual(self.calls, 3)
+
+    def testClear(self):
+        cache = irccat._AuthCache(self.hasher)   # pylint: disable=W0212
+        cache.verify('ivar', 'ivarpw', self.cipher_pw)
+        cache.clear()
+        cache.verify('ivar', 'ivarpw', self.cipher_pw)
+        self.assertEqual(self.calls, 2)
+
 #
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: